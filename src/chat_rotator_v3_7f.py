@@ -16,30 +16,271 @@ RogoAI Chat Rotator v3.7
 【依存】
   pip install pyperclip PyQt6 requests
   pip install pypdf  # PDF対応（任意）
+  pip install zstandard  # 長文回答の圧縮を zstd に（任意・なければ zlib）
+  pip install numpy  # 意味検索（任意・Local LLM の埋め込みAPIを使用）
 """
 
-import sys, os, sqlite3, hashlib, threading, time, json, re, subprocess
+import sys, os, sqlite3, hashlib, threading, time, json, re, subprocess, queue, random
 import requests, base64, mimetypes
 from dataclasses import dataclass
+from concurrent.futures import Future
+from collections import OrderedDict, Counter
+from array import array
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, Callable
+import zlib, gzip, csv, bisect, platform
+from contextlib import contextmanager
+from functools import wraps
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# ─────────────────────────────────────────────────────────────────────
+# メトリクス
+# ─────────────────────────────────────────────────────────────────────
+class Metrics:
+    """
+    プロセス内の軽量メトリクス：カウンタ・ゲージ・固定バケットのレイテンシヒストグラム（ms）。
+    observe() はバケットの件数を1つ増やすだけで値は保持しない。p50/p95/p99 はバケット内を線形補間した近似値。
+    名前は "cb.read" / "db.commit" / "llm.chat" のように「領域.処理」で付ける。
+    """
+    BUCKETS=(0.05,0.1,0.25,0.5,1,2.5,5,10,25,50,100,250,500,1000,2500,5000,10000,30000,60000,120000)  # ms（上限）
+
+    def __init__(self):
+        self._lock=threading.Lock(); self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters={}; self.gauges={}
+            self.hists={}   # name → [バケット別件数, 件数, 合計ms, 最大ms]
+
+    def inc(self, name:str, n:int=1):
+        with self._lock: self.counters[name]=self.counters.get(name,0)+n
+
+    def gauge(self, name:str, value):
+        with self._lock: self.gauges[name]=value
+
+    def observe(self, name:str, ms:float):
+        i=bisect.bisect_left(self.BUCKETS,ms)
+        with self._lock:
+            h=self.hists.get(name)
+            if h is None: h=self.hists[name]=[[0]*(len(self.BUCKETS)+1),0,0.0,0.0]
+            h[0][i]+=1; h[1]+=1; h[2]+=ms
+            if ms>h[3]: h[3]=ms
+
+    @contextmanager
+    def timer(self, name:str):
+        t=time.perf_counter()
+        try: yield
+        finally: self.observe(name,(time.perf_counter()-t)*1e3)
+
+    def timed(self, name:str):
+        """関数の所要時間を name のヒストグラムに記録するデコレータ"""
+        def deco(fn):
+            @wraps(fn)
+            def wrapper(*a,**kw):
+                t=time.perf_counter()
+                try: return fn(*a,**kw)
+                finally: self.observe(name,(time.perf_counter()-t)*1e3)
+            return wrapper
+        return deco
+
+    def quantile(self, name:str, q:float) -> float:
+        with self._lock:
+            h=self.hists.get(name)
+            if not h or not h[1]: return 0.0
+            counts,n,_,mx=h[0][:],h[1],h[2],h[3]
+        rank=q*n; cum=0
+        for i,c in enumerate(counts):
+            if c and cum+c>=rank:
+                lo=self.BUCKETS[i-1] if i else 0.0
+                hi=min(self.BUCKETS[i] if i<len(self.BUCKETS) else mx,mx)
+                return round(lo+(max(hi,lo)-lo)*(rank-cum)/c,3)
+            cum+=c
+        return round(mx,3)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters=dict(self.counters); gauges=dict(self.gauges); names=sorted(self.hists)
+            raw={k:(self.hists[k][0][:],self.hists[k][1],self.hists[k][2],self.hists[k][3]) for k in names}
+        hists={}
+        for k,(counts,n,total,mx) in raw.items():
+            hists[k]=dict(count=n,mean_ms=round(total/n,3) if n else 0.0,max_ms=round(mx,3),
+                          p50=self.quantile(k,0.5),p95=self.quantile(k,0.95),p99=self.quantile(k,0.99),
+                          buckets={("+Inf" if i==len(self.BUCKETS) else str(self.BUCKETS[i])):c
+                                   for i,c in enumerate(counts) if c})
+        return dict(counters=counters,gauges=gauges,histograms=hists)
+
+    def dump(self, path:str) -> dict:
+        """スナップショットを JSON で書き出す（リリース間の比較用に実行環境も記録）"""
+        snap=dict(app=Path(__file__).stem,created_at=datetime.now().isoformat(timespec="seconds"),
+                  python=platform.python_version(),platform=platform.platform(),**self.snapshot())
+        with open(path,"w",encoding="utf-8") as f: json.dump(snap,f,ensure_ascii=False,indent=1)
+        return snap
+
+metrics=Metrics()
+
 
 # ─────────────────────────────────────────────────────────────────────
 # クリップボード
 # ─────────────────────────────────────────────────────────────────────
-_cb_backend = None
+class ClipboardBackend:
+    """
+    クリップボードの読み書き先。read / write に加え、変化通知に対応するものは
+    watch(cb) で cb() を登録して True を返す（未対応は False → 監視側がポーリング）。
+    通知は「変わった」だけを伝え、本文は読まない（読むかどうかは監視側が決める）。
+    """
+    name = "none"
+    PUMP = None   # 秒。待ち時間にも pump() が必要なもの（tkinter のイベント処理）だけ指定
+    def read(self) -> str: return ""
+    def write(self, text:str): pass
+    def watch(self, cb:Callable) -> bool: return False
+    def pump(self): pass
+    def close(self): pass
+
+class PyperclipBackend(ClipboardBackend):
+    name = "pyperclip"
+    def __init__(self):
+        import pyperclip; self._pc=pyperclip; pyperclip.paste()
+    def read(self) -> str: return self._pc.paste() or ""
+    def write(self, text:str): self._pc.copy(text)
+
+class TkBackend(ClipboardBackend):
+    """
+    Tk ルートを1つだけ作って使い回す（作成したスレッドからしか触れないので ClipboardService 経由で使う）。
+    X11 では書き込んだ内容をこのルートが持ち続け、pump() のイベント処理で他アプリの貼り付けに応答する。
+    """
+    name = "tkinter"
+    PUMP = 0.05
+    def __init__(self):
+        import tkinter as tk; self._tk=tk
+        self._r=tk.Tk(); self._r.withdraw()
+    def read(self) -> str:
+        try: return self._r.clipboard_get()
+        except self._tk.TclError: return ""
+    def write(self, text:str):
+        self._r.clipboard_clear(); self._r.clipboard_append(text); self._r.update()
+    def pump(self): self._r.update()
+    def close(self): self._r.destroy()
+
+class QtClipboardBackend(ClipboardBackend):
+    """
+    QApplication.clipboard() を使う（GUI 版の既定）。同じプロセス内で読めるので外部コマンドを起動せず、
+    dataChanged で変化したときだけ読む。GUI スレッドで作ること（通知も GUI スレッドで届く）。
+    QClipboard は GUI スレッド専用なので、別スレッドからの read は GUI スレッドに取り出しを頼んで結果を待ち、
+    HTML → テキスト変換は呼び出し側のスレッドで行う。
+    他アプリのコピーも通知されるのは Windows と X11 だけなので、それ以外は pyperclip / tkinter のまま。
+    """
+    name = "qt"
+    NOTIFY_PLATFORMS = ("windows","xcb")
+    READ_TIMEOUT = 5.0
+    def __init__(self, clipboard):
+        from PyQt6.QtCore import QObject, pyqtSignal
+        class _GuiCall(QObject):   # GUI スレッドに住む受け手。別スレッドの emit はキュー経由で GUI スレッドで実行
+            run=pyqtSignal(object)
+            def __init__(self): super().__init__(); self.run.connect(self._do)
+            def _do(self, fn): fn()
+        self._cb=clipboard; self._gui=threading.get_ident(); self._call=_GuiCall()
+    def _fetch(self) -> tuple:
+        """GUI スレッドで (text, html) を取り出すだけ（変換しない）"""
+        md=self._cb.mimeData()
+        if md is None: return "",""
+        return (md.text() if md.hasText() else ""),(md.html() if md.hasHtml() else "")
+    def read(self) -> str:
+        if threading.get_ident()==self._gui: text,html=self._fetch()
+        else:
+            fut=Future()
+            def _run():
+                try: fut.set_result(self._fetch())
+                except Exception as e: fut.set_exception(e)
+            self._call.run.emit(_run); text,html=fut.result(self.READ_TIMEOUT)
+        # プレーンテキストがなく HTML だけのコピー（表・図の選択など）
+        if not text.strip() and html: text=_html_to_text(html)
+        return text
+    def write(self, text:str): self._cb.setText(text)
+    def watch(self, cb:Callable) -> bool:
+        self._cb.dataChanged.connect(cb); return True
+
+class MemoryBackend(ClipboardBackend):
+    """プロセス内だけのクリップボード（GUI・X サーバーなしで取り込み処理を試す用）"""
+    name = "memory"
+    def __init__(self, text:str=""):
+        self._text=text; self._watchers=[]
+    def read(self) -> str: return self._text
+    def write(self, text:str):
+        self._text=text
+        for cb in self._watchers: cb()
+    def watch(self, cb:Callable) -> bool:
+        self._watchers.append(cb); return True
+
+class ClipboardService(ClipboardBackend):
+    """
+    バックエンド1つを専用スレッドで持ち、読み書きを要求キューで受け付ける（pyperclip / tkinter 用）。
+    write は積むだけで即座に戻る（外部コマンドの起動や Tk の処理で UI を止めない）。
+    続けて write された場合は最後の1件だけを書く。read は結果を待つ（キューの順なので直前の write が反映済み）。
+    """
+    READ_TIMEOUT = 5.0
+
+    def __init__(self, factory:Callable):
+        self._q=queue.Queue(); self._wseq=0; self._seq_lock=threading.Lock()
+        ready=Future()
+        self._thread=threading.Thread(target=self._run,args=(factory,ready),daemon=True,name="clipboard")
+        self._thread.start()
+        self._backend=ready.result()   # 生成に失敗（未インストール・ディスプレイなし）したらここで例外
+        self.name=self._backend.name
+
+    def _run(self, factory:Callable, ready:Future):
+        try: b=factory()
+        except Exception as e: ready.set_exception(e); return
+        ready.set_result(b)
+        while True:
+            try: op,arg,fut=self._q.get(timeout=b.PUMP)
+            except queue.Empty: b.pump(); continue
+            try:
+                if op=="close": b.close(); fut.set_result(None); return
+                if op=="read": fut.set_result(b.read())
+                elif arg[0]==self._wseq: b.write(arg[1]); fut.set_result(True)
+                else: fut.set_result(False)   # 後から別の write が来ている → 書かない
+            except Exception as e:
+                print(f"[DEBUG] clipboard {op} error: {e}", flush=True); fut.set_exception(e)
+
+    def _submit(self, op:str, arg=None) -> Future:
+        fut=Future(); self._q.put((op,arg,fut)); return fut
+
+    def read(self) -> str:
+        return self._submit("read").result(self.READ_TIMEOUT)
+
+    def write(self, text:str) -> Future:
+        with self._seq_lock:
+            self._wseq+=1; return self._submit("write",(self._wseq,text))
+
+    def close(self):
+        if self._thread.is_alive(): self._submit("close").result(self.READ_TIMEOUT)
+
+_cb:ClipboardBackend = ClipboardBackend()
+_cb_backend = None   # 使用中のバックエンド名（表示・ログ用）
+
+def _use_cb(backend:ClipboardBackend):
+    """クリップボードのバックエンドを差し替える（GUI 起動後の Qt 版・テスト用の MemoryBackend など）"""
+    global _cb, _cb_backend
+    old=_cb; _cb=backend; _cb_backend=backend.name
+    if old is not backend: old.close()
+    print(f"[DEBUG] clipboard backend={backend.name}", flush=True)
 
 def _init_cb() -> bool:
-    global _cb_backend
-    try:
-        import pyperclip; pyperclip.paste(); _cb_backend = "pyperclip"; return True
-    except: pass
-    try:
-        import tkinter as tk; _cb_backend = "tkinter"; return True
-    except: pass
+    """GUI 起動前の既定：pyperclip、なければ tkinter（どちらも専用スレッドの ClipboardService で動かす）"""
+    for cls in (PyperclipBackend, TkBackend):
+        try: _use_cb(ClipboardService(cls)); return True
+        except Exception: pass
     return False
 
+@metrics.timed("cb.cf_html")
 def _html_to_text(html: str) -> str:
     """CF_HTML形式からプレーンテキストを抽出"""
     import re as _re, html as _htmlmod
@@ -61,18 +302,10 @@ def _html_to_text(html: str) -> str:
     body = _re.sub(r'\n{3,}', '\n\n', body)
     return body.strip()
 
+@metrics.timed("cb.read")
 def _get_cb() -> str:
     # まずプレーンテキストを取得
-    plain = ""
-    if _cb_backend == "pyperclip":
-        import pyperclip
-        plain = pyperclip.paste() or ""
-    elif _cb_backend == "tkinter":
-        import tkinter as tk
-        r = tk.Tk(); r.withdraw()
-        try: plain = r.clipboard_get()
-        except: plain = ""
-        finally: r.destroy()
+    plain = _cb.read()
 
     if plain.strip():
         return plain
@@ -102,14 +335,9 @@ def _get_cb() -> str:
     return plain
 
 
+@metrics.timed("cb.write")
 def _set_cb(text: str):
-    if _cb_backend == "pyperclip":
-        import pyperclip; pyperclip.copy(text)
-    elif _cb_backend == "tkinter":
-        import tkinter as tk
-        r = tk.Tk(); r.withdraw()
-        r.clipboard_clear(); r.clipboard_append(text)
-        r.update(); time.sleep(0.3); r.destroy()
+    _cb.write(text)
 
 
 # ─────────────────────────────────────────────────────────────────────
@@ -263,6 +491,58 @@ class FileAttachment:
 # ─────────────────────────────────────────────────────────────────────
 # データベース
 # ─────────────────────────────────────────────────────────────────────
+class MessageRow:
+    """
+    一覧・検索結果の1行。値は SELECT のタプルのまま持ち、列名→位置の表は結果セット全体で共有する
+    （行ごとに dict を作らない）。m["id"] / m.get("snippet") / dict(m) は従来の dict と同じように使える。
+    == は (id, rev) だけで比較する（rev は行が更新されるたびに増える版番号）。
+    metadata の JSON は .meta を初めて読んだときにだけ解析する。
+    """
+    __slots__=("_cols","_vals","_meta")
+
+    def __init__(self, cols:dict, vals:tuple):
+        self._cols=cols; self._vals=vals; self._meta=None
+
+    @staticmethod
+    def columns(description) -> dict:
+        return {d[0]:i for i,d in enumerate(description)}
+
+    @classmethod
+    def batch(cls, cur, rows:list=None) -> list:
+        """カーソルの結果（rows 省略時は fetchall）を MessageRow のリストにする"""
+        cols=cls.columns(cur.description)
+        return [cls(cols,v) for v in (cur.fetchall() if rows is None else rows)]
+
+    def __getitem__(self, key:str):
+        return self._vals[self._cols[key]]
+
+    def get(self, key:str, default=None):
+        i=self._cols.get(key)
+        return default if i is None else self._vals[i]
+
+    def __contains__(self, key:str) -> bool: return key in self._cols
+    def keys(self): return self._cols.keys()
+    def items(self): return zip(self._cols,self._vals)
+
+    @property
+    def key(self) -> tuple:
+        return (self.get("id"),self.get("rev",0))
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            try: self._meta=json.loads(self.get("metadata") or "{}")
+            except ValueError: self._meta={}
+        return self._meta
+
+    def __eq__(self, other):
+        if not isinstance(other,MessageRow): return NotImplemented
+        return self.key==other.key
+
+    def __hash__(self): return hash(self.key)
+    def __repr__(self): return f"MessageRow({dict(self.items())!r})"
+
+
 class ChatDatabase:
     LABELS = [
         ("summary",     "📄 Summary",    "要約対象"),
@@ -272,17 +552,135 @@ class ChatDatabase:
         ("user_note",   "✏️  Note",       "メモ"),
     ]
 
-    def __init__(self, db_path:str="chat_rotator.db"):
+    BUSY_TIMEOUT = 5.0   # 秒。書き込み競合時に待つ上限
+
+    def __init__(self, db_path:str="chat_rotator.db", group_commit:bool=False, auto_archive:bool=True):
         self.db_path=db_path
-        self._lock=threading.Lock()
-        self._conn=sqlite3.connect(db_path, check_same_thread=False)
-        self._conn.row_factory=sqlite3.Row
-        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._lock=threading.Lock()     # 書き込みは self._conn（単一ライター）に直列化
+        self._local=threading.local()   # 読み取りはスレッドごとの専用接続
+        self._readers=[]; self._rlock=threading.Lock()   # 作成した読み取り接続（スレッド, 接続）。close() で全部閉じる
+        self._content_cache=OrderedDict(); self._cache_lock=threading.Lock()
+        self._arc_lock=threading.Lock()   # 月別アーカイブの退避は同時に1つだけ
+        self._qcache=OrderedDict(); self._qstats=[0,0]; self._gen=0   # 検索・統計結果の LRU（hit, miss）
+        self._conn=self._connect()
+        # WAL: 読み取りが書き込みをブロックしない（UIの長い検索中もワーカーがコミットできる）
+        mode=self._conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._wal=str(mode).lower()=="wal"
+        print(f"[DEBUG] DB journal_mode={mode}", flush=True)
         self._init_schema()
+        self._watch_content()
+        self._wq=None; self._writer=None
+        if group_commit: self.start_writer()
+        self._scan_archives()
+        if auto_archive and self._archive_due():
+            threading.Thread(target=self.archive_old,daemon=True).start()
+
+    def _connect(self) -> sqlite3.Connection:
+        c=sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT, check_same_thread=False, uri=True)
+        c.row_factory=sqlite3.Row
+        c.create_function("cr_unpack",1,self._unpack,deterministic=True)
+        c.execute("PRAGMA foreign_keys = ON")
+        return c
+
+    def _reader(self) -> sqlite3.Connection:
+        """
+        呼び出しスレッド専用の読み取り接続（初回に作成）。作成した接続は登録しておき、
+        終了したスレッドの分は次の作成時に、残りは close() でまとめて閉じる（ATTACH 中のアーカイブも外れる）。
+        WAL でなければ（:memory: 等）共有ライター接続をそのまま使う。
+        """
+        if not self._wal: return self._conn
+        c=getattr(self._local,"conn",None)
+        if c is None:
+            c=self._local.conn=self._connect()
+            c.execute("PRAGMA query_only=ON")
+            with self._rlock:
+                live=[]
+                for t,rc in self._readers:
+                    if t.is_alive(): live.append((t,rc))
+                    else: rc.close()
+                self._readers=live+[(threading.current_thread(),c)]
+        return c
+
+    def close(self):
+        self.stop_writer()
+        with self._rlock:
+            for _,rc in self._readers: rc.close()
+            self._readers=[]
+        self._local.conn=None; self._local.attached=None
+        with self._lock: self._conn.close()
+
+    # ── スキーマ・マイグレーション（PRAGMA user_version で管理）──────────
+    # (version, メソッド) を順に適用。各ステップは c を受け取り commit しない。
+    # ランナーが1ステップ=1トランザクションで実行し、user_version を進めて COMMIT する。
+    # 手順は既存DB（どの版から来ても）に対して冪等に書く。
+    MIGRATIONS = [
+        (1, "_mig_base"),          # 基本表・索引（v3.7f 以前の列追加を含む）
+        (2, "_mig_meta_columns"),  # metadata → 索引付き生成列
+        (3, "_mig_preview"),       # preview 列・既存本文の圧縮
+        (4, "_mig_hash"),          # blake2b 再ハッシュ・UNIQUE(content_hash)
+        (5, "_mig_ai_services"),   # 既定の AI サービス
+        (6, "_mig_fts"),           # FTS5 trigram（展開ビュー経由）
+        (7, "_mig_change_log"),    # 変更フィード
+        (8, "_mig_counters"),      # 件数カウンタ
+        (9, "_mig_embeddings"),    # 意味検索用の埋め込みベクトル
+        (10,"_mig_simhash"),       # 近似重複検出用の SimHash（LSH バンド）
+        (11,"_mig_threads"),       # 回答→質問の紐付け（question_id）
+        (12,"_mig_row_version"),   # 行の版番号（rev）
+        (13,"_mig_service_date"),  # service＋期間検索用の複合索引
+        (14,"_mig_thread_archive"),# 質問の月別アーカイブでは回答の紐付けを外さない
+        (15,"_mig_fts_queue"),     # FTS 同期トリガーから Python 関数（cr_unpack）を外す
+    ]
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
 
     def _init_schema(self):
+        self._digest=self.HASH_ALGOS[self.HASH_ALGO]
+        self.migrate()
+        self._start_fts()
+
+    def migrate(self, target:int=None) -> list:
+        """
+        user_version より新しいマイグレーションを順に適用し、適用した version を返す。
+        最新のDBは PRAGMA user_version を1回読むだけで戻る（DBサイズに依存しない）。
+        失敗したステップはロールバックされ、user_version はその手前で止まる。
+        """
         c=self._conn
-        # マイグレーション（既存DBへの列追加）
+        target=self.SCHEMA_VERSION if target is None else target
+        cur=c.execute("PRAGMA user_version").fetchone()[0]
+        if cur>=target: return []
+        done=[]
+        with self._lock:
+            iso=c.isolation_level; c.isolation_level=None   # BEGIN/COMMIT を自前で管理
+            try:
+                for ver,name in self.MIGRATIONS:
+                    if ver<=cur or ver>target: continue
+                    t=time.time()
+                    c.execute("BEGIN IMMEDIATE")
+                    try:
+                        getattr(self,name)(c)
+                        self._fts_sync(c)
+                        c.execute(f"PRAGMA user_version={ver}")
+                        c.execute("COMMIT")
+                    except Exception:
+                        c.execute("ROLLBACK"); raise
+                    done.append(ver)
+                    print(f"[DEBUG] migration {ver} {name} {time.time()-t:.2f}s", flush=True)
+            finally:
+                c.isolation_level=iso
+        return done
+
+    @staticmethod
+    def _script(c:sqlite3.Connection, sql:str):
+        """複文を1文ずつ実行（executescript と違い途中で COMMIT しない）"""
+        buf=""
+        for line in sql.splitlines(keepends=True):
+            buf+=line
+            if sqlite3.complete_statement(buf):
+                c.execute(buf); buf=""
+        if buf.strip() and not buf.strip().startswith("--"): c.execute(buf)
+
+    def _mig_base(self, c):
+        # 既存DBへの列追加（v3.7f 以前）
         for tbl,col,dfn in [
             ("messages","metadata", "TEXT NOT NULL DEFAULT '{}'"),
             ("messages","ts",       "TEXT DEFAULT ''"),
@@ -290,9 +688,7 @@ class ChatDatabase:
             ex=[r[1] for r in c.execute(f"PRAGMA table_info({tbl})").fetchall()]
             if ex and col not in ex:
                 c.execute(f"ALTER TABLE {tbl} ADD COLUMN {col} {dfn}")
-        c.commit()
-
-        c.executescript("""
+        self._script(c,"""
             CREATE TABLE IF NOT EXISTS sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
@@ -319,110 +715,1172 @@ class ChatDatabase:
             CREATE TABLE IF NOT EXISTS settings (
                 key TEXT PRIMARY KEY, value TEXT, updated_at TEXT
             );
-            CREATE INDEX IF NOT EXISTS idx_msg_hash ON messages(content_hash);
             CREATE INDEX IF NOT EXISTS idx_msg_sess ON messages(session_id,detected_at);
             CREATE INDEX IF NOT EXISTS idx_msg_ts   ON messages(ts);
+            CREATE INDEX IF NOT EXISTS idx_msg_service ON messages(service);
+            CREATE INDEX IF NOT EXISTS idx_msg_detected ON messages(detected_at);
+        """)
+
+    # metadata JSON から昇格させる生成列（列名, JSONパス）
+    META_COLUMNS = [("label","$.label"),("source","$.source"),("model","$.model"),("from_id","$.from")]
+
+    def _mig_meta_columns(self, c):
+        """
+        よく絞り込む metadata のキーを VIRTUAL 生成列として追加し索引を張る。
+        json_extract を行ごとに評価していたクエリを索引検索にするため。
+        """
+        ex=[r[1] for r in c.execute("PRAGMA table_xinfo(messages)").fetchall()]
+        for col,path in self.META_COLUMNS:
+            if col not in ex:
+                c.execute(f"ALTER TABLE messages ADD COLUMN {col} "
+                          f"GENERATED ALWAYS AS (json_extract(metadata,'{path}')) VIRTUAL")
+        self._script(c,"""
+            CREATE INDEX IF NOT EXISTS idx_msg_label     ON messages(label);
+            CREATE INDEX IF NOT EXISTS idx_msg_source    ON messages(source);
+            CREATE INDEX IF NOT EXISTS idx_msg_model     ON messages(model);
+            CREATE INDEX IF NOT EXISTS idx_msg_from      ON messages(from_id);
+            CREATE INDEX IF NOT EXISTS idx_msg_svc_label ON messages(service,label);
+        """)
+
+    # ── 本文の圧縮と preview 列 ───────────────────────────────────────
+    COMPRESS_MIN = 4096   # これ以上（UTF-8 バイト数）の本文は圧縮して BLOB で保存
+    PREVIEW_LEN  = 200    # 一覧表示用に先頭だけ平文で持つ文字数
+
+    @staticmethod
+    def _pack(text:str):
+        """長い本文を圧縮（先頭1バイトで方式を識別）。短い・縮まない本文は str のまま"""
+        raw=text.encode()
+        if len(raw)<ChatDatabase.COMPRESS_MIN: return text
+        z=b"S"+_zstd.ZstdCompressor(level=3).compress(raw) if _zstd else b"Z"+zlib.compress(raw,6)
+        return z if len(z)<len(raw) else text
+
+    @staticmethod
+    def _unpack(v):
+        """_pack の逆。SQL からは cr_unpack(content) として使う"""
+        if not isinstance(v,bytes): return v
+        if v[:1]==b"Z": return zlib.decompress(v[1:]).decode()
+        if v[:1]==b"S":
+            if _zstd is None: raise RuntimeError("zstd 圧縮の本文です（pip install zstandard）")
+            return _zstd.ZstdDecompressor().decompress(v[1:]).decode()
+        return v.decode()
+
+    def _mig_preview(self, c):
+        """
+        一覧用の preview 列を追加し、既存行を埋める。
+        あわせて COMPRESS_MIN 以上の既存本文を圧縮する（初回のみ・以後は保存時に圧縮）。
+        """
+        ex=[r[1] for r in c.execute("PRAGMA table_info(messages)").fetchall()]
+        if "preview" in ex: return
+        t=time.time()
+        # 旧形式の FTS 更新トリガーは圧縮 BLOB をそのまま索引してしまう → 外す（_mig_fts で作り直す）
+        c.execute("DROP TRIGGER IF EXISTS messages_fts_au")
+        c.execute("ALTER TABLE messages ADD COLUMN preview TEXT NOT NULL DEFAULT ''")
+        c.execute("UPDATE messages SET preview=substr(content,1,?)",(self.PREVIEW_LEN,))
+        big=c.execute("SELECT id,content FROM messages WHERE typeof(content)='text' AND length(CAST(content AS BLOB))>=?",
+                      (self.COMPRESS_MIN,)).fetchall()
+        for mid,content in big:
+            packed=self._pack(content)
+            if packed is not content:
+                c.execute("UPDATE messages SET content=? WHERE id=?",(packed,mid))
+        print(f"[DEBUG] preview column added, compressed={len(big)} {time.time()-t:.2f}s", flush=True)
+
+    CONTENT_CACHE = 32   # 展開済み本文を保持する件数（LRU）
+
+    def get_message_content(self, msg_id:int) -> str:
+        """1件の本文を展開して返す（本文を開いたときだけ呼ぶ）"""
+        return self.get_message_contents([msg_id]).get(msg_id,"")
+
+    def get_message_contents(self, ids:list) -> dict:
+        """
+        複数件の本文を {id: 本文} で返す。直近に開いた本文は LRU から返し、
+        残りは1回の IN 検索でまとめて取得する。
+        本文の書き換え（近似重複の差し替えなど）は _watch_content のトリガーが LRU から外す。
+        id は再利用されない（AUTOINCREMENT）ので削除の無効化は不要。
+        """
+        out={}; miss=[]
+        with self._cache_lock:
+            for i in ids:
+                if i in self._content_cache:
+                    self._content_cache.move_to_end(i); out[i]=self._content_cache[i]
+                else: miss.append(i)
+        if miss:
+            ph=",".join("?"*len(miss))
+            rows=self._reader().execute(f"SELECT id,content FROM messages WHERE id IN ({ph})",miss).fetchall()
+            # ホットに無い id は ATTACH 済みのアーカイブ（この検索で開いたもの）を探す
+            left=set(miss)-{r[0] for r in rows}
+            for sch in list(getattr(self._local,"attached",None) or {}):
+                if not left: break
+                ph=",".join("?"*len(left))
+                got=self._reader().execute(f"SELECT id,content FROM {sch}.messages WHERE id IN ({ph})",list(left)).fetchall()
+                rows+=got; left-={r[0] for r in got}
+            with self._cache_lock:
+                for mid,v in rows:
+                    out[mid]=self._content_cache[mid]=self._unpack(v)
+                while len(self._content_cache)>self.CONTENT_CACHE:
+                    self._content_cache.popitem(last=False)
+        return out
+
+    def _watch_content(self):
+        """
+        messages.content の UPDATE で本文 LRU から外す（書き込み接続だけの TEMP トリガー）。
+        どの経路の書き換えもここを通るので呼び出し側で個別に無効化しない。
+        DBファイルには残らないのでアプリ外のツールには影響しない。
+        """
+        self._conn.create_function("cr_forget",1,self._forget_content)
+        self._conn.execute("CREATE TEMP TRIGGER IF NOT EXISTS cr_content_au AFTER UPDATE OF content ON main.messages"
+                           " BEGIN SELECT cr_forget(old.id); END")
+
+    def _forget_content(self, msg_id:int):
+        with self._cache_lock: self._content_cache.pop(msg_id,None)
+
+    # ── 検索・統計結果のキャッシュ（キー＝正規化した条件＋データ版）──────────
+    # データ版は change_token()（messages への書き込みでトリガーが進める）。
+    # ai_services・カウンタ再集計など change_log に出ない書き込みは self._gen を進める。
+    # 古い版のエントリは参照されなくなり、LRU で押し出される。
+    QUERY_CACHE = 64   # 保持する結果の件数
+
+    def _cached(self, key:tuple, fn):
+        with self._cache_lock:
+            if key in self._qcache:
+                self._qcache.move_to_end(key); self._qstats[0]+=1
+                return self._qcache[key]
+            self._qstats[1]+=1
+        v=fn()
+        with self._cache_lock:
+            self._qcache[key]=v
+            while len(self._qcache)>self.QUERY_CACHE: self._qcache.popitem(last=False)
+        return v
+
+    def _data_version(self) -> tuple:
+        return (self.change_token(),self._gen,self._fts_ready)
+
+    def _query_key(self, query:str) -> tuple:
+        """検索条件の正規化（AND 結合なのでトークン順は無関係）。相対期間は分単位で更新"""
+        toks=tuple(sorted(query.split()))
+        rel=any(re.search(r"last\d+[hdw]|today|yesterday",t,re.I) for t in toks)
+        return toks+((datetime.now().strftime("%Y-%m-%dT%H:%M"),) if rel else ())
+
+    def _invalidate_queries(self):
+        """change_log に現れない書き込みのあとに呼ぶ（ai_services・カウンタ）"""
+        with self._cache_lock: self._gen+=1
+
+    def cache_stats(self) -> dict:
+        """検索・統計キャッシュのヒット数・ミス数・ヒット率（HISTORY タブの統計に表示）"""
+        with self._cache_lock:
+            hits,miss=self._qstats; n=len(self._qcache)
+        return {"hits":hits,"misses":miss,"size":n,"rate":hits/(hits+miss) if hits+miss else 0.0}
+
+    # ── 重複判定キー（content_hash）────────────────────────────────────
+    # blake2b(16byte) は md5 と同じ32桁で、md5 より速い
+    HASH_ALGOS = {
+        "md5":     lambda b: hashlib.md5(b).hexdigest(),
+        "blake2b": lambda b: hashlib.blake2b(b,digest_size=16).hexdigest(),
+    }
+    HASH_ALGO = "blake2b"
+
+    def _mig_hash(self, c):
+        """
+        content_hash を UNIQUE 索引にして重複判定を INSERT 側に任せる。
+        保存済みのハッシュ関数（settings.hash_algo、未記録の既存DBは md5）が
+        HASH_ALGO と違えば全行を再計算する。既存の重複行は消さずに「hash:id」へ退避。
+        HASH_ALGO を変えるときは、このステップを呼ぶ新しいマイグレーションを足す。
+        """
+        row=c.execute("SELECT value FROM settings WHERE key='hash_algo'").fetchone()
+        has_rows=c.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+        cur=row[0] if row else ("md5" if has_rows else self.HASH_ALGO)
+        if cur!=self.HASH_ALGO:
+            t=time.time(); upd=[]; seen=set()
+            for mid,ts,svc,content,label in c.execute(
+                "SELECT id,ts,service,cr_unpack(content),label FROM messages ORDER BY id"
+            ):
+                h=self.question_hash(ts or "",content) if label=="question" else self.message_hash(svc,content)
+                if h in seen: h=f"{h}:{mid}"
+                seen.add(h); upd.append((h,mid))
+            c.execute("DROP INDEX IF EXISTS idx_msg_hash_u")
+            c.executemany("UPDATE messages SET content_hash=? WHERE id=?",upd)
+            print(f"[DEBUG] rehash {cur}→{self.HASH_ALGO} rows={len(upd)} {time.time()-t:.2f}s", flush=True)
+        if not c.execute("SELECT 1 FROM sqlite_master WHERE name='idx_msg_hash_u'").fetchone():
+            c.execute("""
+                UPDATE messages SET content_hash=content_hash||':'||id
+                WHERE id NOT IN (SELECT MIN(id) FROM messages GROUP BY content_hash)
+            """)
+            c.execute("DROP INDEX IF EXISTS idx_msg_hash")
+            c.execute("CREATE UNIQUE INDEX idx_msg_hash_u ON messages(content_hash)")
+        c.execute("INSERT OR REPLACE INTO settings(key,value,updated_at) VALUES('hash_algo',?,?)",
+                  (self.HASH_ALGO,datetime.now().isoformat()))
+
+    def message_hash(self, service:str, content:str) -> str:
+        # serviceも含めてhash化 → 同内容でもAIが違えば別レコード
+        return self._digest(f"{service}:{content}".encode())
+
+    def question_hash(self, ts:str, content:str) -> str:
+        return self._digest(f"Q:{ts}:{content[:80]}".encode())
+
+    # ── 変更フィード ──────────────────────────────────────────────────
+    CHANGE_LOG_KEEP = 5000   # change_log に残す直近の件数
+
+    def _mig_change_log(self, c):
+        """
+        messages の INSERT/UPDATE/DELETE をトリガーで change_log に記録する。
+        seq が単調増加の変更トークンになる（同一接続の書き込みは PRAGMA data_version
+        に現れないため、カウンタ方式にしている）。古い行は1000件ごとに刈り込む。
+        """
+        self._script(c,f"""
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq    INTEGER PRIMARY KEY AUTOINCREMENT,
+                msg_id INTEGER NOT NULL,
+                op     TEXT NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_chg_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO change_log(msg_id,op) VALUES(new.id,'I');
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_chg_au AFTER UPDATE ON messages BEGIN
+                INSERT INTO change_log(msg_id,op) VALUES(new.id,'U');
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_chg_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO change_log(msg_id,op) VALUES(old.id,'D');
+            END;
+            CREATE TRIGGER IF NOT EXISTS change_log_prune AFTER INSERT ON change_log
+            WHEN new.seq%1000=0 BEGIN
+                DELETE FROM change_log WHERE seq<=new.seq-{self.CHANGE_LOG_KEEP};
+            END;
+        """)
+
+    def change_token(self) -> int:
+        """現在の変更トークン（変化がなければ同じ値）"""
+        return self._reader().execute("SELECT IFNULL(MAX(seq),0) FROM change_log").fetchone()[0]
+
+    def changes_since(self, token:int) -> dict:
+        """
+        token 以降に変化した message id を返す。
+          {"token":新トークン, "inserted":[…], "updated":[…], "deleted":[…], "reset":bool}
+        同じ id の連続した変化はまとめる（挿入→削除は消える、挿入→更新は挿入）。
+        reset=True は刈り込み済みで差分が取れない → 呼び出し側で全再読込。
+        """
+        rows=self._reader().execute(
+            "SELECT seq,msg_id,op FROM change_log WHERE seq>? ORDER BY seq",(token,)
+        ).fetchall()
+        oldest=self._reader().execute("SELECT IFNULL(MIN(seq),0) FROM change_log").fetchone()[0]
+        state:dict={}
+        for _,mid,op in rows:
+            prev=state.get(mid)
+            if op=="D": state[mid]=None if prev=="I" else "D"
+            elif op=="U": state[mid]=prev if prev in ("I","D") else "U"
+            else: state[mid]="I"
+        return {
+            "token":    rows[-1][0] if rows else token,
+            "inserted": sorted(i for i,o in state.items() if o=="I"),
+            "updated":  sorted(i for i,o in state.items() if o=="U"),
+            "deleted":  sorted(i for i,o in state.items() if o=="D"),
+            "reset":    bool(rows) and token<oldest-1,
+        }
+
+    # ── 月別アーカイブ（古い月を別DBへ退避し、必要なときだけ ATTACH）──────
+    ARCHIVE_KEEP_MONTHS = 0   # ホットDBに残す月数（settings.archive_months で指定、0=退避しない＝既定）
+    ARCHIVE_CHUNK       = 500 # 1回の書き込みロックで移す行数（ロックを離す間に取り込み・Local LLM の保存が進む）
+    MAX_ATTACH          = 8   # 1接続で同時に ATTACH するアーカイブ数（SQLite の上限は10）
+
+    def _archive_path(self, month:str) -> str:
+        p=Path(self.db_path)
+        return str(p.with_name(f"{p.stem}_archive_{month.replace('-','')}{p.suffix or '.db'}"))
+
+    def _scan_archives(self):
+        """既存のアーカイブファイルを {"YYYY-MM": パス} に登録"""
+        self._archives={}
+        if self.db_path==":memory:": return
+        p=Path(self.db_path)
+        pat=re.compile(re.escape(p.stem)+r"_archive_(\d{4})(\d{2})"+re.escape(p.suffix or ".db")+"$")
+        for f in p.resolve().parent.glob(f"{p.stem}_archive_*"):
+            m=pat.match(f.name)
+            if m: self._archives[f"{m[1]}-{m[2]}"]=str(f)
+
+    def _archive_cutoff(self, keep:int) -> str:
+        """keep か月より前の月初（この日時より古い行が退避対象）"""
+        now=datetime.now(); y,m=now.year,now.month-(keep-1)
+        while m<1: y-=1; m+=12
+        return f"{y:04d}-{m:02d}-01"
+
+    def _archive_keep(self) -> int:
+        try: return int(self.get_setting("archive_months",self.ARCHIVE_KEEP_MONTHS))
+        except (TypeError,ValueError): return self.ARCHIVE_KEEP_MONTHS
+
+    def _archive_due(self) -> bool:
+        keep=self._archive_keep()
+        if keep<=0 or self.db_path==":memory:": return False
+        oldest=self._reader().execute("SELECT MIN(detected_at) FROM messages").fetchone()[0]
+        return bool(oldest) and oldest<self._archive_cutoff(keep)
+
+    def archive_old(self, keep_months:int=None) -> int:
+        """
+        keep_months より古い月のメッセージを月別アーカイブDBへ移す（移した行数を返す）。
+        アーカイブへ書いて commit → ホットから削除、の順なので途中で落ちても行は失われない
+        （再実行時は INSERT OR IGNORE で二重にならない）。
+        """
+        keep=self._archive_keep() if keep_months is None else keep_months
+        if keep<=0 or self.db_path==":memory:": return 0
+        if not self._arc_lock.acquire(blocking=False): return 0   # 起動時の自動退避と SETTINGS の実行が重ならないように
+        try: return self._archive_old(keep)
+        finally: self._arc_lock.release()
+
+    def _archive_old(self, keep:int) -> int:
+        cutoff=self._archive_cutoff(keep)
+        months=[r[0] for r in self._reader().execute(
+            "SELECT DISTINCT substr(detected_at,1,7) FROM messages WHERE detected_at<? ORDER BY 1",(cutoff,)
+        ).fetchall()]
+        moved=0
+        try:
+            for mon in months: moved+=self._archive_month(mon)
+        except Exception as e:
+            print(f"[DEBUG] archive error: {e}", flush=True)
+        if months:
+            self._scan_archives()
+            print(f"[DEBUG] archived {moved} rows into {len(months)} month(s)", flush=True)
+        return moved
+
+    def _archive_month(self, mon:str) -> int:
+        """
+        1か月分を ARCHIVE_CHUNK 行ずつ「アーカイブへコピー（FTS も）→ commit」し、全部写してから
+        同じく ARCHIVE_CHUNK 行ずつホットから削除する。チャンクごとに書き込みロックを離す。
+        """
+        y,m=int(mon[:4]),int(mon[5:7])
+        lo=f"{mon}-01"; hi=f"{y+m//12:04d}-{m%12+1:02d}-01"
+        cols="id,session_id,ts,role,service,content,content_hash,detected_at,metadata,preview,question_id,rev"
+        rng="detected_at>=? AND detected_at<? AND id>? AND id<=?"
+        c=self._conn; n=0
+        with self._lock:
+            c.execute("ATTACH DATABASE ? AS arcw",(self._archive_path(mon),))
+        try:
+            with self._lock:
+                self._init_archive_schema("arcw")
+                c.execute("INSERT OR IGNORE INTO arcw.sessions SELECT * FROM main.sessions WHERE id IN"
+                          " (SELECT session_id FROM main.messages WHERE detected_at>=? AND detected_at<?)",(lo,hi))
+                self._commit()
+            # コピー：再実行時（前回途中で落ちた）に既にある行は FTS にも入れない
+            pos=0
+            while True:
+                with self._lock:
+                    try:
+                        nxt=c.execute("SELECT MAX(id) FROM (SELECT id FROM main.messages WHERE detected_at>=? AND detected_at<?"
+                                      " AND id>? ORDER BY id LIMIT ?)",(lo,hi,pos,self.ARCHIVE_CHUNK)).fetchone()[0]
+                        if nxt is None: break
+                        if self._has_fts:
+                            c.execute(f"INSERT INTO arcw.messages_fts(rowid,content) SELECT id,cr_unpack(content)"
+                                      f" FROM main.messages WHERE {rng} AND id NOT IN (SELECT id FROM arcw.messages)",(lo,hi,pos,nxt))
+                        c.execute(f"INSERT OR IGNORE INTO arcw.messages({cols}) SELECT {cols} FROM main.messages WHERE {rng}",
+                                  (lo,hi,pos,nxt))
+                        self._commit()
+                    finally:
+                        if c.in_transaction: c.rollback()
+                pos=nxt; time.sleep(0)
+            # 削除：アーカイブに写っている行だけ。目印を置いて質問を消しても回答の question_id は外さない
+            pos=0
+            while True:
+                with self._lock:
+                    try:
+                        nxt=c.execute("SELECT MAX(id) FROM (SELECT id FROM main.messages WHERE detected_at>=? AND detected_at<?"
+                                      " AND id>? ORDER BY id LIMIT ?)",(lo,hi,pos,self.ARCHIVE_CHUNK)).fetchone()[0]
+                        if nxt is None: break
+                        c.execute("INSERT OR REPLACE INTO main.settings(key,value,updated_at) VALUES(?,?,?)",
+                                  (self.ARCHIVING_KEY,mon,datetime.now().isoformat()))
+                        n+=c.execute(f"DELETE FROM main.messages WHERE {rng} AND id IN (SELECT id FROM arcw.messages)",
+                                     (lo,hi,pos,nxt)).rowcount
+                        c.execute("DELETE FROM main.settings WHERE key=?",(self.ARCHIVING_KEY,))
+                        self._commit()
+                    finally:
+                        if c.in_transaction: c.rollback()
+                pos=nxt; time.sleep(0)
+            with self._lock:
+                c.execute("DELETE FROM main.sessions WHERE updated_at<?"
+                          " AND id NOT IN (SELECT session_id FROM main.messages)",(hi,))
+                self._commit()
+        finally:
+            with self._lock:
+                if c.in_transaction: c.rollback()
+                c.execute("DETACH DATABASE arcw")
+        return n
+
+    def _init_archive_schema(self, sch:str):
+        """アーカイブDBの表（ホットと同じ列・生成列・索引、FTS は展開ビュー経由）"""
+        gen=",".join(f"\n                {col} GENERATED ALWAYS AS (json_extract(metadata,'{path}')) VIRTUAL"
+                     for col,path in self.META_COLUMNS)
+        fts=(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {sch}.messages_fts USING fts5(
+                content, content='messages_text', content_rowid='id', tokenize='trigram'
+            );""" if self._has_fts else "")
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {sch}.sessions (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS {sch}.messages (
+                id           INTEGER PRIMARY KEY,
+                session_id   INTEGER NOT NULL,
+                ts           TEXT DEFAULT '',
+                role         TEXT NOT NULL,
+                service      TEXT NOT NULL,
+                content      TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                detected_at  TEXT NOT NULL,
+                metadata     TEXT NOT NULL DEFAULT '{{}}',
+                preview      TEXT NOT NULL DEFAULT '',
+                question_id  INTEGER,
+                rev          INTEGER NOT NULL DEFAULT 0,{gen}
+            );
+            CREATE INDEX IF NOT EXISTS {sch}.idx_arc_detected ON messages(detected_at);
+            CREATE INDEX IF NOT EXISTS {sch}.idx_arc_service  ON messages(service,detected_at);
+            CREATE INDEX IF NOT EXISTS {sch}.idx_arc_label    ON messages(label);
+            CREATE INDEX IF NOT EXISTS {sch}.idx_arc_source   ON messages(source);
+            CREATE INDEX IF NOT EXISTS {sch}.idx_arc_model    ON messages(model);
+            CREATE VIEW IF NOT EXISTS {sch}.messages_text AS
+                SELECT id, cr_unpack(content) AS content FROM messages;
+            {fts}
+        """)
+        # 以前の版で作ったアーカイブには question_id・rev がない → 列を足す
+        ex=[r[1] for r in self._conn.execute(f"PRAGMA {sch}.table_info(messages)").fetchall()]
+        for col,typ in (("question_id","INTEGER"),("rev","INTEGER NOT NULL DEFAULT 0")):
+            if col not in ex: self._conn.execute(f"ALTER TABLE {sch}.messages ADD COLUMN {col} {typ}")
+
+    def _archive_months(self, query:str) -> list:
+        """
+        query の date 条件（date= / date>= など）にかかるアーカイブ月。なければ空（ホットだけ検索）。
+        期間に解釈できる値は重なる月だけ、解釈できない値（部分一致）は全アーカイブ。否定は対象外。
+        """
+        if not self._archives: return []
+        hit=set()
+        for token in query.split():
+            r=self._date_token(token)
+            if not r or r[0]!="date" or r[1]: continue
+            if r[2] is None: hit|=set(self._archives); continue
+            pad=lambda x:x+"0000-01-01T00:00:00"[len(x):]   # 長さの違う日付文字列をそろえて比較
+            for lo,hi in r[2]:
+                for mon in self._archives:
+                    y,m=int(mon[:4]),int(mon[5:7])
+                    if (hi is None or pad(mon)<pad(hi)) and (lo is None or pad(f"{y+m//12:04d}-{m%12+1:02d}")>pad(lo)):
+                        hit.add(mon)
+        return sorted(hit,reverse=True)
+
+    def _schemas_for(self, query:str, all_archives:bool=False):
+        """
+        検索対象のスキーマ名を順に返す（アーカイブは必要になった時点で ATTACH）。
+        all_archives=True なら date 条件がないとき全アーカイブを対象にする（エクスポート用）。
+        """
+        yield "main"
+        dated=any((r:=self._date_token(t)) and r[0]=="date" and not r[1] for t in query.split())
+        months=self._archive_months(query) if dated or not all_archives else sorted(self._archives,reverse=True)
+        for mon in months:
+            sch=self._attach(mon)
+            if sch: yield sch
+
+    def _attach(self, mon:str) -> Optional[str]:
+        """呼び出しスレッドの読み取り接続にアーカイブを読み取り専用で ATTACH（LRU で上限管理）"""
+        if not self._wal: return None
+        c=self._reader()
+        att=getattr(self._local,"attached",None)
+        if att is None: att=self._local.attached=OrderedDict()
+        sch="arc_"+mon.replace("-","")
+        if sch in att:
+            att.move_to_end(sch); return sch
+        while len(att)>=self.MAX_ATTACH:
+            old,_=att.popitem(last=False); c.execute(f"DETACH DATABASE {old}")
+        uri=Path(self._archives[mon]).resolve().as_uri()+"?mode=ro"
+        try: c.execute(f"ATTACH DATABASE ? AS {sch}",(uri,))
+        except sqlite3.Error as e:
+            print(f"[DEBUG] archive attach failed {mon}: {e}", flush=True); return None
+        att[sch]=mon; return sch
+
+    # ── 件数カウンタ（get_stats 用）───────────────────────────────────
+    # key: total / questions / unknown（ラベルなし Unknown）/ svc:<サービス名>（質問行を除く）
+    _COUNTER_ROWS = """
+        ('total',{s}1),
+        ('questions',{s}({r}.label IS 'question')),
+        ('unknown',{s}({r}.service='Unknown' AND IFNULL({r}.label,'')='')),
+        ('svc:'||{r}.service,{s}({r}.label IS NOT 'question'))
+    """
+
+    def _mig_counters(self, c):
+        """
+        message_counters をトリガーで増減させ、get_stats を全件走査なしで返す。
+        新規作成時（既存DBへの追加を含む）は初期値を集計。
+        """
+        add=self._COUNTER_ROWS.format(s="",r="new"); sub=self._COUNTER_ROWS.format(s="-",r="old")
+        upsert="ON CONFLICT(key) DO UPDATE SET n=n+excluded.n"
+        self._script(c,f"""
+            CREATE TABLE IF NOT EXISTS message_counters (
+                key TEXT PRIMARY KEY,
+                n   INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_cnt_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO message_counters(key,n) VALUES {add} {upsert};
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_cnt_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO message_counters(key,n) VALUES {sub} {upsert};
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_cnt_au AFTER UPDATE OF service,metadata ON messages BEGIN
+                INSERT INTO message_counters(key,n) VALUES {sub} {upsert};
+                INSERT INTO message_counters(key,n) VALUES {add} {upsert};
+            END;
         """)
-        c.commit()
-        self._init_ai_services()
+        if not c.execute("SELECT 1 FROM message_counters WHERE key='total'").fetchone():
+            self._count_all(c)
+
+    def rebuild_counters(self):
+        """カウンタを messages から集計し直す（修復用）"""
+        t=time.time()
+        with self._lock:
+            self._count_all(self._conn); self._commit()
+        self._invalidate_queries()
+        print(f"[DEBUG] counters rebuilt {time.time()-t:.2f}s", flush=True)
 
-    def _init_ai_services(self):
+    @staticmethod
+    def _count_all(c):
+        c.execute("DELETE FROM message_counters")
+        c.execute("INSERT INTO message_counters(key,n) SELECT 'total',COUNT(*) FROM messages")
+        c.execute("INSERT INTO message_counters(key,n) SELECT 'questions',COUNT(*) FROM messages WHERE label='question'")
+        c.execute("INSERT INTO message_counters(key,n) SELECT 'unknown',COUNT(*) FROM messages"
+                  " WHERE service='Unknown' AND (label IS NULL OR label='')")
+        c.execute("INSERT INTO message_counters(key,n) SELECT 'svc:'||service,COUNT(*) FROM messages"
+                  " WHERE label IS NOT 'question' GROUP BY service")
+
+    # ── 全文検索（FTS5 trigram）──────────────────────────────────────
+    FTS_CHUNK = 2000   # バックフィル1回あたりの行数
+
+    def _mig_fts(self, c):
+        """
+        messages_fts（外部コンテンツ FTS5・trigram）と同期トリガーを作成。
+        trigram なので日本語の部分文字列も一致する（3文字以上）。
+        既存行は fts_state の pos→upto をバックグラウンドで少しずつ索引化し、
+        未索引範囲の行はトリガーの delete 対象から外して索引の破損を防ぐ。
+        """
+        old=c.execute("SELECT sql FROM sqlite_master WHERE name='messages_fts'").fetchone()
+        if old and "messages_text" not in old[0]:
+            # 旧形式（messages を直接参照）→ 圧縮本文を読めないので作り直して再索引
+            print("[DEBUG] FTS rebuild over messages_text", flush=True)
+            self._script(c,"""
+                DROP TRIGGER IF EXISTS messages_fts_ai;
+                DROP TRIGGER IF EXISTS messages_fts_ad;
+                DROP TRIGGER IF EXISTS messages_fts_au;
+                DROP TABLE IF EXISTS messages_fts;
+                DELETE FROM fts_state;
+            """)
+        c.execute("SAVEPOINT fts")
+        try:
+            self._script(c,"""
+                -- 圧縮本文を展開して見せるビュー（FTS の外部コンテンツ・snippet 用）
+                CREATE VIEW IF NOT EXISTS messages_text AS
+                    SELECT id, cr_unpack(content) AS content FROM messages;
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content, content='messages_text', content_rowid='id', tokenize='trigram'
+                );
+                CREATE TABLE IF NOT EXISTS fts_state (
+                    id   INTEGER PRIMARY KEY CHECK (id=1),
+                    pos  INTEGER NOT NULL,
+                    upto INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO fts_state(id,pos,upto)
+                    SELECT 1,0,IFNULL(MAX(id),0) FROM messages;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid,content) VALUES(new.id,cr_unpack(new.content));
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+                WHEN old.id<=(SELECT pos FROM fts_state) OR old.id>(SELECT upto FROM fts_state) BEGIN
+                    INSERT INTO messages_fts(messages_fts,rowid,content) VALUES('delete',old.id,cr_unpack(old.content));
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages
+                WHEN old.id<=(SELECT pos FROM fts_state) OR old.id>(SELECT upto FROM fts_state) BEGIN
+                    INSERT INTO messages_fts(messages_fts,rowid,content) VALUES('delete',old.id,cr_unpack(old.content));
+                    INSERT INTO messages_fts(rowid,content) VALUES(new.id,cr_unpack(new.content));
+                END;
+            """)
+        except sqlite3.OperationalError as e:
+            # FTS5 / trigram 非対応の SQLite → LIKE 検索のまま
+            c.execute("ROLLBACK TO fts")
+            print(f"[DEBUG] FTS5 unavailable: {e}", flush=True)
+        c.execute("RELEASE fts")
+
+    def _mig_fts_queue(self, c):
+        """
+        FTS 同期トリガーを SQL だけで動くものに作り直す（sqlite3 コマンド等、アプリ外のツールでも messages を変更できる）。
+        トリガーは圧縮されたままの本文を fts_queue に積むだけで、索引への反映は _fts_sync が
+        同じトランザクションの commit 直前に Python 側で展開して行う（アプリ外の変更は次回起動時に反映）。
+        messages_text ビュー（snippet・rebuild 用）は引き続き cr_unpack を使うので、読めるのはアプリ経由のみ。
+        """
+        if not c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone(): return
+        self._script(c,"""
+            CREATE TABLE IF NOT EXISTS fts_queue (
+                seq     INTEGER PRIMARY KEY,
+                id      INTEGER NOT NULL,
+                op      TEXT NOT NULL,    -- I=索引に追加 / D=索引から削除
+                content                   -- 圧縮されたままの本文
+            );
+            DROP TRIGGER IF EXISTS messages_fts_ai;
+            DROP TRIGGER IF EXISTS messages_fts_ad;
+            DROP TRIGGER IF EXISTS messages_fts_au;
+            CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO fts_queue(id,op,content) VALUES(new.id,'I',new.content);
+            END;
+            CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages
+            WHEN old.id<=(SELECT pos FROM fts_state) OR old.id>(SELECT upto FROM fts_state) BEGIN
+                INSERT INTO fts_queue(id,op,content) VALUES(old.id,'D',old.content);
+            END;
+            CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages
+            WHEN old.id<=(SELECT pos FROM fts_state) OR old.id>(SELECT upto FROM fts_state) BEGIN
+                INSERT INTO fts_queue(id,op,content) VALUES(old.id,'D',old.content);
+                INSERT INTO fts_queue(id,op,content) VALUES(new.id,'I',new.content);
+            END;
+        """)
+
+    def _fts_sync(self, c:sqlite3.Connection=None) -> int:
+        """fts_queue を順に索引へ反映して空にする（書き込みロック内・commit の直前に呼ぶ）"""
+        c=c or self._conn
+        if not c.execute("SELECT 1 FROM sqlite_master WHERE name='fts_queue'").fetchone(): return 0
+        last=0; n=0
+        for seq,mid,op,blob in c.execute("SELECT seq,id,op,content FROM fts_queue ORDER BY seq").fetchall():
+            if op=="D": c.execute("INSERT INTO messages_fts(messages_fts,rowid,content) VALUES('delete',?,?)",(mid,self._unpack(blob)))
+            else:       c.execute("INSERT INTO messages_fts(rowid,content) VALUES(?,?)",(mid,self._unpack(blob)))
+            last=seq; n+=1
+        if n: c.execute("DELETE FROM fts_queue WHERE seq<=?",(last,))
+        return n
+
+    def _commit(self):
+        """FTS の保留分を反映してから commit（messages を変更する書き込みは必ずこれで確定する）"""
+        self._fts_sync(self._conn); self._conn.commit()
+
+    def _start_fts(self):
+        """索引の有無を確認し、未索引の範囲が残っていればバックフィルを再開"""
+        self._has_fts=bool(self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone())
+        self._fts_ready=False
+        if not self._has_fts: return
+        with self._lock:
+            n=self._fts_sync(self._conn); self._conn.commit()   # アプリ外で変更された分
+        if n: print(f"[DEBUG] FTS synced {n} queued changes", flush=True)
+        pos,upto=self._conn.execute("SELECT pos,upto FROM fts_state").fetchone()
+        if pos>=upto:
+            self._fts_ready=True
+        else:
+            print(f"[DEBUG] FTS backfill start: {upto-pos} ids", flush=True)
+            threading.Thread(target=self._fts_backfill,daemon=True).start()
+
+    def _fts_backfill(self):
+        """既存行をチャンク単位で索引化（各チャンクは短いトランザクション）"""
+        try:
+            while True:
+                with self._lock:
+                    pos,upto=self._conn.execute("SELECT pos,upto FROM fts_state").fetchone()
+                    if pos>=upto: break
+                    nxt=self._conn.execute(
+                        "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id>? AND id<=? ORDER BY id LIMIT ?)",
+                        (pos,upto,self.FTS_CHUNK)
+                    ).fetchone()[0] or upto
+                    self._conn.execute(
+                        "INSERT INTO messages_fts(rowid,content) SELECT id,cr_unpack(content) FROM messages WHERE id>? AND id<=?",
+                        (pos,nxt)
+                    )
+                    self._conn.execute("UPDATE fts_state SET pos=?",(nxt,))
+                    self._commit()
+                time.sleep(0.01)   # UI・ワーカーの書き込みに譲る
+            self._fts_ready=True
+            print("[DEBUG] FTS backfill done", flush=True)
+        except Exception as e:
+            print(f"[DEBUG] FTS backfill error: {e}", flush=True)
+
+    # ── 埋め込みベクトル（意味検索用）──────────────────────────────────
+    EMBED_MAX_CHARS = 2000   # 埋め込みに渡す本文の先頭文字数
+
+    def _mig_embeddings(self, c):
+        """
+        embeddings: メッセージ1件につき1ベクトル（float32 の BLOB）。
+        本文が消えた・変わった行のベクトルはトリガーで削除し、次の埋め込みで作り直す。
+        seq は追加順の通し番号（再利用しない）。VectorIndex は seq で追記分を判定する。
+        """
+        self._script(c,"""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                seq   INTEGER PRIMARY KEY AUTOINCREMENT,
+                id    INTEGER NOT NULL UNIQUE,   -- messages.id
+                model TEXT NOT NULL,
+                dim   INTEGER NOT NULL,
+                vec   BLOB NOT NULL          -- float32 × dim
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_emb_ad AFTER DELETE ON messages BEGIN
+                DELETE FROM embeddings WHERE id=old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_emb_au AFTER UPDATE OF content ON messages BEGIN
+                DELETE FROM embeddings WHERE id=old.id;
+            END;
+        """)
+
+    def pending_embeddings(self, after:int=0, limit:int=32) -> list:
+        """ベクトル未作成のメッセージ [(id,本文先頭)] を id 順に（after より後ろだけ）"""
+        return [tuple(r) for r in self._reader().execute(
+            "SELECT m.id,substr(cr_unpack(m.content),1,?) FROM messages m"
+            " WHERE m.id>? AND NOT EXISTS(SELECT 1 FROM embeddings e WHERE e.id=m.id)"
+            " ORDER BY m.id LIMIT ?",(self.EMBED_MAX_CHARS,after,limit)).fetchall()]
+
+    def save_embeddings(self, model:str, rows:list) -> int:
+        """[(id, float32 の bytes)] を保存。処理中に削除された行の分は捨てる"""
+        return self._submit(self._insert_embeddings,model,rows).result()
+
+    def _insert_embeddings(self, model:str, rows:list) -> int:
+        n=0
+        for mid,blob in rows:
+            n+=self._conn.execute(
+                "REPLACE INTO embeddings(id,model,dim,vec)"
+                " SELECT ?,?,?,? WHERE EXISTS(SELECT 1 FROM messages WHERE id=?)",
+                (mid,model,len(blob)//4,blob,mid)).rowcount
+        return n
+
+    def clear_embeddings(self, keep_model:str=None) -> int:
+        """keep_model 以外（None なら全部）のベクトルを削除（埋め込みモデル変更時）"""
+        with self._lock:
+            n=self._conn.execute("DELETE FROM embeddings WHERE model IS NOT ?",(keep_model,)).rowcount
+            self._commit()
+        return n
+
+    def embedding_state(self) -> tuple:
+        """(件数, 最大seq)。VectorIndex が作り直し・追記の要否を判定するのに使う"""
+        return tuple(self._reader().execute("SELECT COUNT(*),IFNULL(MAX(seq),0) FROM embeddings").fetchone())
+
+    def iter_embeddings(self, after:int=0, chunk:int=1000):
+        """seq が after より後ろの (seq, id, vec) を追加順に chunk 件ずつ読み出すジェネレータ"""
+        while True:
+            rows=self._reader().execute("SELECT seq,id,vec FROM embeddings WHERE seq>? ORDER BY seq LIMIT ?",
+                                        (after,chunk)).fetchall()
+            if not rows: return
+            for r in rows: yield tuple(r)
+            after=rows[-1][0]
+
+    # ── 近似重複（SimHash＋LSH バンド）──────────────────────────────────
+    # 空白・表罫線・記号を除いた本文の4文字シングルから64bit SimHash を作り、
+    # 16bit×4 バンドを索引付き列に保存。距離3以下なら鳩の巣原理でどれかのバンドが一致するので、
+    # 候補はバンドの索引検索だけで集まる（全件比較しない）。
+    SIMHASH_MIN  = 64   # 正規化後この文字数未満の短文は対象外（SimHash が安定しない）
+    SIMHASH_DIST = 3    # ハミング距離がこれ以下なら近似重複
+    _SIM_STRIP = re.compile(r"[\s|\-*#>`_:=+]+")
+
+    def _mig_simhash(self, c):
+        self._script(c,"""
+            CREATE TABLE IF NOT EXISTS simhash (
+                id INTEGER PRIMARY KEY,   -- messages.id
+                b0 INTEGER NOT NULL, b1 INTEGER NOT NULL,
+                b2 INTEGER NOT NULL, b3 INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sim_b0 ON simhash(b0);
+            CREATE INDEX IF NOT EXISTS idx_sim_b1 ON simhash(b1);
+            CREATE INDEX IF NOT EXISTS idx_sim_b2 ON simhash(b2);
+            CREATE INDEX IF NOT EXISTS idx_sim_b3 ON simhash(b3);
+            CREATE TRIGGER IF NOT EXISTS messages_sim_ad AFTER DELETE ON messages BEGIN
+                DELETE FROM simhash WHERE id=old.id;
+            END;
+        """)
+
+    @classmethod
+    def simhash(cls, text:str) -> Optional[int]:
+        """64bit SimHash（短すぎる本文は None）。末尾の空白・表の罫線・選択範囲の多少の欠けでは数bitしか変わらない"""
+        t=cls._SIM_STRIP.sub("",text or "").lower()
+        if len(t)<cls.SIMHASH_MIN: return None
+        crc=zlib.crc32
+        hs=[crc(b)<<32|crc(b,0x9E3779B9) for b in map(str.encode,{t[i:i+4] for i in range(len(t)-3)})]
+        # ビット位置ごとに 1 の多数決。64bit 値をバイト列に並べ、バイト位置ごとの値の出現数を C 側で数えてから
+        # 立っているビットに足し込む（1件ごとに64回の加算や文字列化をしない）
+        raw=array("Q",hs).tobytes(); cnt=[0]*64
+        for k in range(8):
+            base=8*(k if sys.byteorder=="little" else 7-k)
+            for v,c in Counter(raw[k::8]).items():
+                while v: low=v&-v; cnt[base+low.bit_length()-1]+=c; v^=low
+        half=len(hs)/2
+        return sum(1<<i for i,c in enumerate(cnt) if c>half)
+
+    @staticmethod
+    def _bands(h:int) -> list:
+        return [(h>>(16*i))&0xFFFF for i in range(4)]
+
+    @staticmethod
+    def _unband(b:tuple) -> int:
+        return b[0]|b[1]<<16|b[2]<<32|b[3]<<48
+
+    def _insert_simhash(self, mid:int, h:Optional[int]):
+        # 短文（h=None）も -1 で記録して「計算済み・対象外」とする（バンド検索には掛からない）
+        self._conn.execute("INSERT OR REPLACE INTO simhash(id,b0,b1,b2,b3) VALUES(?,?,?,?,?)",
+                           [mid]+(self._bands(h) if h is not None else [-1]*4))
+
+    def find_near_duplicate(self, content:str, service:str=None, h:int=None) -> Optional[int]:
+        """content に最も近い既存行の id（距離 SIMHASH_DIST 以下・service 指定時は同じサービスのみ）"""
+        h=self.simhash(content) if h is None else h
+        if h is None: return None
+        b=self._bands(h)
+        sql=("SELECT s.id,s.b0,s.b1,s.b2,s.b3 FROM simhash s JOIN messages m ON m.id=s.id"
+             " WHERE (s.b0=? OR s.b1=? OR s.b2=? OR s.b3=?)")
+        args=list(b)
+        if service: sql+=" AND +m.service=?"; args.append(service)   # + でサービス索引を使わせず、バンド索引から引く
+        best=None
+        for r in self._reader().execute(sql,args):
+            d=bin(h^self._unband(tuple(r)[1:])).count("1")
+            if d<=self.SIMHASH_DIST and (best is None or d<best[0]): best=(d,r[0])
+        return best[1] if best else None
+
+    def merge_near_duplicate(self, msg_id:int, content:str, ts:str=None, question_id:int=None,
+                             h:int=None) -> Optional[bool]:
+        """
+        近似重複の取り込み：新しい本文のほうが長ければ既存行の本文を差し替える（欠けた選択範囲の取り直し）。
+        差し替えたら True。短い・同じなら何もしない（従来の重複と同じ扱い）で False。
+        新しい取り込みにシグネチャ（ts）や質問の紐付けがあり、既存行と違う場合は別の回答なので
+        まとめずに None を返す（呼び出し側で別行として保存する）。h は計算済みの SimHash（省略時は計算）。
+        """
+        row=self._reader().execute("SELECT ts,question_id FROM messages WHERE id=?",(msg_id,)).fetchone()
+        if not row: return None
+        if (ts and row["ts"]!=ts) or (question_id is not None and row["question_id"]!=question_id): return None
+        old=self.get_message_content(msg_id)
+        if len(content)<=len(old): return False
+        with self._lock:
+            row=self._conn.execute("SELECT service,ts,label FROM messages WHERE id=?",(msg_id,)).fetchone()
+            if not row: return None
+            ch=self.question_hash(row["ts"] or "",content) if row["label"]=="question" else self.message_hash(row["service"],content)
+            n=self._conn.execute(
+                "UPDATE OR IGNORE messages SET content=?,preview=?,content_hash=? WHERE id=?",
+                (self._pack(content),content[:self.PREVIEW_LEN],ch,msg_id)).rowcount
+            if n: self._insert_simhash(msg_id,self.simhash(content) if h is None else h)
+            self._commit()
+        return bool(n)
+
+    def backfill_simhash(self, chunk:int=500) -> int:
+        """SimHash 未計算の既存行を chunk 件ずつ埋める（近似重複の一括検出の前処理）"""
+        done=0; after=0
+        while True:
+            rows=self._reader().execute(
+                "SELECT m.id,cr_unpack(m.content) FROM messages m WHERE m.id>?"
+                " AND NOT EXISTS(SELECT 1 FROM simhash s WHERE s.id=m.id) ORDER BY m.id LIMIT ?",(after,chunk)).fetchall()
+            if not rows: return done
+            hs=[(mid,self.simhash(content)) for mid,content in rows]
+            with self._lock:
+                for mid,h in hs: self._insert_simhash(mid,h)
+                self._commit()
+            done+=len(rows); after=rows[-1][0]
+
+    def near_duplicate_clusters(self) -> list:
+        """
+        既存DB全体の近似重複クラスタ [[id,…],…]（各クラスタは id 昇順＝先頭が最古）。
+        バンドごとに同じ値の行だけを突き合わせ、同じサービス内で距離 SIMHASH_DIST 以下を union-find でまとめる。
+        """
+        t=time.time(); self.backfill_simhash()
+        rows=self._reader().execute(
+            "SELECT s.id,s.b0,s.b1,s.b2,s.b3,m.service FROM simhash s JOIN messages m ON m.id=s.id"
+            " WHERE s.b0>=0").fetchall()
+        sig={r[0]:(self._unband(tuple(r)[1:5]),r[5]) for r in rows}
+        parent={}
+        def find(x):
+            while parent.get(x,x)!=x: x=parent[x]
+            return x
+        for band in range(4):
+            buckets={}
+            for r in rows: buckets.setdefault((r[1+band],r[5]),[]).append(r[0])
+            for ids in buckets.values():
+                if len(ids)<2: continue
+                for i,a in enumerate(ids):
+                    for b in ids[i+1:]:
+                        if bin(sig[a][0]^sig[b][0]).count("1")<=self.SIMHASH_DIST:
+                            ra,rb=find(a),find(b)
+                            if ra!=rb: parent[max(ra,rb)]=min(ra,rb)
+        groups={}
+        for x in parent: groups.setdefault(find(x),set()).update((x,find(x)))
+        out=sorted(sorted(g) for g in groups.values())
+        print(f"[DEBUG] near-dup clusters={len(out)} rows={len(rows)} {time.time()-t:.2f}s", flush=True)
+        return out
+
+    def reset(self, full:bool=False):
+        """
+        全メッセージ・セッションを削除する（SETTINGS の初期化）。
+        full=True なら settings・ai_services も消して既定の AI サービスを入れ直す。
+        ai_services は変更フィードに出ないので、本文・検索結果のキャッシュはここでまとめて捨てる。
+        """
+        with self._lock:
+            c=self._conn
+            c.execute("DELETE FROM messages"); c.execute("DELETE FROM sessions")
+            if full:
+                c.execute("DELETE FROM settings"); c.execute("DELETE FROM ai_services")
+                self._mig_ai_services(c)
+            self._commit()
+        with self._cache_lock: self._content_cache.clear()
+        self._invalidate_queries()
+
+    def _mig_ai_services(self, c):
         now=datetime.now().isoformat()
-        for name,cfg in DEFAULT_AI_SERVICES.items():
-            if not self._conn.execute(
-                "SELECT name FROM ai_services WHERE name=?",(name,)
-            ).fetchone():
-                self._conn.execute(
-                    "INSERT INTO ai_services(name,config,updated_at) VALUES(?,?,?)",
-                    (name,json.dumps(cfg,ensure_ascii=False),now)
-                )
-        self._conn.commit()
+        c.executemany(
+            "INSERT OR IGNORE INTO ai_services(name,config,updated_at) VALUES(?,?,?)",
+            [(name,json.dumps(cfg,ensure_ascii=False),now) for name,cfg in DEFAULT_AI_SERVICES.items()]
+        )
+
+    # ── グループコミット（書き込み後回しキュー）──────────────────────────
+    GROUP_MAX_ROWS = 64     # 1コミットにまとめる最大行数
+    GROUP_MAX_WAIT = 0.05   # 先頭の行が来てからコミットまで待つ最大秒数
+
+    def start_writer(self):
+        """
+        バックグラウンド書き込みスレッドを開始。
+        以後 save_message / save_question はキューに積まれ、
+        最大 GROUP_MAX_ROWS 行 / GROUP_MAX_WAIT 秒ごとに1回の commit（=1回の fsync）で確定する。
+        """
+        if self._writer and self._writer.is_alive(): return
+        self._wq=queue.Queue()
+        self._writer=threading.Thread(target=self._writer_loop,daemon=True)
+        self._writer.start()
+
+    def stop_writer(self):
+        """キューに残った行を確定してから書き込みスレッドを止める"""
+        if not (self._writer and self._writer.is_alive()): return
+        self._wq.put(None); self._writer.join()
+        self._writer=None
+
+    def flush(self):
+        """キュー済みの行がすべて commit されるまで待つ"""
+        if not (self._writer and self._writer.is_alive()): return
+        f=Future(); self._wq.put((f,None,())); f.result()
+
+    def _writer_loop(self):
+        stop=False
+        while not stop:
+            item=self._wq.get()
+            if item is None: break
+            batch=[item]; deadline=time.monotonic()+self.GROUP_MAX_WAIT
+            while len(batch)<self.GROUP_MAX_ROWS:
+                wait=deadline-time.monotonic()
+                try: item=self._wq.get(timeout=wait) if wait>0 else self._wq.get_nowait()
+                except queue.Empty: break
+                if item is None: stop=True; break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch:list):
+        done=[]; t=time.perf_counter()
+        with self._lock:
+            metrics.observe("db.lock_wait",(time.perf_counter()-t)*1e3); t=time.perf_counter()
+            for fut,fn,args in batch:
+                if fn is None: done.append((fut,None)); continue   # flush 用の目印
+                try: done.append((fut,fn(*args)))
+                except Exception as e: fut.set_exception(e)
+            try:
+                self._commit()
+            except Exception as e:
+                if self._conn.in_transaction: self._conn.rollback()
+                print(f"[DEBUG] group commit error: {e}", flush=True)
+                metrics.inc("db.commit_errors")
+                for fut,_ in done: fut.set_exception(e)
+                return
+            metrics.observe("db.commit",(time.perf_counter()-t)*1e3); metrics.inc("db.rows",len(batch))
+        for fut,res in done: fut.set_result(res)
+        if len(batch)>1: print(f"[DEBUG] group commit rows={len(batch)}", flush=True)
+
+    def _submit(self, fn:Callable, *args) -> Future:
+        """fn(*args) を書き込みスレッドで実行（未起動ならその場で実行・commit）"""
+        if self._writer and self._writer.is_alive():
+            f=Future(); self._wq.put((f,fn,args)); return f
+        f=Future(); t=time.perf_counter()
+        with self._lock:
+            metrics.observe("db.lock_wait",(time.perf_counter()-t)*1e3); t=time.perf_counter()
+            try:
+                res=fn(*args); self._commit()
+            except Exception as e:
+                if self._conn.in_transaction: self._conn.rollback()
+                metrics.inc("db.commit_errors"); f.set_exception(e); return f
+            metrics.observe("db.commit",(time.perf_counter()-t)*1e3); metrics.inc("db.rows")
+        f.set_result(res); return f
 
     # ── Questions ─────────────────────────────────────────────────────
     # ── Questions（messagesテーブルに統合）──────────────────────────────
     def save_question(self, session_id:int, ts:str, content:str,
                       framework="",viewpoint="",output_fmt="") -> int:
         """質問をmessagesテーブルにlabel=questionで保存"""
+        return self.save_question_async(session_id,ts,content,framework,viewpoint,output_fmt).result()
+
+    def save_question_async(self, session_id:int, ts:str, content:str,
+                            framework="",viewpoint="",output_fmt="") -> Future:
+        """save_question のキュー版。Future は行id（重複時は既存行のid）を返す"""
         now=datetime.now().isoformat()
         meta=json.dumps({"label":"question","fw":framework,"vp":viewpoint,
                          "fmt":output_fmt},ensure_ascii=False)
-        h=hashlib.md5(f"Q:{ts}:{content[:80]}".encode()).hexdigest()
-        with self._lock:
-            if self._conn.execute("SELECT id FROM messages WHERE content_hash=?",(h,)).fetchone():
-                row=self._conn.execute("SELECT id FROM messages WHERE content_hash=?",(h,)).fetchone()
-                return row[0]
-            cur=self._conn.execute(
-                "INSERT INTO messages(session_id,ts,role,service,content,content_hash,detected_at,metadata)"
-                " VALUES(?,?,?,?,?,?,?,?)",
-                (session_id,ts,"user","User",content,h,now,meta)
-            )
-            self._conn.commit()
-        return cur.lastrowid
+        h=self.question_hash(ts,content)
+        return self._submit(self._insert_question,(session_id,ts,"user","User",self._pack(content),h,now,meta,
+                                                   content[:self.PREVIEW_LEN]))
+
+    def _insert_question(self, row:tuple) -> int:
+        new=self._conn.execute(
+            "INSERT INTO messages(session_id,ts,role,service,content,content_hash,detected_at,metadata,preview)"
+            " VALUES(?,?,?,?,?,?,?,?,?) ON CONFLICT(content_hash) DO NOTHING RETURNING id",row
+        ).fetchone()
+        if new: return new[0]
+        return self._conn.execute("SELECT id FROM messages WHERE content_hash=?",(row[5],)).fetchone()[0]
 
     def find_question(self, ts:str, q_prefix:str) -> Optional[dict]:
         """ts + q_prefix でmessagesテーブルから質問行を突合"""
-        row=self._conn.execute(
-            "SELECT * FROM messages WHERE ts=? AND content LIKE ? AND service='User' LIMIT 1",
+        cols="id,session_id,ts,role,service,cr_unpack(content) AS content,content_hash,detected_at,metadata"
+        row=self._reader().execute(
+            f"SELECT {cols} FROM messages WHERE ts=? AND cr_unpack(content) LIKE ? AND service='User' LIMIT 1",
             (ts, q_prefix+"%")
         ).fetchone()
         if not row:
-            row=self._conn.execute(
-                "SELECT * FROM messages WHERE ts=? AND service='User' LIMIT 1",(ts,)
+            row=self._reader().execute(
+                f"SELECT {cols} FROM messages WHERE ts=? AND service='User' LIMIT 1",(ts,)
             ).fetchone()
         return dict(row) if row else None
 
     # ── Messages ──────────────────────────────────────────────────────
+    @metrics.timed("db.save_message")
     def save_message(self, session_id:int, role:str, service:str,
-                     content:str, metadata:dict=None, ts:str=None) -> bool:
-        # serviceも含めてhash化 → 同内容でもAIが違えば別レコード
-        h=hashlib.md5(f"{service}:{content}".encode()).hexdigest()
+                     content:str, metadata:dict=None, ts:str=None, content_hash:str=None,
+                     question_id:int=None, sim:int=None) -> bool:
+        return self.save_message_async(session_id,role,service,content,metadata,ts,content_hash,question_id,sim).result()
+
+    def save_message_async(self, session_id:int, role:str, service:str,
+                           content:str, metadata:dict=None, ts:str=None,
+                           content_hash:str=None, question_id:int=None, sim:int=None) -> Future:
+        """
+        save_message のキュー版。Future は保存できたか（重複なら False）を返す。
+        content_hash・sim は呼び出し側で message_hash() / simhash() 済みなら渡す（再計算しない）。
+        question_id を省略すると ts が同じ質問行に紐付ける。
+        """
+        h=content_hash or self.message_hash(service,content)
         now=datetime.now().isoformat()
         meta=json.dumps(metadata or {},ensure_ascii=False)
-        with self._lock:
-            if self._conn.execute("SELECT id FROM messages WHERE content_hash=?",(h,)).fetchone():
-                return False
-            self._conn.execute(
-                "INSERT INTO messages(session_id,ts,role,service,"
-                "content,content_hash,detected_at,metadata) VALUES(?,?,?,?,?,?,?,?)",
-                (session_id,ts or "",role,service,content,h,now,meta)
-            )
-            self._conn.commit()
-        return True
+        return self._submit(self._insert_message,(session_id,ts or "",role,service,self._pack(content),h,now,meta,
+                                                  content[:self.PREVIEW_LEN],question_id),
+                            self.simhash(content) if sim is None else sim)
+
+    def _insert_message(self, row:tuple, sim:int=None) -> bool:
+        if row[9] is None and row[1]:
+            q=self._conn.execute("SELECT id FROM messages WHERE ts=? AND label='question' ORDER BY id LIMIT 1",
+                                 (row[1],)).fetchone()
+            if q: row=row[:9]+(q[0],)
+        # 重複は UNIQUE(content_hash) で弾く（事前 SELECT なし）
+        r=self._conn.execute(
+            "INSERT INTO messages(session_id,ts,role,service,"
+            "content,content_hash,detected_at,metadata,preview,question_id) VALUES(?,?,?,?,?,?,?,?,?,?)"
+            " ON CONFLICT(content_hash) DO NOTHING RETURNING id",row
+        ).fetchone()
+        if r: self._insert_simhash(r[0],sim)
+        return r is not None
 
     def set_label(self, msg_id:int, label:Optional[str]):
-        with self._lock:
-            row=self._conn.execute("SELECT metadata FROM messages WHERE id=?",(msg_id,)).fetchone()
-            if not row: return
-            meta=json.loads(row[0] or "{}")
-            if label is None: meta.pop("label",None)
-            else: meta["label"]=label
-            self._conn.execute(
-                "UPDATE messages SET metadata=? WHERE id=?",
-                (json.dumps(meta,ensure_ascii=False),msg_id)
-            )
-            self._conn.commit()
+        self.set_labels([msg_id],label)
 
     def get_messages(self, session_id:int, limit:int=500) -> list:
         sql="""
-            SELECT id,role,service,content,detected_at,metadata,ts,
-                   CASE WHEN json_extract(metadata,'$.label')='question' THEN content ELSE '' END AS question_content
+            SELECT id,role,service,cr_unpack(content) AS content,detected_at,metadata,ts,
+                   CASE WHEN label='question' THEN cr_unpack(content) ELSE '' END AS question_content,rev
             FROM messages
             WHERE session_id=?
             ORDER BY detected_at ASC LIMIT ?
         """
-        return [dict(r) for r in self._conn.execute(sql,(session_id,limit)).fetchall()]
+        return MessageRow.batch(self._tuples(sql,(session_id,limit)))
 
     def get_all_messages(self) -> list:
         """全セッション全件取得"""
         sql="""
-            SELECT id,role,service,content,detected_at,metadata,ts,
-                   CASE WHEN json_extract(metadata,'$.label')='question' THEN content ELSE '' END AS question_content
+            SELECT id,role,service,cr_unpack(content) AS content,detected_at,metadata,ts,
+                   CASE WHEN label='question' THEN cr_unpack(content) ELSE '' END AS question_content,rev
             FROM messages
             ORDER BY detected_at ASC
         """
-        return [dict(r) for r in self._conn.execute(sql).fetchall()]
+        return MessageRow.batch(self._tuples(sql))
+
+    # 一覧用の列（本文は読まず preview だけ。全文は get_message_content で取得）
+    # 表示用の label / source / 時刻もここで作り、行ごとの json.loads・日時変換をなくす
+    # 行は MessageRow で返す（rev は _rev_col(sch) で足す）
+    _PAGE_COLS = """
+        m.id,m.role,m.service,m.preview,m.detected_at,m.ts,
+        IFNULL(m.label,'') AS label, substr(IFNULL(m.source,'cb'),1,3) AS src,
+        strftime('%m/%d %H:%M:%S',m.detected_at) AS t_disp
+    """
+
+    def _from_where(self, query:str, sch:str="main") -> tuple:
+        """検索構文 → (追加列, FROM句, WHERE句, params)。sch はホット(main)かアーカイブのスキーマ名"""
+        fts,where,params=self._compile_search(query,sch)
+        if not fts: return "", f"{sch}.messages m", where, params
+        return (",snippet(messages_fts,0,'【','】','…',24) AS snippet,bm25(messages_fts) AS rank",
+                f"{sch}.messages_fts JOIN {sch}.messages m ON m.id=messages_fts.rowid",
+                f"messages_fts MATCH ? AND {where}", [fts]+params)
+
+    def get_messages_page(self, after:tuple=None, before:tuple=None, limit:int=100,
+                          query:str="", desc:bool=False, ranked:bool=False) -> list:
+        """_get_messages_page の結果をキャッシュ経由で返す（ページ移動・再描画の再実行を省く）"""
+        key=("page",self._query_key(query),after,before,limit,desc,ranked)+self._data_version()
+        return list(self._cached(key,lambda:self._get_messages_page(after,before,limit,query,desc,ranked)))
+
+    @staticmethod
+    def page_key(row) -> tuple:
+        """行 → 次ページのキー（関連度順のページは (rank,id)、それ以外は (detected_at,id)）"""
+        return (row["rank"],row["id"]) if "rank" in row else (row["detected_at"],row["id"])
+
+    def _get_messages_page(self, after:tuple=None, before:tuple=None, limit:int=100,
+                           query:str="", desc:bool=False, ranked:bool=False) -> list:
+        """
+        (detected_at,id) のキーセットで1ページ分だけ取得（VIEWER用）。
+          after  → このキーより後ろ（表示順で次ページ）
+          before → このキーより前（表示順で前ページ）
+          query  → search_messages と同じ検索構文
+          ranked → 本文条件が FTS にかかるときは bm25 の関連度順（キーは (rank,id)、desc は無視）
+        全件を読まないので、ページ移動のコストはページサイズにのみ比例する。キーは page_key() で作る。
+        date= がアーカイブ月にかかる場合は各アーカイブも同じ条件で読み、キー順にマージする
+        （bm25 は索引ごとの統計なので、アーカイブをまたぐ関連度順は近似）。
+        """
+        # before 指定時は逆向きに読んで最後に反転する
+        back=before is not None
+        key=before if back else after
+        rows=[]; nsrc=0; by_rank=False
+        for sch in self._schemas_for(query):
+            nsrc+=1
+            extra,src,where,params=self._from_where(query,sch)
+            by_rank=ranked and bool(extra)
+            rev=back if by_rank else desc!=back
+            order="DESC" if rev else "ASC"
+            if by_rank:
+                # bm25() は外側の WHERE で比較できないので、rank 列を持つ副問い合わせにしてからキーセットで切る
+                sql=f"SELECT * FROM (SELECT {self._PAGE_COLS}{self._rev_col(sch)}{extra} FROM {src} WHERE {where})"
+                if key is not None:
+                    sql+=f" WHERE (rank,id) {'<' if rev else '>'} (?,?)"; params+=list(key)
+                sql+=f" ORDER BY rank {order}, id {order} LIMIT ?"
+            else:
+                if key is not None:
+                    where+=f" AND (m.detected_at,m.id) {'<' if rev else '>'} (?,?)"
+                    params+=list(key)
+                sql=f"""
+                    SELECT {self._PAGE_COLS}{self._rev_col(sch)}{extra} FROM {src}
+                    WHERE {where}
+                    ORDER BY m.detected_at {order}, m.id {order} LIMIT ?
+                """
+            rows+=MessageRow.batch(self._tuples(sql,params+[limit]))
+        if nsrc>1:
+            rows.sort(key=self.page_key,reverse=rev)
+            rows=rows[:limit]
+        if back: rows.reverse()
+        return rows
+
+    def get_messages_by_ids(self, ids:list, query:str="") -> list:
+        """id 指定で取得（変更フィードの差分適用用・ホットDBのみ）。query に一致しない行は返さない"""
+        if not ids: return []
+        extra,src,where,params=self._from_where(query)
+        ph=",".join("?"*len(ids))
+        sql=f"SELECT {self._PAGE_COLS},m.rev{extra} FROM {src} WHERE m.id IN ({ph}) AND {where}"
+        return MessageRow.batch(self._tuples(sql,list(ids)+params))
+
+    def count_messages(self, query:str="") -> int:
+        """get_messages_page と同じ条件の件数（本文は読まない・キャッシュ経由）"""
+        key=("count",self._query_key(query))+self._data_version()
+        return self._cached(key,lambda:self._count_messages(query))
+
+    def _count_messages(self, query:str) -> int:
+        n=0
+        for sch in self._schemas_for(query):
+            _,src,where,params=self._from_where(query,sch)
+            n+=self._reader().execute(f"SELECT COUNT(*) FROM {src} WHERE {where}",params).fetchone()[0]
+        return n
 
     def search_messages(self, query:str, limit:int=200) -> list:
+        """_search_messages の結果をキャッシュ経由で返す（同じ条件・同じデータ版なら辞書を引くだけ）"""
+        key=("search",self._query_key(query),limit)+self._data_version()
+        return list(self._cached(key,lambda:self._search_messages(query,limit)))
+
+    @metrics.timed("db.search")
+    def _search_messages(self, query:str, limit:int=200) -> list:
         """
         項目名参照検索構文（スペース区切りですべてAND結合）:
           service=claude      → SERVICE列がclaudeを含む
@@ -431,113 +1889,511 @@ class ChatDatabase:
           label=!unknown      → LABELがunknownを含まない
           content=python      → 本文にpythonを含む
           content=!error      → 本文にerrorを含まない
+          date=2025-11        → 検出日時が2025年11月（2025 / 2025-11-03 / 2025-11-03T10 も可）
+          date>=2025-11-15    → 期間の比較（>= > <= <）。date=2025-11-01..2025-11-15 で両端を含む範囲
+          date=last7d         → 直近7日（last24h / last2w / today / yesterday）
+          ts=2026-02-18T14:23 → 質問タイムスタンプ（シグネチャの TS）で同様に絞り込み
           python              → 項目名なし → content部分一致（従来互換）
 
         例: service=claude content=python label=!unknown
-        """
-        import re as _re
 
-        # 項目名→SQLカラムのマッピング
-        FIELD_MAP = {
-            "service": "service",
-            "label":   "json_extract(metadata,'$.label')",
-            "content": "content",
-            "src":     "json_extract(metadata,'$.source')",
-            "date":    "detected_at",
-        }
-
-        clauses: list = []
-        params:  list = []
+        本文条件は FTS5 の MATCH 式に変換し、bm25 順で返す（snippet 付き）。
+        本文条件がなければ従来どおり新しい順。
+        date / ts は半開区間の範囲条件（>= ? AND < ?）になり、索引の範囲検索で解決する。
+        date の期間にかかるアーカイブ月も検索する。
+        """
+        rows=[]; nsrc=0; cur=None
+        for sch in self._schemas_for(query):
+            nsrc+=1
+            extra,src,where,params=self._from_where(query,sch)
+            order="rank" if extra else "m.detected_at DESC"
+            sql=f"""
+                SELECT m.id,m.role,m.service,cr_unpack(m.content) AS content,m.detected_at,m.metadata,m.ts,
+                       CASE WHEN m.label='question' THEN cr_unpack(m.content) ELSE '' END AS question_content
+                       {self._rev_col(sch)}{extra}
+                FROM {src}
+                WHERE {where}
+                ORDER BY {order} LIMIT ?
+            """
+            cur=self._tuples(sql,params+[limit]); rows+=cur.fetchall()
+        if not rows: return []
+        cols=MessageRow.columns(cur.description)
+        rank=cols.pop("rank",None)   # 並べ替えにだけ使い、結果の列には出さない
+        if nsrc>1:
+            if rank is not None: rows.sort(key=lambda r:r[rank])
+            else: rows.sort(key=lambda r:r[cols["detected_at"]],reverse=True)
+            rows=rows[:limit]
+        return [MessageRow(cols,r) for r in rows]
+
+    # 項目名→SQLカラムのマッピング（content / service は個別に変換）
+    _FIELD_MAP = {
+        "service": "m.service",
+        "label":   "m.label",
+        "content": "m.content",
+        "src":     "m.source",
+        "model":   "m.model",
+        "date":    "m.detected_at",
+        "ts":      "m.ts",
+    }
+    _INDEXED_FIELDS = ("service","label","src","model")
+    _FIELD_RE = re.compile(r'^(\w+)=(!?)(.+)$')
+    # date / ts は期間（半開区間）に変換して索引の範囲検索にする
+    _RANGE_FIELDS = ("date","ts")
+    _CMP_RE = re.compile(r'^(date|ts)(>=|<=|>|<)(.+)$',re.I)
+    _DATE_RE = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[T ](\d{2})(?::(\d{2})(?::(\d{2}))?)?)?)?)?$')
+    _REL_RE = re.compile(r'^last(\d+)([hdw])$',re.I)
+
+    @classmethod
+    def _date_span(cls, v:str) -> Optional[tuple]:
+        """
+        日付の値 → 半開区間 (lo, hi)。ISO 文字列の大小で比較する（None は片側なし）。
+          2026 / 2026-02 / 2026-02-15 / 2026-02-15T10[:30[:15]] → その年・月・日・時・分・秒
+          today / yesterday / last24h / last7d / last2w       → 相対期間
+          2026-01-15..2026-02-10                            → 両端の日を含む期間（片側省略可）
+        解釈できなければ None。
+        """
+        v=v.strip()
+        if ".." in v:
+            a,b=v.split("..",1)
+            lo=cls._date_span(a) if a else (None,None)
+            hi=cls._date_span(b) if b else (None,None)
+            return (lo[0],hi[1]) if lo and hi else None
+        now=datetime.now()
+        if v.lower() in ("today","yesterday"):
+            d=now.replace(hour=0,minute=0,second=0,microsecond=0)-timedelta(days=v.lower()=="yesterday")
+            return (d.date().isoformat(),(d+timedelta(days=1)).date().isoformat())
+        m=cls._REL_RE.match(v)
+        if m:
+            unit={"h":"hours","d":"days","w":"weeks"}[m[2].lower()]
+            return ((now-timedelta(**{unit:int(m[1])})).isoformat(timespec="seconds"),None)
+        m=cls._DATE_RE.match(v)
+        if not m: return None
+        y=int(m[1])
+        if m[2] is None: return (f"{y:04d}",f"{y+1:04d}")
+        mo=int(m[2])
+        if not 1<=mo<=12: return None
+        if m[3] is None: return (f"{y:04d}-{mo:02d}",f"{y+mo//12:04d}-{mo%12+1:02d}")
+        n=sum(g is not None for g in m.groups()[3:])   # 時・分・秒の指定数
+        try: lo=datetime(y,mo,int(m[3]),*(int(g) for g in m.groups()[3:3+n]))
+        except ValueError: return None
+        step=timedelta(**{("days","hours","minutes","seconds")[n]:1})
+        w=(10,13,16,19)[n]
+        return (lo.isoformat()[:w],(lo+step).isoformat()[:w])
+
+    def _date_token(self, token:str) -> Optional[tuple]:
+        """
+        date / ts のトークン → (項目, 否定か, [(lo,hi), …] or None)。対象外のトークンは None。
+        値が期間に解釈できなければ区間リストは None（従来どおり部分一致で扱う）。
+          date=2026-02,2026-04  date=!2026-02  date>=2026-01-15  date<2026  ts=2026-02-18T14:23
+        """
+        m=self._CMP_RE.match(token)
+        if m:
+            key,op,vals,negate=m.group(1).lower(),m.group(2),[m.group(3)],False
+        else:
+            m=self._FIELD_RE.match(token)
+            if not m or m.group(1).lower() not in self._RANGE_FIELDS: return None
+            key,op,negate=m.group(1).lower(),"=",m.group(2)=="!"
+            vals=[v.strip() for v in m.group(3).split(",") if v.strip()]
+            if not vals: return None
+        spans=[]
+        for v in vals:
+            sp=self._date_span(v)
+            if sp is None: return (key,negate,None) if op=="=" else (key,negate,[("9999",None)])
+            lo,hi=sp
+            spans.append({"=":(lo,hi),">=":(lo,None),">":(hi or "9999",None),
+                          "<":(None,lo),"<=":(None,hi)}[op])
+        return (key,negate,spans)
+    @staticmethod
+    def _fts_quote(v:str) -> str:
+        return '"'+v.replace('"','""')+'"'
 
-        tokens = query.split()
-        for token in tokens:
-            if not token:
+    def _compile_search(self, query:str, sch:str="main") -> tuple:
+        """
+        検索構文 → (FTS MATCH式 or None, WHERE句, params)。
+        本文条件は trigram 索引が使える（3文字以上）ものだけ MATCH に寄せ、
+        2文字以下は LIKE に残す。service は索引付き列の IN 条件に解決する。
+        """
+        use_fts=self._has_fts and self._fts_ready
+        clauses:list=[]; params:list=[]
+        fts_pos:list=[]; fts_neg:list=[]
+
+        def _content(vals, negate):
+            if use_fts and all(len(v)>=3 for v in vals):
+                expr=" OR ".join(self._fts_quote(v) for v in vals)
+                (fts_neg if negate else fts_pos).append(f"({expr})")
+            elif negate:
+                clauses.append("("+" AND ".join("cr_unpack(m.content) NOT LIKE ?" for _ in vals)+")")
+                params.extend(f"%{v}%" for v in vals)
+            else:
+                clauses.append("("+" OR ".join("cr_unpack(m.content) LIKE ?" for _ in vals)+")")
+                params.extend(f"%{v}%" for v in vals)
+
+        for token in query.split():
+            r=self._date_token(token)
+            if r and r[2] is not None:
+                # 期間 → 索引の範囲検索（複数値は OR、否定は NOT）
+                field=self._FIELD_MAP[r[0]]; ors=[]
+                for lo,hi in r[2]:
+                    sub=[]
+                    if lo is not None: sub.append(f"{field}>=?"); params.append(lo)
+                    if hi is not None: sub.append(f"{field}<?"); params.append(hi)
+                    ors.append("("+" AND ".join(sub or ["1"])+")")
+                expr=" OR ".join(ors)
+                clauses.append(f"NOT ({expr})" if r[1] else f"({expr})")
                 continue
-            # 項目名=値 の形式か判定
-            m = _re.match(r'^(\w+)=(!?)(.+)$', token)
-            if m and m.group(1).lower() in FIELD_MAP:
-                field  = FIELD_MAP[m.group(1).lower()]
-                negate = m.group(2) == "!"
-                vals   = [v.strip() for v in m.group(3).split(",") if v.strip()]
+            m=self._FIELD_RE.match(token)
+            if m and m.group(1).lower() in self._FIELD_MAP:
+                key   =m.group(1).lower()
+                negate=m.group(2)=="!"
+                vals  =[v.strip() for v in m.group(3).split(",") if v.strip()]
+                if not vals: continue
+                if key=="content":
+                    _content(vals,negate); continue
+                field=self._FIELD_MAP[key]
+                if key in self._INDEXED_FIELDS:
+                    # 部分一致（大文字小文字無視）→ 実在する値の IN に解決して索引を使う
+                    col=field[2:]
+                    names=self._resolve_values(col,vals,sch)
+                    if names:
+                        ph=",".join("?"*len(names))
+                        if negate:
+                            clauses.append(f"({field} NOT IN ({ph}) OR {field} IS NULL)")
+                        else:
+                            clauses.append(f"{field} IN ({ph})")
+                        params.extend(names)
+                    elif not negate:
+                        clauses.append("0")
+                    continue
                 if negate:
                     # NOT: すべての値を含まない（AND結合）
-                    sub = [f"({field} NOT LIKE ? OR {field} IS NULL)" for _ in vals]
+                    sub=[f"({field} NOT LIKE ? OR {field} IS NULL)" for _ in vals]
                     clauses.append(f"({' AND '.join(sub)})")
-                    params.extend(f"%{v}%" for v in vals)
                 else:
                     # OR: いずれかの値を含む
-                    sub = [f"{field} LIKE ?" for _ in vals]
+                    sub=[f"{field} LIKE ?" for _ in vals]
                     clauses.append(f"({' OR '.join(sub)})")
-                    params.extend(f"%{v}%" for v in vals)
+                params.extend(f"%{v}%" for v in vals)
             else:
                 # 項目名なし → content部分一致（従来互換）
-                if token.startswith("!") and len(token) > 1:
-                    clauses.append("content NOT LIKE ?")
-                    params.append(f"%{token[1:]}%")
-                else:
-                    clauses.append("content LIKE ?")
-                    params.append(f"%{token}%")
+                if token.startswith("!") and len(token)>1: _content([token[1:]],True)
+                else: _content([token],False)
 
-        where = " AND ".join(clauses) if clauses else "1=1"
-        sql = f"""
-            SELECT id,role,service,content,detected_at,metadata,ts,
-                   CASE WHEN json_extract(metadata,'$.label')='question' THEN content ELSE '' END AS question_content
-            FROM messages
-            WHERE {where}
-            ORDER BY detected_at DESC LIMIT ?
+        fts=None
+        if fts_pos:
+            fts=" AND ".join(fts_pos)+"".join(f" NOT {n}" for n in fts_neg)
+        else:
+            # 否定のみ → MATCH した rowid を除外
+            for n in fts_neg:
+                clauses.append(f"m.id NOT IN (SELECT rowid FROM {sch}.messages_fts WHERE messages_fts MATCH ?)")
+                params.append(n)
+        return fts, (" AND ".join(clauses) if clauses else "1=1"), params
+
+    def _resolve_values(self, col:str, vals:list, sch:str="main") -> list:
         """
-        params.append(limit)
-        return [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+        索引付き列の実在値のうち vals を部分一致で含むものを列挙。
+        再帰CTEで索引を飛び飛びに辿るので、コストは行数ではなく値の種類数に比例。
+        """
+        names=[r[0] for r in self._reader().execute(f"""
+            WITH RECURSIVE d(v) AS (
+                SELECT MIN({col}) FROM {sch}.messages
+                UNION ALL
+                SELECT (SELECT MIN({col}) FROM {sch}.messages WHERE {col}>d.v) FROM d WHERE d.v IS NOT NULL
+            ) SELECT v FROM d WHERE v IS NOT NULL
+        """).fetchall()]
+        low=[v.lower() for v in vals]
+        return [n for n in names if any(v in str(n).lower() for v in low)]
 
     def count_unknown(self, session_id:int=None) -> int:
         sql=("SELECT COUNT(*) FROM messages WHERE service='Unknown'"
-             " AND (json_extract(metadata,'$.label') IS NULL OR json_extract(metadata,'$.label')='')")
+             " AND (label IS NULL OR label='')")
         args=()
         if session_id: sql+=" AND session_id=?"; args=(session_id,)
-        return self._conn.execute(sql,args).fetchone()[0]
+        return self._reader().execute(sql,args).fetchone()[0]
 
     def delete_unknown(self, session_id:int=None) -> int:
         sql=("DELETE FROM messages WHERE service='Unknown'"
-             " AND (json_extract(metadata,'$.label') IS NULL OR json_extract(metadata,'$.label')='')")
+             " AND (label IS NULL OR label='')")
         args=()
         if session_id: sql+=" AND session_id=?"; args=(session_id,)
         with self._lock:
-            cur=self._conn.execute(sql,args); self._conn.commit()
+            cur=self._conn.execute(sql,args); self._commit()
         return cur.rowcount
 
     def update_service(self, msg_id:int, new_service:str):
         """メッセージのサービス名を手動変更"""
-        with self._lock:
-            self._conn.execute(
-                "UPDATE messages SET service=? WHERE id=?",
-                (new_service, msg_id)
-            )
-            self._conn.commit()
+        self.update_services([msg_id],new_service)
 
     def delete_message(self, msg_id:int):
+        self.delete_messages([msg_id])
+
+    # ── 一括操作（id 集合を IN でまとめて1トランザクション）──────────────
+    BULK_CHUNK = 500   # WHERE id IN (…) 1文あたりの件数
+
+    def _bulk(self, sql:str, ids:list, args:tuple=()) -> int:
+        """sql の {ids} に id のプレースホルダを入れ、BULK_CHUNK 件ずつ実行して1回で commit"""
+        ids=list(ids); n=0
+        if not ids: return 0
         with self._lock:
-            self._conn.execute("DELETE FROM messages WHERE id=?",(msg_id,)); self._conn.commit()
+            try:
+                for i in range(0,len(ids),self.BULK_CHUNK):
+                    chunk=ids[i:i+self.BULK_CHUNK]
+                    n+=self._conn.execute(sql.format(ids=",".join("?"*len(chunk))),
+                                          tuple(args)+tuple(chunk)).rowcount
+                self._commit()
+            except Exception:
+                if self._conn.in_transaction: self._conn.rollback()
+                raise
+        return n
+
+    def delete_messages(self, ids:list) -> int:
+        return self._bulk("DELETE FROM messages WHERE id IN ({ids})",ids)
+
+    def set_labels(self, ids:list, label:Optional[str]) -> int:
+        """metadata.label を SQL 側（json_set / json_remove）で書き換える。None でラベル削除"""
+        meta="IFNULL(NULLIF(metadata,''),'{{}}')"
+        if label is None:
+            return self._bulk(f"UPDATE messages SET metadata=json_remove({meta},'$.label') WHERE id IN ({{ids}})",ids)
+        return self._bulk(f"UPDATE messages SET metadata=json_set({meta},'$.label',?) WHERE id IN ({{ids}})",ids,(label,))
+
+    def update_services(self, ids:list, new_service:str) -> int:
+        return self._bulk("UPDATE messages SET service=? WHERE id IN ({ids})",ids,(new_service,))
 
     def get_stats(self) -> dict:
-        total=self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
-        q_cnt=self._conn.execute(
-            "SELECT COUNT(*) FROM messages WHERE json_extract(metadata,'$.label')='question'"
-        ).fetchone()[0]
-        active=self._conn.execute(
-            "SELECT COUNT(*) FROM messages WHERE service!='Unknown'"
-            " OR (json_extract(metadata,'$.label') IS NOT NULL AND json_extract(metadata,'$.label')!='')"
-        ).fetchone()[0]
-        by_svc=self._conn.execute(
-            "SELECT service,COUNT(*) FROM messages"
-            " WHERE json_extract(metadata,'$.label')!='question' OR json_extract(metadata,'$.label') IS NULL"
-            " GROUP BY service ORDER BY COUNT(*) DESC"
-        ).fetchall()
-        return {"total":total,"active":active,"unknown_unlabeled":total-active,
-                "questions":q_cnt,"by_service":{r[0]:r[1] for r in by_svc}}
+        """_get_stats の結果をキャッシュ経由で返す"""
+        s=self._cached(("stats",)+self._data_version(),self._get_stats)
+        return {**s,"by_service":dict(s["by_service"])}
+
+    def _get_stats(self) -> dict:
+        """件数は message_counters から読むだけ（全件走査なし）"""
+        cnt={r[0]:r[1] for r in self._reader().execute("SELECT key,n FROM message_counters WHERE n<>0")}
+        total=cnt.get("total",0); unknown=cnt.get("unknown",0)
+        by_svc=sorted(((k[4:],n) for k,n in cnt.items() if k.startswith("svc:")),key=lambda x:-x[1])
+        return {"total":total,"active":total-unknown,"unknown_unlabeled":unknown,
+                "questions":cnt.get("questions",0),"by_service":dict(by_svc)}
+
+    # ── スレッド（質問1件＋その回答）───────────────────────────────────
+    def _mig_threads(self, c):
+        """
+        回答行に question_id を持たせ、質問ごとの回答を索引1本で引けるようにする。
+        既存行は ts（シグネチャ由来の質問タイムスタンプ）が一致する質問行に紐付ける。
+        """
+        ex=[r[1] for r in c.execute("PRAGMA table_info(messages)").fetchall()]
+        if "question_id" not in ex:
+            c.execute("ALTER TABLE messages ADD COLUMN question_id INTEGER")
+        self._script(c,"""
+            CREATE INDEX IF NOT EXISTS idx_msg_qid ON messages(question_id,detected_at);
+            CREATE INDEX IF NOT EXISTS idx_msg_questions ON messages(detected_at,id) WHERE label='question';
+            CREATE TRIGGER IF NOT EXISTS messages_thread_ad AFTER DELETE ON messages
+            WHEN old.label='question' BEGIN
+                UPDATE messages SET question_id=NULL WHERE question_id=old.id;
+            END;
+        """)
+        n=self._link_threads(c)
+        print(f"[DEBUG] threads linked={n}", flush=True)
+
+    @staticmethod
+    def _link_threads(c) -> int:
+        """未紐付けの回答を ts が同じ質問行（最初の1件）に紐付ける"""
+        return c.execute("""
+            UPDATE messages SET question_id=(
+                SELECT q.id FROM messages q WHERE q.ts=messages.ts AND q.label='question' ORDER BY q.id LIMIT 1)
+            WHERE question_id IS NULL AND ts<>'' AND label IS NOT 'question'
+        """).rowcount
+
+    # ── 行の版番号（一覧の差分比較用）──────────────────────────────────
+    def _mig_row_version(self, c):
+        """
+        messages に rev 列を足し、表示に関わる列が更新されるたびにトリガーで +1 する。
+        VIEWER は (id, rev) を比べるだけで再描画が要るか判断できる。
+        rev だけの更新は変更フィードに二重に記録しない。
+        """
+        ex=[r[1] for r in c.execute("PRAGMA table_info(messages)").fetchall()]
+        if "rev" not in ex:
+            c.execute("ALTER TABLE messages ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        self._script(c,"""
+            DROP TRIGGER IF EXISTS messages_chg_au;
+            CREATE TRIGGER messages_chg_au AFTER UPDATE ON messages WHEN new.rev=old.rev BEGIN
+                INSERT INTO change_log(msg_id,op) VALUES(new.id,'U');
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_rev_au
+            AFTER UPDATE OF ts,service,content,metadata,preview,question_id ON messages
+            WHEN new.rev=old.rev BEGIN
+                UPDATE messages SET rev=old.rev+1 WHERE id=new.id;
+            END;
+        """)
+
+    def _mig_service_date(self, c):
+        """
+        service=… date=… の組み合わせを1本の索引の範囲検索にする (service, detected_at)。
+        service 単独の索引はこの先頭列で代用できるので削除する。
+        """
+        self._script(c,"""
+            CREATE INDEX IF NOT EXISTS idx_msg_svc_date ON messages(service,detected_at);
+            DROP INDEX IF EXISTS idx_msg_service;
+        """)
+
+    ARCHIVING_KEY = "_archiving"   # settings の目印：アーカイブ退避中の削除（同じトランザクション内だけ存在）
+
+    def _mig_thread_archive(self, c):
+        """
+        質問行を削除したら回答の question_id を外すトリガーを、アーカイブ退避中は動かさないよう作り直す。
+        退避した質問はアーカイブDBに残るので、ホットに残る回答の紐付けはそのまま保つ。
+        """
+        self._script(c,f"""
+            DROP TRIGGER IF EXISTS messages_thread_ad;
+            CREATE TRIGGER messages_thread_ad AFTER DELETE ON messages
+            WHEN old.label='question' AND NOT EXISTS(SELECT 1 FROM settings WHERE key='{self.ARCHIVING_KEY}') BEGIN
+                UPDATE messages SET question_id=NULL WHERE question_id=old.id;
+            END;
+        """)
+
+    @staticmethod
+    def _rev_col(sch:str="main") -> str:
+        """一覧用の rev 列（アーカイブは読み取り専用で更新されないので常に 0）"""
+        return ",m.rev" if sch=="main" else ",0 AS rev"
+
+    def _tuples(self, sql:str, params=()) -> sqlite3.Cursor:
+        """読み取り接続で実行し、行を sqlite3.Row ではなく素のタプルで返すカーソル（MessageRow 用）"""
+        cur=self._reader().cursor(); cur.row_factory=None
+        return cur.execute(sql,params)
+
+    def get_thread(self, question_id:int) -> Optional[dict]:
+        """質問1件とその回答（検出順）を1回の索引検索で取得 → {"question":…, "answers":[…]}"""
+        rows=MessageRow.batch(self._tuples(
+            f"SELECT {self._PAGE_COLS},m.rev,m.question_id FROM messages m WHERE m.id=? OR m.question_id=?"
+            " ORDER BY m.question_id IS NOT NULL,m.detected_at,m.id",(question_id,question_id)))
+        if not rows or rows[0]["id"]!=question_id: return None
+        return {"question":rows[0],"answers":rows[1:]}
+
+    def get_threads_page(self, after:tuple=None, limit:int=20) -> list:
+        """
+        新しい質問から limit 件と、それぞれの回答をまとめて取得（VIEWER のスレッド表示用）。
+        after=(detected_at,id) より古い質問が次ページ。質問の絞り込みと回答の取得は1クエリ。
+        """
+        key="AND (detected_at,id)<(?,?)" if after else ""
+        rows=MessageRow.batch(self._tuples(f"""
+            WITH q AS (
+                SELECT id FROM messages INDEXED BY idx_msg_questions WHERE label='question' {key}
+                ORDER BY detected_at DESC,id DESC LIMIT ?
+            )
+            SELECT {self._PAGE_COLS},m.rev,m.question_id FROM messages m
+            WHERE m.id IN q OR m.question_id IN q
+            ORDER BY m.detected_at,m.id
+        """,(list(after) if after else [])+[limit]))
+        threads={}
+        for r in rows:
+            if r["question_id"] is None: threads[r["id"]]={"question":r,"answers":[]}
+        for r in rows:
+            if r["question_id"] in threads: threads[r["question_id"]]["answers"].append(r)
+        return sorted(threads.values(),key=lambda t:(t["question"]["detected_at"],t["question"]["id"]),reverse=True)
+
+    # ── エクスポート／インポート（カーソルとジェネレータで一定メモリ）────────
+    EXPORT_COLS = ["id","session_id","ts","role","service","content","detected_at","metadata"]
+    EXPORT_CHUNK = 1000   # fetchmany / executemany の1回あたりの行数
+
+    def iter_messages(self, query:str="", chunk:int=None):
+        """
+        search_messages と同じ検索構文に一致する行を dict で1行ずつ返す（本文は展開済み）。
+        fetchmany で chunk 件ずつ読むので、全件でもメモリは chunk 件分だけ。
+        アーカイブは date 条件があれば重なる月だけ、なければ全アーカイブが対象（検索と違い全期間）。
+        """
+        chunk=chunk or self.EXPORT_CHUNK
+        for sch in self._schemas_for(query,all_archives=True):
+            _,src,where,params=self._from_where(query,sch)
+            cur=self._reader().execute(
+                f"SELECT m.id,m.session_id,m.ts,m.role,m.service,cr_unpack(m.content) AS content,"
+                f"m.detected_at,m.metadata FROM {src} WHERE {where} ORDER BY m.id",params)
+            while True:
+                rows=cur.fetchmany(chunk)
+                if not rows: break
+                for r in rows: yield dict(r)
+
+    @staticmethod
+    def _open_text(path:str, mode:str):
+        """.gz は gzip、それ以外は通常のテキストファイル（UTF-8・改行コード変換なし）"""
+        if str(path).endswith(".gz"): return gzip.open(path,mode+"t",encoding="utf-8",newline="")
+        return open(path,mode,encoding="utf-8",newline="")
+
+    def export_messages(self, path:str, query:str="") -> int:
+        """
+        検索条件に一致する行を JSONL か CSV（拡張子で判定・.gz なら gzip 圧縮）に書き出し、件数を返す。
+        例: export_messages("backup.jsonl.gz", "service=claude date=2026-02")
+        """
+        t=time.time(); n=0
+        is_csv=".csv" in Path(path).name
+        with self._open_text(path,"w") as f:
+            w=csv.DictWriter(f,fieldnames=self.EXPORT_COLS) if is_csv else None
+            if w: w.writeheader()
+            for row in self.iter_messages(query):
+                if w: w.writerow(row)
+                else: f.write(json.dumps(row,ensure_ascii=False)+"\n")
+                n+=1
+        print(f"[DEBUG] export {path} rows={n} {time.time()-t:.2f}s", flush=True)
+        return n
+
+    def _read_export(self, path:str):
+        """export_messages の出力（JSONL / CSV・gzip 可）を1行ずつ dict で返す"""
+        with self._open_text(path,"r") as f:
+            if ".csv" in Path(path).name:
+                yield from csv.DictReader(f)
+            else:
+                for line in f:
+                    if line.strip(): yield json.loads(line)
+
+    def import_messages(self, path:str, session_name:str=None) -> tuple:
+        """
+        export_messages の出力を取り込み、(読んだ行数, 追加した行数) を返す。
+        EXPORT_CHUNK 行ずつ executemany し、全体を1トランザクションで確定（途中で失敗したら何も残さない）。
+        重複は content_hash を現在のハッシュ関数で計算し直して UNIQUE 索引で弾く。
+        行は取り込み用の新しいセッションに入る（元の id・セッションは引き継がない）。
+        """
+        t=time.time(); read=0
+        sql=("INSERT INTO messages(session_id,ts,role,service,content,content_hash,detected_at,metadata,preview)"
+             " VALUES(?,?,?,?,?,?,?,?,?) ON CONFLICT(content_hash) DO NOTHING")
+        with self._lock:
+            c=self._conn
+            try:
+                now=datetime.now().isoformat()
+                sid=c.execute("INSERT INTO sessions(name,created_at,updated_at) VALUES(?,?,?)",
+                              (session_name or f"Import {Path(path).name}",now,now)).lastrowid
+                batch=[]
+                for r in self._read_export(path):
+                    content=r.get("content") or ""
+                    meta=r.get("metadata") or "{}"
+                    if not isinstance(meta,str): meta=json.dumps(meta,ensure_ascii=False)
+                    try: md=json.loads(meta)
+                    except ValueError: md=None
+                    if not isinstance(md,dict):
+                        # 壊れた metadata はその行だけ {} にする（取り込み全体は止めない）
+                        print(f"[DEBUG] import: bad metadata at row {read+1} → {{}}", flush=True)
+                        md={}; meta="{}"
+                    ts=r.get("ts") or ""; service=r.get("service") or "Unknown"
+                    is_q=md.get("label")=="question"
+                    h=self.question_hash(ts,content) if is_q else self.message_hash(service,content)
+                    batch.append((sid,ts,r.get("role") or "assistant",service,self._pack(content),h,
+                                  r.get("detected_at") or now,meta,content[:self.PREVIEW_LEN]))
+                    read+=1
+                    if len(batch)>=self.EXPORT_CHUNK: c.executemany(sql,batch); batch=[]
+                if batch: c.executemany(sql,batch)
+                self._link_threads(c)
+                # トリガー（FTS・カウンタ・変更フィード）の分を除いた messages への追加件数
+                added=c.execute("SELECT COUNT(*) FROM messages WHERE session_id=?",(sid,)).fetchone()[0]
+                if not added: c.execute("DELETE FROM sessions WHERE id=?",(sid,))
+                self._commit()
+            except Exception:
+                if c.in_transaction: c.rollback()
+                raise
+        print(f"[DEBUG] import {path} read={read} added={added} {time.time()-t:.2f}s", flush=True)
+        return read,added
 
     # ── AI Services ───────────────────────────────────────────────────
     def get_ai_services(self) -> dict:
-        rows=self._conn.execute("SELECT name,config FROM ai_services").fetchall()
+        """{名前: 設定}。書き込みは save/delete_ai_service だけなので self._gen を版にする"""
+        svcs=self._cached(("ai_services",self._gen),self._get_ai_services)
+        return {k:dict(v) for k,v in svcs.items()}   # 呼び出し側が書き換えてもキャッシュは変わらない
+
+    def _get_ai_services(self) -> dict:
+        rows=self._reader().execute("SELECT name,config FROM ai_services").fetchall()
         return {str(r[0]):json.loads(r[1]) for r in rows}
 
     def save_ai_service(self, name, config:dict):
@@ -545,22 +2401,26 @@ class ChatDatabase:
         if not name or name in ("True","False","0","1"):
             print(f"[DEBUG] save_ai_service rejected invalid name={name!r}", flush=True)
             return
-        self._conn.execute(
-            "INSERT OR REPLACE INTO ai_services(name,config,updated_at) VALUES(?,?,?)",
-            (name,json.dumps(config,ensure_ascii=False),datetime.now().isoformat())
-        )
-        self._conn.commit()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ai_services(name,config,updated_at) VALUES(?,?,?)",
+                (name,json.dumps(config,ensure_ascii=False),datetime.now().isoformat())
+            )
+            self._commit()
+        self._invalidate_queries()
         print(f"[DEBUG] save_ai_service saved name={name!r}", flush=True)
 
     def delete_ai_service(self, name):
         print(f"[DEBUG] delete_ai_service name={name!r} type={type(name)}", flush=True)
         # bool・数値残骸を全削除
-        self._conn.execute("DELETE FROM ai_services WHERE typeof(name)='integer'")
-        # 文字列nameも削除
-        if not isinstance(name, bool):
-            self._conn.execute("DELETE FROM ai_services WHERE name=?",(str(name),))
-        self._conn.commit()
-        rows=self._conn.execute("SELECT name FROM ai_services").fetchall()
+        with self._lock:
+            self._conn.execute("DELETE FROM ai_services WHERE typeof(name)='integer'")
+            # 文字列nameも削除
+            if not isinstance(name, bool):
+                self._conn.execute("DELETE FROM ai_services WHERE name=?",(str(name),))
+            self._commit()
+        self._invalidate_queries()
+        rows=self._reader().execute("SELECT name FROM ai_services").fetchall()
         print(f"[DEBUG] remaining: {[r[0] for r in rows]}", flush=True)
 
     # ── Session ───────────────────────────────────────────────────────
@@ -575,21 +2435,22 @@ class ChatDatabase:
             ).fetchone()
             if row:
                 self._conn.execute("UPDATE sessions SET updated_at=? WHERE id=?",(now,row[0]))
-                self._conn.commit(); return row[0]
+                self._commit(); return row[0]
             cur=self._conn.execute(
                 "INSERT INTO sessions(name,created_at,updated_at) VALUES(?,?,?)",(name,now,now)
             )
-            self._conn.commit(); return cur.lastrowid
+            self._commit(); return cur.lastrowid
 
     def get_setting(self,key,default=None):
-        row=self._conn.execute("SELECT value FROM settings WHERE key=?",(key,)).fetchone()
+        row=self._reader().execute("SELECT value FROM settings WHERE key=?",(key,)).fetchone()
         return row[0] if row else default
 
     def set_setting(self,key,value):
-        self._conn.execute(
-            "INSERT OR REPLACE INTO settings(key,value,updated_at) VALUES(?,?,?)",
-            (key,value,datetime.now().isoformat())
-        ); self._conn.commit()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO settings(key,value,updated_at) VALUES(?,?,?)",
+                (key,value,datetime.now().isoformat())
+            ); self._commit()
 
 
 # ─────────────────────────────────────────────────────────────────────
@@ -621,6 +2482,7 @@ class AIServiceDetector:
 # ─────────────────────────────────────────────────────────────────────
 class LocalLLMClient:
     @staticmethod
+    @metrics.timed("llm.chat")
     def chat(base_url:str, endpoint:str, model:str, messages:list, timeout:int=300) -> str:
         url=base_url.rstrip("/")+endpoint
         # 画像あり（imagesキー存在）の場合はthink/optionsを除外
@@ -646,13 +2508,13 @@ class LocalLLMClient:
                 return content
             if "choices" in data: return data["choices"][0]["message"]["content"]
         except requests.exceptions.ConnectionError:
-            print("[DEBUG] ConnectionError", flush=True)
+            print("[DEBUG] ConnectionError", flush=True); metrics.inc("llm.errors")
             return f"[接続エラー] {base_url} に接続できません"
         except requests.exceptions.Timeout:
-            print(f"[DEBUG] Timeout after {timeout}s", flush=True)
+            print(f"[DEBUG] Timeout after {timeout}s", flush=True); metrics.inc("llm.errors")
             return f"[タイムアウト] {timeout}秒"
         except Exception as e:
-            print(f"[DEBUG] Exception: {e}", flush=True)
+            print(f"[DEBUG] Exception: {e}", flush=True); metrics.inc("llm.errors")
             return f"[エラー] {e}"
         return ""
 
@@ -683,6 +2545,227 @@ class LocalLLMClient:
         print("[DEBUG] list_models returning []", flush=True)
         return []
 
+    @staticmethod
+    @metrics.timed("llm.embed")
+    def embed(base_url:str, model:str, texts:list, endpoint:str="", timeout:int=60) -> Optional[list]:
+        """
+        texts の埋め込みベクトルを返す。失敗時は None。
+        Ollama（/api/embed）と OpenAI 互換（/v1/embeddings・LM Studio）を試す。
+        チャット用 endpoint が /v1/… のサービスは /v1/embeddings を先に試す。
+        """
+        eps=["/api/embed","/v1/embeddings"]
+        if endpoint.startswith("/v1/"): eps.reverse()
+        for ep in eps:
+            url=base_url.rstrip("/")+ep
+            try:
+                r=requests.post(url,json={"model":model,"input":texts},timeout=timeout)
+                if r.status_code!=200:
+                    print(f"[DEBUG] embed {url} status={r.status_code}", flush=True); continue
+                data=r.json()
+                if "embeddings" in data: vecs=data["embeddings"]
+                elif "data" in data: vecs=[d["embedding"] for d in sorted(data["data"],key=lambda d:d.get("index",0))]
+                else: continue
+                if len(vecs)==len(texts): return vecs
+                print(f"[DEBUG] embed {url} returned {len(vecs)}/{len(texts)} vectors", flush=True)
+            except requests.exceptions.ConnectionError:
+                print(f"[DEBUG] embed {url} ConnectionError", flush=True); return None
+            except Exception as e:
+                print(f"[DEBUG] embed {url} exception: {e}", flush=True)
+        return None
+
+
+# ─────────────────────────────────────────────────────────────────────
+# 意味検索（埋め込みベクトル索引）
+# ─────────────────────────────────────────────────────────────────────
+class VectorIndex:
+    """
+    embeddings 表のベクトルを正規化済み float32 行列ファイル（<DB名>_vectors.f32）に書き出し、
+    np.memmap で読んで cos 類似度の top-k を1回の行列積で求める。
+    行の追加だけなら末尾に追記し、削除・差し替えがあったときだけ作り直す。
+    """
+    CHUNK = 1024
+
+    def __init__(self, db:ChatDatabase, path:str=None):
+        self.db=db
+        p=Path(path or db.db_path); base=str(p.with_name(p.stem+"_vectors"))
+        self._vec_path=base+".f32"; self._ids_path=base+".ids"; self._meta_path=base+".json"
+        self._lock=threading.Lock()
+        self._mat=None; self._ids=None; self._state=None; self.dim=0
+
+    def __len__(self): return 0 if self._ids is None else len(self._ids)
+
+    def refresh(self) -> bool:
+        """embeddings 表と行列ファイルを同期。変化があれば True"""
+        if _np is None: return False
+        with self._lock:
+            if self._state is None: self._load()
+            state=self.db.embedding_state()
+            if state==self._state: return False
+            cnt,top=self._state
+            tail=list(self.db.iter_embeddings(after=top))
+            self._mat=None   # 書き込み前にマップを外す（Windows では必須）
+            # 件数の増分＝追記分なら削除・差し替えはない → 末尾に足すだけ
+            if cnt and len(tail)==state[0]-cnt and all(len(b)==self.dim*4 for _,_,b in tail):
+                self._write(tail,"ab")
+                print(f"[DEBUG] vector index +{len(tail)} rows", flush=True)
+            else:
+                t=time.time(); self.dim=0
+                self._write(self.db.iter_embeddings(),"wb")
+                print(f"[DEBUG] vector index rebuilt rows={state[0]} {time.time()-t:.2f}s", flush=True)
+            self._state=state
+            with open(self._meta_path,"w",encoding="utf-8") as f:
+                json.dump({"count":state[0],"top":state[1],"dim":self.dim},f)
+            self._map()
+            return True
+
+    def _load(self):
+        """前回の行列ファイルを再利用（embeddings 表とずれていれば refresh で直す）"""
+        self._state=(0,0)
+        try:
+            with open(self._meta_path,encoding="utf-8") as f: meta=json.load(f)
+            n,dim=meta["count"],meta["dim"]
+            if os.path.getsize(self._vec_path)==n*dim*4 and os.path.getsize(self._ids_path)==n*8:
+                self.dim=dim; self._state=(n,meta["top"]); self._map()
+        except (OSError,ValueError,KeyError): pass
+
+    def _write(self, rows, mode:str):
+        with open(self._vec_path,mode) as fv, open(self._ids_path,mode) as fi:
+            buf=[]; ids=[]
+            def _flush():
+                m=_np.frombuffer(b"".join(buf),dtype=_np.float32).reshape(len(buf),self.dim)
+                m=m/_np.maximum(_np.linalg.norm(m,axis=1,keepdims=True),1e-12)
+                fv.write(m.astype(_np.float32).tobytes()); fi.write(_np.asarray(ids,dtype=_np.int64).tobytes())
+                buf.clear(); ids.clear()
+            for _,mid,blob in rows:
+                if not self.dim: self.dim=len(blob)//4
+                if len(blob)!=self.dim*4: continue   # 次元の違うベクトル（モデル切替の途中）は除外
+                buf.append(blob); ids.append(mid)
+                if len(buf)>=self.CHUNK: _flush()
+            if buf: _flush()
+
+    def _map(self):
+        self._ids=_np.fromfile(self._ids_path,dtype=_np.int64) if os.path.exists(self._ids_path) else _np.zeros(0,_np.int64)
+        n=len(self._ids)
+        self._mat=_np.memmap(self._vec_path,dtype=_np.float32,mode="r",shape=(n,self.dim)) if n and self.dim else None
+
+    def top_k(self, vec, k:int=20, exclude:tuple=()) -> list:
+        """vec との cos 類似度が高い順に [(id, score)] を最大 k 件"""
+        if _np is None: return []
+        with self._lock:
+            if self._mat is None: return []
+            q=_np.asarray(vec,dtype=_np.float32)
+            if q.shape!=(self.dim,): return []
+            s=self._mat@(q/(float(_np.linalg.norm(q)) or 1.0)); ids=self._ids
+        n=min(k+len(exclude),len(s))
+        top=_np.argpartition(-s,n-1)[:n]
+        top=top[_np.argsort(-s[top])]
+        return [(int(ids[i]),float(s[i])) for i in top if int(ids[i]) not in exclude][:k]
+
+    def similar(self, msg_id:int, k:int=20) -> list:
+        """msg_id の回答に似た行（自身を除く）。未埋め込みなら空"""
+        if _np is None: return []
+        with self._lock:
+            if self._mat is None: return []
+            hit=_np.flatnonzero(self._ids==msg_id)
+            if not len(hit): return []
+            vec=_np.array(self._mat[hit[0]])
+        return self.top_k(vec,k,exclude=(msg_id,))
+
+
+class Embedder:
+    """
+    未埋め込みのメッセージを EMBED_BATCH 件ずつ Local LLM の埋め込みAPIへ送り、embeddings 表に保存する。
+    使うサービス・モデルは settings の embed_service / embed_model。処理済み位置より後ろだけを見る（増分）。
+    """
+    EMBED_BATCH   = 32
+    IDLE_WAIT     = 10.0   # 未処理がないときの待ち秒数
+    RETRY_WAIT    = 60.0   # 接続できなかったときの待ち秒数
+    DEFAULT_MODEL = "nomic-embed-text"
+
+    def __init__(self, db:ChatDatabase, index:VectorIndex=None):
+        self.db=db; self.index=index or VectorIndex(db)
+        self._stop=threading.Event()
+        self._pos=0; self._model=None; self._tok=None
+        self.stats=dict(embedded=0,errors=0)
+
+    def config(self) -> Optional[tuple]:
+        """
+        (base_url, endpoint, model)。埋め込みに使える Local LLM がなければ None。
+        AI SERVICES で有効にしたサービスだけを使う（無効なサービスへ DB の本文を送らない）。
+        """
+        name=self.db.get_setting("embed_service","Ollama")
+        cfg=self.db.get_ai_services().get(name)
+        if not cfg or cfg.get("type")!="local" or not cfg.get("url") or not cfg.get("enabled"): return None
+        return cfg["url"],cfg.get("endpoint",""),self.db.get_setting("embed_model",self.DEFAULT_MODEL)
+
+    def run_once(self) -> int:
+        """未処理分をすべて埋め込み、保存した件数を返す（接続できなければ -1）"""
+        if _np is None: return 0
+        cfg=self.config()
+        if not cfg: return 0
+        url,ep,model=cfg
+        if model!=self._model:
+            # モデルが変わると次元もベクトル空間も違う → 古いベクトルは捨てて作り直す
+            n=self.db.clear_embeddings(keep_model=model)
+            if n: print(f"[DEBUG] embeddings cleared for model={model}: {n}", flush=True)
+            self._model=model; self._pos=0
+        self._rewind()
+        done=0
+        while not self._stop.is_set():
+            rows=self.db.pending_embeddings(after=self._pos,limit=self.EMBED_BATCH)
+            if not rows: break
+            vecs=LocalLLMClient.embed(url,model,[t or " " for _,t in rows],endpoint=ep)
+            if vecs is None:
+                self.stats["errors"]+=1; done=done or -1; break
+            done+=self.db.save_embeddings(model,[(mid,_np.asarray(v,dtype=_np.float32).tobytes())
+                                                 for (mid,_),v in zip(rows,vecs)])
+            self._pos=rows[-1][0]
+        if done>0:
+            self.stats["embedded"]+=done
+            print(f"[DEBUG] embedded {done} messages model={model}", flush=True)
+        self.index.refresh()
+        return done
+
+    def _rewind(self):
+        """
+        前回以降に更新された行まで処理済み位置を戻す（本文が変わるとトリガーでベクトルが消えるので、
+        近似重複のまとめなどで差し替わった行も埋め込み直す）。変更フィードを読むだけで全件は見ない。
+        """
+        if self._tok is None: self._tok=self.db.change_token(); self._pos=0; return
+        ch=self.db.changes_since(self._tok); self._tok=ch["token"]
+        if ch["reset"]: self._pos=0
+        elif ch["updated"]: self._pos=min(self._pos,ch["updated"][0]-1)
+
+    def search_text(self, text:str, k:int=20) -> list:
+        """自由文の意味検索 → [(id, score)]"""
+        cfg=self.config()
+        if _np is None or not cfg or not text: return []
+        url,ep,model=cfg
+        vecs=LocalLLMClient.embed(url,model,[text],endpoint=ep,timeout=10)
+        if not vecs: return []
+        self.index.refresh()
+        return self.index.top_k(vecs[0],k)
+
+    def similar(self, msg_id:int, k:int=20) -> list:
+        self.index.refresh()
+        return self.index.similar(msg_id,k)
+
+    def start(self):
+        if _np is None:
+            print("[DEBUG] numpy not installed: semantic search disabled", flush=True); return
+        # 停止→再開（終了の取りやめ）でも前のスレッドは自分の Event で抜けるので二重に回らない
+        self._stop=stop=threading.Event()
+        threading.Thread(target=self._loop,args=(stop,),daemon=True).start()
+
+    def stop(self): self._stop.set()
+
+    def _loop(self, stop:threading.Event):
+        while not stop.is_set():
+            try: n=self.run_once()
+            except Exception as e:
+                print(f"[DEBUG] Embedder error: {e}", flush=True); n=-1
+            stop.wait(self.RETRY_WAIT if n<0 else self.IDLE_WAIT)
+
 
 # ─────────────────────────────────────────────────────────────────────
 # プロンプトビルダー
@@ -749,54 +2832,250 @@ class PromptBuilder:
         return text.strip()
 
 
+# ─────────────────────────────────────────────────────────────────────
+# 取り込み分類（送信プロンプト・シグネチャ・サービス・機密文字列）
+# ─────────────────────────────────────────────────────────────────────
+@dataclass
+class Capture:
+    prompt:bool            # 送信プロンプト（指示ブロック入り）→ 保存しない
+    sig:Optional[dict]     # シグネチャ {"ai","q","ts"}
+    service:str            # シグネチャの AI 名 / 本文パターンで判定したサービス / "Unknown"
+    clean:str              # シグネチャ・指示ブロックを除いた保存用の本文
+    secret:Optional[str]   # 機密っぽい文字列（あれば保存しない）
+
+class CaptureClassifier:
+    """
+    取り込んだ1件をまとめて分類する（ClipboardMonitor._process 用）。
+    本文を1回だけ小文字化し、各パターンに必須のリテラルが含まれるかを str の部分一致（C 実装の高速検索）で
+    確かめてから、該当した正規表現だけを実行する。普通の回答はリテラル検査だけで終わり、
+    数百KBの本文でも正規表現で全文を何度も走査しない。判定結果は従来の個別処理と同じ。
+    """
+    PROMPT_LITERALS = ("回答の冒頭に","管理用タグ")                     # _PROMPT_BLOCK_PATTERN
+    BLOCK_LITERALS  = ("【システム指示","変更・省略しないでください：")    # PromptBuilder._SIG_BLOCK_PATTERN
+    SIG_LITERAL     = "[AI:"                                          # SIG_PATTERN
+    SECRET_LITERALS = ("sk-","AKIA","eyJ","ghp_","xoxb-","AIza")      # _SENSITIVE_PATTERNS の各候補の先頭
+
+    def __init__(self, patterns:dict=None):
+        patterns=patterns or AIServiceDetector.PATTERNS
+        self._svc=[(svc,[(self._literal(p),re.compile(p,re.I)) for p in ps]) for svc,ps in patterns.items()]
+
+    @staticmethod
+    def _literal(pat:str) -> str:
+        """正規表現から必ず現れる最長のリテラル（小文字）を取り出す。省略可能な (…)? と文字クラスは区切り扱い"""
+        pat=re.sub(r"\([^()]*\)[?*]|\[[^\]]*\]","|",pat)
+        pat=re.sub(r"\\(.)",r"\1",pat)
+        parts=re.split(r"[()|?*+{}^$]",pat)
+        return max((x.strip() for x in parts),key=len).lower()
+
+    def detect(self, text:str, low:str=None) -> str:
+        """本文パターンでサービスを判定（PATTERNS の順で最初に当たったもの）"""
+        low=text.lower() if low is None else low
+        for svc,pats in self._svc:
+            for lit,rx in pats:
+                if lit in low and rx.search(text): return svc
+        return "Unknown"
+
+    @metrics.timed("capture.classify")
+    def classify(self, text:str) -> Capture:
+        # 正規表現は最初のリテラルの少し手前（「---\n」＋20文字）から走らせる
+        i=text.find(self.PROMPT_LITERALS[0])
+        if i>=0 and self.PROMPT_LITERALS[1] in text and \
+           ClipboardMonitor._PROMPT_BLOCK_PATTERN.search(text,max(0,i-25)):
+            return Capture(True,None,"Unknown","",None)
+        sig=PromptBuilder.parse_signature(text) if self.SIG_LITERAL in text else None
+        service=sig["ai"] if sig else self.detect(text)
+        clean=text
+        if all(l in clean for l in self.BLOCK_LITERALS): clean=PromptBuilder._SIG_BLOCK_PATTERN.sub("",clean)
+        if sig: clean=SIG_PATTERN.sub("",clean)
+        clean=clean.strip()
+        secret=None
+        pos=[i for i in (clean.find(l) for l in self.SECRET_LITERALS) if i>=0]
+        if pos:
+            m=ClipboardMonitor._SENSITIVE_PATTERNS.search(clean,min(pos))
+            if m: secret=m.group()
+        return Capture(False,sig,service,clean,secret)
+
+    @classmethod
+    def legacy(cls, text:str, detector:"AIServiceDetector"=None) -> Capture:
+        """従来の個別処理（パターンごとに全文を走査）。bench の比較・結果照合用"""
+        if ClipboardMonitor._PROMPT_BLOCK_PATTERN.search(text): return Capture(True,None,"Unknown","",None)
+        sig=PromptBuilder.parse_signature(text)
+        service=sig["ai"] if sig else (detector or AIServiceDetector()).detect(text)
+        clean=PromptBuilder.strip_signature(text)
+        m=ClipboardMonitor._SENSITIVE_PATTERNS.search(clean)
+        return Capture(False,sig,service,clean,m.group() if m else None)
+
+    @staticmethod
+    def bench_corpus(size_kb:int=200) -> dict:
+        """ベンチマーク用の大きな取り込み例（通常の回答・シグネチャ付き・サービス名入り・機密入り・送信プロンプト）"""
+        rnd=random.Random(0)
+        words=("the answer uses a function to return value and handles errors in python code "
+               "データベース の 索引 を 使って 検索 を 高速化 します 例えば 次 の ように").split()
+        def body(): 
+            out=[]; n=0
+            while n<size_kb*1024:
+                w=rnd.choice(words); out.append(w); n+=len(w.encode())+1
+            return " ".join(out)
+        sig="[AI:Claude][Q:索引の使い方][TS:2026-02-18T14:23:15]"
+        return {
+            "plain":     body(),
+            "signature": sig+"\n"+body(),
+            "service":   body()+"\nAs an AI language model developed by OpenAI, ChatGPT …",
+            "secret":    body()+"\nexport OPENAI_API_KEY=sk-"+"a1B2"*8+"\n",
+            "prompt":    body()+PromptBuilder.add_signature("","Claude","索引の使い方","2026-02-18T14:23:15"),
+        }
+
+    @classmethod
+    def bench(cls, size_kb:int=200, rounds:int=5) -> list:
+        """各例について 従来処理 / 分類器 の1件あたりの時間（ms）と結果の一致を返す"""
+        clf=cls(); det=AIServiceDetector(); out=[]
+        for name,text in cls.bench_corpus(size_kb).items():
+            t=time.perf_counter()
+            for _ in range(rounds): a=cls.legacy(text,det)
+            t1=(time.perf_counter()-t)/rounds*1e3
+            t=time.perf_counter()
+            for _ in range(rounds): b=clf.classify(text)
+            t2=(time.perf_counter()-t)/rounds*1e3
+            out.append({"case":name,"kb":len(text.encode())//1024,"legacy_ms":round(t1,2),
+                        "classifier_ms":round(t2,2),"same":a==b})
+        return out
+
+
 # ─────────────────────────────────────────────────────────────────────
 # クリップボード監視
 # ─────────────────────────────────────────────────────────────────────
 class ClipboardMonitor:
+    """
+    常時監視モード：バックエンドが変化通知に対応していれば（Qt / MemoryBackend）通知後に監視スレッドが読む。
+    通知は監視スレッドを起こすだけなので、手動モードや続けざまの通知では読み取り・変換をしない。
+    未対応（pyperclip / tkinter）はポーリングし、変化がない間は間隔を poll → POLL_MAX まで延ばす。
+    取り込みは2段：読み取り側（監視スレッド・手動取り込み）は本文に時刻を付けて上限付きキューに積むだけで、
+    分類と保存は取り込みワーカーが行う（DB が Local LLM の保存で混んでいても読み取りは止まらない）。
+    """
+    POLL_MAX     = 4.0   # 秒。変化がないときのポーリング間隔の上限
+    POLL_BACKOFF = 1.5   # 変化がないたびに間隔を何倍にするか
+    QUEUE_MAX    = 32    # 分類・保存待ちの上限（件）
+    QUEUE_WAIT   = 0.5   # 秒。満杯のとき読み取り側が待つ上限（超えたら破棄して dropped に数える）
+
     def __init__(self, db:ChatDatabase, poll:float=0.8, on_new:Callable=None):
         self.db=db; self.poll=poll; self.on_new=on_new
         self.detector=AIServiceDetector()
-        self._running=False; self._last_hash=""
+        self.classifier=CaptureClassifier()
+        self._stop=threading.Event(); self._stop.set(); self._last_key=None
+        self._wake=threading.Event(); self._pending=None; self._watch_cb=None; self._watching=False
         self.session_id:Optional[int]=None
-        self.stats=dict(detected=0,saved=0,dup=0,unknown=0,matched=0)
+        # queued=キューの件数 / queue_peak=最大 / dropped=満杯で破棄
+        # read_ms=クリップボード読み取り / wait_ms=キュー待ち / process_ms=分類＋保存（いずれも移動平均）
+        self.stats=dict(detected=0,saved=0,dup=0,unknown=0,matched=0,near_dup=0,
+                        queued=0,queue_peak=0,dropped=0,read_ms=0.0,wait_ms=0.0,process_ms=0.0)
+        self._cq=queue.Queue(maxsize=self.QUEUE_MAX); self._worker=None; self._wlock=threading.Lock()
         self.manual_mode=True   # True=手動取り込み（デフォルト）/ False=常時監視
+        # 近似重複（空白違い・表の再描画・選択範囲の欠け）の扱い
+        #   "flag"=保存して metadata.near_dup_of に記録（既定）/ "merge"=既存行にまとめる（長いほうの本文を残す）/ "off"
+        self.near_dup=db.get_setting("near_dup","flag")
 
     def start_session(self, name=None):
         self.session_id=self.db.get_or_create_session(name)
-        try: self._last_hash=hashlib.md5(_get_cb().encode()).hexdigest()
+        try: self._last_key=(None,_get_cb())
         except: pass
 
     def start(self):
-        self._running=True
-        threading.Thread(target=self._loop,daemon=True).start()
+        if not self._stop.is_set(): return
+        # 変化通知の登録は1バックエンドにつき1回（停止→再開で二重にしない）
+        if self._watch_cb is not _cb:
+            self._watch_cb=_cb; self._watching=_cb.watch(self._on_change)
+        self._stop=stop=threading.Event()
+        threading.Thread(target=self._loop,args=(stop,),daemon=True).start()
+
+    def stop(self): self._stop.set(); self._wake.set()
 
-    def stop(self): self._running=False
+    def _on_change(self):
+        """バックエンドからの変化通知（Qt では GUI スレッド）。読まずに時刻だけ残して監視スレッドを起こす"""
+        if self.manual_mode or self._stop.is_set(): return
+        if self._pending is None: self._pending=time.perf_counter()
+        self._wake.set()
 
     def capture_once(self, hint_ai:str=""):
-        """手動モード用：今のクリップボードを1回だけ取り込む"""
+        """手動モード用：今のクリップボードを1回だけ取り込む（キューに積んだら戻る）"""
         try:
-            text=_get_cb()
-            if text:
-                # hint_aiも含めてhash化 → 同文でも別AIなら通過
-                h=hashlib.md5(f"{hint_ai}:{text}".encode()).hexdigest()
-                if h!=self._last_hash:
-                    self._last_hash=h; self.stats["detected"]+=1
-                    self._process(text, hint_ai=hint_ai)
-                    return True
+            # hint_aiも含めて比較 → 同文でも別AIなら通過
+            return self._offer(self._read(),hint_ai)
         except: pass
         return False
 
-    def _loop(self):
-        while self._running:
+    def _read(self) -> str:
+        t=time.perf_counter(); text=_get_cb()
+        self._lat("read_ms",time.perf_counter()-t)
+        return text
+
+    def _lat(self, key:str, sec:float):
+        """段ごとの所要時間（ms）を移動平均で stats に残し、metrics の capture.* ヒストグラムにも記録"""
+        ms=sec*1e3; v=self.stats[key]
+        self.stats[key]=round(ms if not v else v*0.8+ms*0.2,2)
+        metrics.observe("capture."+key[:-3],ms)
+
+    def _offer(self, text:str, hint_ai=None, t0:float=None) -> bool:
+        """前回と違う内容なら取り込みキューに積む（変化検出は文字列比較で十分。ハッシュは保存時の1回だけ）"""
+        if not text: return False
+        key=(hint_ai,text)
+        if key==self._last_key: return False
+        self._last_key=key; self.stats["detected"]+=1; metrics.inc("capture.detected")
+        return self._enqueue(text,hint_ai or "",t0 or time.perf_counter())
+
+    def _enqueue(self, text:str, hint_ai:str, t0:float) -> bool:
+        self._ensure_worker()
+        try: self._cq.put((text,hint_ai,t0),timeout=self.QUEUE_WAIT)
+        except queue.Full:
+            # 満杯 → 破棄。ポーリングなら次回また同じ内容を読んで積み直せるよう前回値を忘れる
+            self.stats["dropped"]+=1; self._last_key=None; metrics.inc("capture.dropped")
+            print(f"[DEBUG] capture queue full → dropped ({len(text)} chars)", flush=True)
+            return False
+        n=self._cq.qsize(); self.stats["queued"]=n; metrics.gauge("capture.queue",n)
+        if n>self.stats["queue_peak"]: self.stats["queue_peak"]=n
+        return True
+
+    def _ensure_worker(self):
+        with self._wlock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker=threading.Thread(target=self._work,daemon=True,name="capture")
+                self._worker.start()
+
+    def _work(self):
+        """取り込みワーカー：キューから1件ずつ分類・保存する"""
+        while True:
+            text,hint_ai,t0=self._cq.get()
+            t=time.perf_counter(); self._lat("wait_ms",t-t0)
+            try: self._process(text, hint_ai=hint_ai)
+            except Exception as e: print(f"[DEBUG] capture error: {e}", flush=True)
+            finally:
+                self._lat("process_ms",time.perf_counter()-t)
+                self.stats["queued"]=n=self._cq.qsize(); metrics.gauge("capture.queue",n); self._cq.task_done()
+
+    def drain(self, timeout:float=5.0) -> bool:
+        """キューに残った取り込みを処理し終えるまで待つ（終了時用）。時間内に空になれば True"""
+        end=time.time()+timeout
+        while self._cq.unfinished_tasks:
+            if time.time()>end: return False
+            time.sleep(0.02)
+        return True
+
+    def _loop(self, stop:threading.Event):
+        wait=self.poll
+        while not stop.is_set():
+            self._wake.wait(self.POLL_MAX if self._watching else wait); self._wake.clear()
+            if stop.is_set(): break
+            if self.manual_mode:   # 手動モードは読まない
+                self._pending=None; wait=self.poll; continue
+            changed=False
             try:
-                if not self.manual_mode:   # 常時監視モードのみポーリング
-                    text=_get_cb()
-                    if text:
-                        h=hashlib.md5(text.encode()).hexdigest()
-                        if h!=self._last_hash:
-                            self._last_hash=h; self.stats["detected"]+=1; self._process(text)
+                if self._watching:
+                    got,self._pending=self._pending,None
+                    if got is not None: changed=self._offer(self._read(),None,got)
+                else:
+                    changed=self._offer(self._read())
             except: pass
-            time.sleep(self.poll)
+            # 変化がなければ間隔を延ばし、変化したら最短に戻す
+            wait=self.poll if changed else min(wait*self.POLL_BACKOFF,self.POLL_MAX)
 
     # 機密っぽい文字列パターン（保存前チェック用）
     _SENSITIVE_PATTERNS = re.compile(
@@ -815,40 +3094,58 @@ class ClipboardMonitor:
     )
 
     def _process(self, text:str, hint_ai:str=""):
+        # 送信プロンプト判定・シグネチャ・サービス判定・除去・機密検査をまとめて1回で
+        cap=self.classifier.classify(text)
         # 送信プロンプトをスキップ（指示ブロックが含まれているものが送信プロンプト）
-        if ClipboardMonitor._PROMPT_BLOCK_PATTERN.search(text):
+        if cap.prompt:
             return
 
-        sig=PromptBuilder.parse_signature(text)
-        service="Unknown"
+        sig=cap.sig
+        service=cap.service
         matched_ts=None
         if sig:
             # シグネチャ突合成功
-            service=sig["ai"]
             matched_ts=sig["ts"]
             self.stats["matched"]+=1
-        else:
-            # シグネチャなし → テキストパターンで検出
-            service=self.detector.detect(text)
-            if service=="Unknown" and hint_ai:
-                # フォールバック：コピー時に記録したAI名を使用
-                service=hint_ai
-                self._log_fn(f"💡  シグネチャなし → {hint_ai}（フォールバック）") if hasattr(self,'_log_fn') else None
+        elif service=="Unknown" and hint_ai:
+            # シグネチャなし・テキストパターンでも不明 → フォールバック：コピー時に記録したAI名を使用
+            service=hint_ai
+            self._log_fn(f"💡  シグネチャなし → {hint_ai}（フォールバック）") if hasattr(self,'_log_fn') else None
 
-        clean=PromptBuilder.strip_signature(text)
+        clean=cap.clean
 
         # 機密文字列ガード（APIキー・JWT・トークン類は保存しない）
-        _sm=ClipboardMonitor._SENSITIVE_PATTERNS.search(clean)
-        if _sm:
-            print(f"[DEBUG] sensitive blocked: service={service} pattern={_sm.group()[:40]!r}", flush=True)
+        if cap.secret:
+            print(f"[DEBUG] sensitive blocked: service={service} pattern={cap.secret[:40]!r}", flush=True)
             if self.on_new: self.on_new("sensitive", "⚠️", clean[:40])
             return  # 保存せずスキップ
 
         meta={"source":"clipboard"}
         if matched_ts: meta["ts"]=matched_ts
+        # シグネチャの ts＋質問の先頭文字で質問行を特定（同じ秒に複数の質問があっても取り違えない）
+        q=self.db.find_question(matched_ts,sig["q"]) if sig else None
+
+        # 近似重複：SimHash のバンド索引で同じサービスの既存行を探す（全件比較なし）
+        # SimHash は1回だけ計算し、検索・まとめ・保存に渡す
+        sim=self.db.simhash(clean)
+        near=self.db.find_near_duplicate(clean,service,h=sim) if self.near_dup!="off" and sim is not None else None
+        if near:
+            self.stats["near_dup"]+=1
+            # merge は設定で選んだときだけ。シグネチャの ts・質問が既存行と違えば別の回答として保存する
+            merged=self.db.merge_near_duplicate(near,clean,matched_ts,q["id"] if q else None,h=sim) if self.near_dup=="merge" else None
+            if merged:
+                print(f"[DEBUG] near-dup merged into id={near}", flush=True)
+                if self.on_new: self.on_new("merged",service,clean)
+                return
+            if merged is False:
+                self.stats["dup"]+=1
+                if self.on_new: self.on_new("dup",service,clean)
+                return
+            meta["near_dup_of"]=near
 
         saved=self.db.save_message(
-            self.session_id,"assistant",service,clean,meta,matched_ts
+            self.session_id,"assistant",service,clean,meta,matched_ts,
+            question_id=q["id"] if q else None, sim=sim
         )
         if saved:
             self.stats["saved"]+=1
@@ -856,6 +3153,7 @@ class ClipboardMonitor:
             if self.on_new: self.on_new("saved",service,clean)
         else:
             self.stats["dup"]+=1
+            if self.on_new: self.on_new("dup",service,clean)
 
 
 # ─────────────────────────────────────────────────────────────────────
@@ -1179,6 +3477,8 @@ if HAS_QT:
         status_update    = pyqtSignal()
         grid_done        = pyqtSignal(object, object)
         reset_local_btns = pyqtSignal(list)  # 完了したai_nameリスト
+        near_dups        = pyqtSignal(list)  # 近似重複クラスタ [[id,…],…]
+        sem_hits         = pyqtSignal(str,list)  # 意味検索の結果（検索文, [id,…]）
 
 
 # ─────────────────────────────────────────────────────────────────────
@@ -1362,10 +3662,17 @@ class MainWindow(QMainWindow):
         self.sig.status_update.connect(self._update_status)
         self.sig.grid_done.connect(self._on_grid_done_global)
         self.sig.reset_local_btns.connect(self._on_reset_local_btns)
+        self.sig.near_dups.connect(self._on_near_dups)
+        self.sig.sem_hits.connect(self._on_sem_hits)
 
         self._custom_vp=""; self._ai_cards={}; self._attached_files=[]
         self._current_ts=None; self._current_qid=None
-        self._page_current=0; self._page_size=100; self._page_all_msgs=[]
+        self._page_size=100; self._page_msgs=[]; self._page_total=0
+        self._page_anchors=[None]; self._page_query=""   # キーセット：各ページ直前の (detected_at,id)
+        self._view_token=-1; self._item_index={}           # 変更フィードのトークン / id→ツリー項目
+        self._sem_query=None; self._sem_ids=[]; self._sem_go=False   # 意味検索（~）の結果 id 列
+        self._thread_mode=False; self._threads=[]; self._thread_page_size=20   # スレッド表示（質問ごと）
+        self.embedder=Embedder(db)
         self._grid_launcher: GridLauncher = None   # 起動後にセット
         self._pending_launcher=None; self._pending_svcs={}
         self._pending_sw=1920; self._pending_sh=1080
@@ -1375,6 +3682,7 @@ class MainWindow(QMainWindow):
         self._build_ui(); self._load_ai_cards(); self._refresh_viewer()
         self.monitor.on_new=self._monitor_cb
         self._timer=QTimer(); self._timer.timeout.connect(self._refresh_viewer); self._timer.start(2500)
+        self.embedder.start()   # 新しい行をバックグラウンドで埋め込み（意味検索用）
         self._restore_state()   # 起動時に前回状態を復元
         # 初回起動時のみ同意ダイアログ
         QTimer.singleShot(300, self._show_consent_if_first_run)
@@ -1638,11 +3946,13 @@ class MainWindow(QMainWindow):
             "  content=python       → 本文に python を含む\n"
             "  content=!error       → 本文から error を除外\n"
             "  src=cli              → クリップボード由来のみ\n"
-            "  python               → 項目名なし → 本文の部分一致\n\n"
+            "  python               → 項目名なし → 本文の部分一致\n"
+            "  ~言い換えた質問      → 意味検索（Enter で実行）\n\n"
             "例: date=2026-02 service=claude content=python"
         )
         self.search_edit.setStyleSheet("border:1px solid #333; border-radius:3px; padding:2px 6px; background:#202020; color:#e0e0e0; font-size:12px;")
-        self.search_edit.textChanged.connect(self._on_search); sh.addWidget(self.search_edit)
+        self.search_edit.textChanged.connect(self._on_search)
+        self.search_edit.returnPressed.connect(self._on_search_enter); sh.addWidget(self.search_edit)
         # ヘルプボタン
         hb=QPushButton("? Help"); hb.setFixedSize(100,24)
         hb.setToolTip("検索ヘルプ")
@@ -1671,6 +3981,10 @@ class MainWindow(QMainWindow):
                 "  python               → 項目名なし＝本文の部分一致\n\n"
                 "【その他】\n"
                 "  src=cli              → クリップボード由来のみ\n\n"
+                "【意味検索】（Local LLM の埋め込みモデル＋numpy が必要）\n"
+                "  ~リストを並べ替える方法 → 言い回しが違っても意味の近い回答\n"
+                "    入力後 Enter で実行（上位100件・類似度順）\n"
+                "  右クリック →「類似の回答を表示」でも同じ一覧になります\n\n"
                 "【組み合わせ例】\n"
                 "  date=2026-02 service=claude\n"
                 "    → 2月の Claude 発言のみ\n\n"
@@ -1695,6 +4009,11 @@ class MainWindow(QMainWindow):
         ph.addWidget(self._page_prev)
         self._page_label=QLabel("1 / 1  (0件)"); self._page_label.setStyleSheet("color:#666; font-size:11px;")
         ph.addWidget(self._page_label,1)
+        self._thread_cb=QCheckBox("🧵 スレッド表示")
+        self._thread_cb.setToolTip("質問ごとに各AIの回答をまとめて表示（検索条件は使わず、新しい質問から20件ずつ）")
+        self._thread_cb.setStyleSheet("color:#888; font-size:11px;")
+        self._thread_cb.toggled.connect(self._toggle_threads)
+        ph.addWidget(self._thread_cb)
         self._page_next=QPushButton("次 ▶"); self._page_next.setFixedSize(60,22)
         self._page_next.setStyleSheet("border:1px solid #383838; border-radius:3px; background:#222; color:#888; font-size:11px;")
         self._page_next.clicked.connect(self._page_go_next)
@@ -1769,7 +4088,12 @@ class MainWindow(QMainWindow):
     def _build_history_tab(self) -> QWidget:
         w=QWidget(); v=QVBoxLayout(w); v.setContentsMargins(8,8,8,8); v.setSpacing(6)
         self.stats_label=QLabel(); self.stats_label.setStyleSheet("color:#888888; font-size:12px; line-height:1.8;"); self.stats_label.setWordWrap(True); v.addWidget(self.stats_label)
-        rb=QPushButton("統計を更新"); rb.clicked.connect(self._refresh_stats); v.addWidget(rb); v.addStretch()
+        self.metrics_label=QLabel(); self.metrics_label.setStyleSheet("color:#888888; font-size:11px; font-family:monospace;")
+        self.metrics_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse); v.addWidget(self.metrics_label)
+        br=QWidget(); bh=QHBoxLayout(br); bh.setContentsMargins(0,0,0,0); bh.setSpacing(6)
+        rb=QPushButton("統計を更新"); rb.clicked.connect(self._refresh_stats); bh.addWidget(rb)
+        mb=QPushButton("📊  メトリクスを保存…"); mb.setToolTip("カウンタ・ゲージ・レイテンシ分布を JSON に書き出す（リリース間の比較用）")
+        mb.clicked.connect(self._dump_metrics); bh.addWidget(mb); bh.addStretch(); v.addWidget(br); v.addStretch()
         self._refresh_stats(); return w
 
     # ── AI SERVICES タブ ───────────────────────────────────────────────
@@ -1807,9 +4131,10 @@ class MainWindow(QMainWindow):
         db_path_lbl.setStyleSheet("color:#777777; font-size:11px; font-family:monospace;"); dbl.addWidget(db_path_lbl)
 
         # DB初期化ボタン群
-        def _danger_row(label, tooltip, fn):
+        def _danger_row(label, tooltip, fn, danger=True):
             row=QWidget(); rh=QHBoxLayout(row); rh.setContentsMargins(0,0,0,0); rh.setSpacing(8)
-            btn=QPushButton(label); btn.setObjectName("btn_danger"); btn.setFixedWidth(220)
+            btn=QPushButton(label); btn.setFixedWidth(220)
+            if danger: btn.setObjectName("btn_danger")
             btn.setToolTip(tooltip); btn.clicked.connect(fn)
             desc=QLabel(tooltip); desc.setStyleSheet("color:#555555; font-size:11px;"); desc.setWordWrap(True)
             rh.addWidget(btn); rh.addWidget(desc,1); return row
@@ -1824,6 +4149,35 @@ class MainWindow(QMainWindow):
             "messages / sessions / settings を全削除。AI設定も初期化。",
             self._reset_db_full
         ))
+        dbl.addWidget(_danger_row(
+            "🔧  件数カウンタを再集計",
+            "ステータスバー・HISTORY の件数がずれた場合に messages から数え直す。",
+            self._rebuild_counters, danger=False
+        ))
+        dbl.addWidget(_danger_row(
+            "📤  エクスポート…",
+            "VIEWER の検索条件に一致する行を JSONL / CSV（.gz で圧縮）に書き出す。空欄なら全件。",
+            self._export_messages, danger=False
+        ))
+        dbl.addWidget(_danger_row(
+            "📥  インポート…",
+            "エクスポートしたファイルを新しいセッションに取り込む（同じ回答はスキップ）。",
+            self._import_messages, danger=False
+        ))
+        dbl.addWidget(_danger_row(
+            "🔍  近似重複を検出",
+            "空白・表の崩れ・選択範囲の欠けだけが違う回答をまとめて探し、各グループの最古の1件を残して削除できる。",
+            self._scan_near_dups, danger=False
+        ))
+        # 月別アーカイブ（既定は退避しない）
+        arc_row=QWidget(); arc_h=QHBoxLayout(arc_row); arc_h.setContentsMargins(0,0,0,0); arc_h.setSpacing(8)
+        arc_lbl=QLabel("古い月を月別アーカイブへ退避（直近 N か月を残す・0=しない）:"); arc_lbl.setStyleSheet("color:#aaaaaa; font-size:12px;")
+        self._arc_spin=QSpinBox(); self._arc_spin.setRange(0,120); self._arc_spin.setValue(max(self.db._archive_keep(),0))
+        self._arc_spin.setFixedWidth(70)
+        self._arc_spin.setStyleSheet("background:#252525; border:1px solid #383838; border-radius:4px; color:#cccccc; padding:3px 6px;")
+        arc_apply=QPushButton("適用"); arc_apply.setFixedWidth(60); arc_apply.clicked.connect(self._apply_archive)
+        arc_h.addWidget(arc_lbl); arc_h.addWidget(self._arc_spin); arc_h.addWidget(arc_apply); arc_h.addStretch()
+        dbl.addWidget(arc_row)
         sv.addWidget(db_g)
 
         # ── クリップボード設定 ────────────────────────────────────────
@@ -1850,6 +4204,20 @@ class MainWindow(QMainWindow):
         ))
         poll_h.addWidget(poll_lbl); poll_h.addWidget(self._poll_spin); poll_h.addWidget(poll_apply); poll_h.addStretch()
         cbl.addWidget(poll_row)
+
+        # 近似重複（同じ回答の取り直し）の扱い
+        nd_row=QWidget(); nd_h=QHBoxLayout(nd_row); nd_h.setContentsMargins(0,0,0,0); nd_h.setSpacing(8)
+        nd_lbl=QLabel("近似重複の取り込み:"); nd_lbl.setStyleSheet("color:#aaaaaa; font-size:12px;")
+        nd_modes=[("flag","別行で保存し印を付ける"),("merge","既存の回答にまとめる（長いほうを残す・シグネチャが違えば別行）"),("off","判定しない")]
+        self._near_dup_cb=QComboBox()
+        for key,txt in nd_modes: self._near_dup_cb.addItem(txt,key)
+        self._near_dup_cb.setCurrentIndex([k for k,_ in nd_modes].index(self.monitor.near_dup) if self.monitor.near_dup in dict(nd_modes) else 0)
+        def _apply_near_dup(_):
+            self.monitor.near_dup=self._near_dup_cb.currentData(); self.db.set_setting("near_dup",self.monitor.near_dup)
+            self._log(f"⚙️  近似重複の取り込み: {self._near_dup_cb.currentText()}")
+        self._near_dup_cb.currentIndexChanged.connect(_apply_near_dup)
+        nd_h.addWidget(nd_lbl); nd_h.addWidget(self._near_dup_cb); nd_h.addStretch()
+        cbl.addWidget(nd_row)
         sv.addWidget(cb_g)
 
         # ── シグネチャ設定 ────────────────────────────────────────────
@@ -1870,6 +4238,31 @@ class MainWindow(QMainWindow):
         desc.setStyleSheet("color:#555555; font-size:11px;"); desc.setWordWrap(True); sigl.addWidget(desc)
         sv.addWidget(sig_g)
 
+        # ── 意味検索（埋め込み）────────────────────────────────────────
+        sem_g=QGroupBox("SEMANTIC  ─  意味検索"); seml=QVBoxLayout(sem_g); seml.setSpacing(8)
+        sem_row=QWidget(); sem_h=QHBoxLayout(sem_row); sem_h.setContentsMargins(0,0,0,0); sem_h.setSpacing(8)
+        sem_lbl=QLabel("埋め込みに使う Local LLM:"); sem_lbl.setStyleSheet("color:#aaaaaa; font-size:12px;")
+        self._embed_svc=QComboBox()
+        self._embed_svc.addItems([n for n,c in self.db.get_ai_services().items() if c.get("type")=="local"])
+        self._embed_svc.setCurrentText(self.db.get_setting("embed_service","Ollama"))
+        self._embed_model=QLineEdit(self.db.get_setting("embed_model",Embedder.DEFAULT_MODEL))
+        self._embed_model.setFixedWidth(180); self._embed_model.setStyleSheet("font-size:11px; font-family:monospace;")
+        sem_apply=QPushButton("適用"); sem_apply.setFixedWidth(60)
+        def _apply_embed():
+            self.db.set_setting("embed_service",self._embed_svc.currentText())
+            self.db.set_setting("embed_model",self._embed_model.text().strip() or Embedder.DEFAULT_MODEL)
+            self._sem_query=None
+            self._log(f"⚙️  意味検索：{self._embed_svc.currentText()} / {self._embed_model.text().strip()}（未処理分を順次埋め込み）")
+        sem_apply.clicked.connect(_apply_embed)
+        sem_h.addWidget(sem_lbl); sem_h.addWidget(self._embed_svc); sem_h.addWidget(self._embed_model); sem_h.addWidget(sem_apply); sem_h.addStretch()
+        seml.addWidget(sem_row)
+        desc=QLabel("VIEWER で「~質問文」と入力して Enter → 言い回しが違っても意味の近い回答を表示。"
+                    "モデル例: nomic-embed-text（ollama pull nomic-embed-text）。モデルを変えると全件を埋め込み直します。"
+                    "AI SERVICES で有効にした Local LLM のときだけ埋め込みます。"
+                    + ("" if _np is not None else "\n⚠️  pip install numpy で有効になります。"))
+        desc.setStyleSheet("color:#555555; font-size:11px;"); desc.setWordWrap(True); seml.addWidget(desc)
+        sv.addWidget(sem_g)
+
         # ── Unknown自動削除 ───────────────────────────────────────────
         unk_g=QGroupBox("UNKNOWN  ─  終了時処理"); unkl=QVBoxLayout(unk_g); unkl.setSpacing(6)
         self._auto_del_unknown=QCheckBox("終了時に Unknown（ラベルなし）を自動削除する")
@@ -2210,6 +4603,7 @@ class MainWindow(QMainWindow):
                 resp=LocalLLMClient.chat(cfg.get("url",""),cfg.get("endpoint","/v1/chat/completions"),cfg.get("model",""),msgs,timeout=300)
                 print(f"[DEBUG] resp received, length={len(resp)}, preview={resp[:80]}", flush=True)
                 meta={"source":"local_api","model":cfg.get("model","")}
+                # 保存（グループコミット）を待ってから通知しないとビューアが先に再読込して行が出ない
                 self.db.save_message(self.monitor.session_id,"assistant",ai_name,resp,meta,ts)
                 self.sig.local_result.emit(ai_name,resp[:80])
                 self.sig.log_message.emit(f"✓  {ai_name} 応答: {len(resp)}文字")
@@ -2241,85 +4635,192 @@ class MainWindow(QMainWindow):
     # ══════════════════════════════════════════════════════════════════
     # Viewer
     # ══════════════════════════════════════════════════════════════════
+    def _viewer_query(self) -> str:
+        return self.search_edit.text().strip() if hasattr(self,"search_edit") else ""
+
+    def _fetch_page(self) -> list:
+        """現在ページ（アンカー直後の page_size 件）だけをDBから取得"""
+        q=self._viewer_query()
+        if q!=self._page_query:   # 検索条件が変わったら先頭ページへ
+            self._page_query=q; self._page_anchors=[None]
+        if self._thread_mode:
+            while True:
+                self._threads=self.db.get_threads_page(after=self._page_anchors[-1],limit=self._thread_page_size)
+                if self._threads or len(self._page_anchors)==1: break
+                self._page_anchors.pop()
+            return [m for t in self._threads for m in [t["question"]]+t["answers"]]
+        if q.startswith("~"): return self._semantic_page(q[1:].strip())
+        while True:
+            # 本文で検索したときは関連度（bm25）順、条件だけなら新しい順
+            msgs=self.db.get_messages_page(after=self._page_anchors[-1],limit=self._page_size,
+                                           query=q,desc=bool(q),ranked=bool(q))
+            # 削除などで現在ページが空になったら前ページへ戻る
+            if msgs or len(self._page_anchors)==1: return msgs
+            self._page_anchors.pop()
+
+    def _semantic_page(self, text:str) -> list:
+        """
+        ~ 検索：類似度順の上位 page_size 件（1ページのみ）。
+        埋め込みAPIを呼ぶので、入力途中では実行せず Enter で確定したときだけ検索する。
+        検索はワーカースレッドで行い、結果の id は sem_hits で受け取って再描画する（UI を止めない）。
+        「~#id」はその行に似た回答。
+        """
+        if text!=self._sem_query:
+            if not self._sem_go: return []
+            self._sem_go=False; self._sem_query=text; self._sem_ids=[]
+            ref=re.fullmatch(r"#(\d+)",text); k=self._page_size
+            def _worker():
+                try:
+                    hits=self.embedder.similar(int(ref.group(1)),k) if ref else self.embedder.search_text(text,k)
+                except Exception as e:
+                    print(f"[DEBUG] semantic search error: {e}", flush=True); hits=[]
+                self.sig.sem_hits.emit(text,[i for i,_ in hits])
+            threading.Thread(target=_worker,daemon=True).start()
+            self._log(f"🔎  意味検索中… {text[:30]}"); return []
+        rows={m["id"]:m for m in self.db.get_messages_by_ids(self._sem_ids)}
+        return [rows[i] for i in self._sem_ids if i in rows]
+
+    def _on_sem_hits(self, text:str, ids:list):
+        if text!=self._sem_query: return   # 入力し直した後に届いた古い検索の結果
+        self._sem_ids=ids
+        if not ids: self._log("🔎  意味検索：結果なし（埋め込みモデル・Local LLM の設定を確認）")
+        self._force_refresh_viewer()
+
+    def _page_db_query(self) -> str:
+        """DBに渡す検索条件（意味検索は id 指定で読むので条件なし）"""
+        return "" if self._page_query.startswith("~") else self._page_query
+
+    def _toggle_threads(self, on:bool):
+        self._thread_mode=on; self._page_anchors=[None]
+        self.tree.setRootIsDecorated(on)
+        self._force_refresh_viewer()
+
+    def _page_count(self) -> int:
+        if self._thread_mode: return self.db.get_stats()["questions"]
+        if self._page_query.startswith("~"): return len(self._page_msgs)
+        return self.db.count_messages(self._page_query)
+
     def _refresh_viewer(self):
         if not self.monitor.session_id: return
-        q=self.search_edit.text().strip() if hasattr(self,"search_edit") else ""
-        if q:
-            msgs=self.db.search_messages(q)
-        else:
-            msgs=self.db.get_all_messages()
-        # データ変化なし＆複数選択中 → タイマー由来の更新をスキップ
-        if msgs==self._page_all_msgs:
-            if len(self.tree.selectedItems())>1:
-                print("[DEBUG] _refresh_viewer: skipped (multi-select active)", flush=True)
-                return
-            return  # データ変化なければ常にスキップ
-        self._page_all_msgs=msgs
-        self._page_current=0
+        if self._view_token>=0 and self._viewer_query()==self._page_query:
+            # 変更フィードで差分だけ確認（変化がなければDBを読まない）
+            ch=self.db.changes_since(self._view_token)
+            if not ch["reset"]:
+                if not (ch["inserted"] or ch["updated"] or ch["deleted"]): return
+                self._view_token=ch["token"]
+                if not ch["inserted"] and not self._thread_mode:
+                    self._apply_delta(ch); return
+        self._view_token=self.db.change_token()
+        same_q=self._viewer_query()==self._page_query
+        msgs=self._fetch_page()
+        total=len(msgs) if self._page_query.startswith("~") and not self._thread_mode else self._page_count()
+        # データ変化なし → タイマー由来の更新をスキップ（複数選択も保持）
+        # 行は (id, rev) で比べる。検索語が変わるとスニペットが変わるので比較しない
+        if same_q and msgs==self._page_msgs and total==self._page_total:
+            return
+        self._page_msgs=msgs; self._page_total=total
         self._render_page()
 
     def _force_refresh_viewer(self):
         """選択状態を無視して強制再描画（削除・ラベル変更後など）"""
         if not self.monitor.session_id: return
-        q=self.search_edit.text().strip() if hasattr(self,"search_edit") else ""
-        msgs=self.db.search_messages(q) if q else self.db.get_all_messages()
-        self._page_all_msgs=msgs
+        self._view_token=self.db.change_token()
+        self._page_msgs=self._fetch_page()
+        self._page_total=self._page_count()
         self._render_page()
 
+    def _page_update_label(self):
+        total=self._page_total; cur=len(self._page_anchors)-1
+        size=self._thread_page_size if self._thread_mode else self._page_size
+        total_pages=max(1,(total+size-1)//size)
+        self._page_label.setText(f"{cur+1} / {total_pages}  （全{total}{'問' if self._thread_mode else '件'}）")
+        self._page_prev.setEnabled(cur>0)
+        shown=len(self._threads) if self._thread_mode else len(self._page_msgs)
+        self._page_next.setEnabled(shown>=size and cur+1<total_pages)
+
     def _render_page(self):
-        msgs=self._page_all_msgs
-        total=len(msgs)
-        page_size=self._page_size
-        total_pages=max(1,(total+page_size-1)//page_size)
-        self._page_current=max(0,min(self._page_current,total_pages-1))
-        start=self._page_current*page_size
-        end=min(start+page_size,total)
-        page_msgs=msgs[start:end]
-
-        # ページラベル更新
-        self._page_label.setText(f"{self._page_current+1} / {total_pages}  （全{total}件）")
-        self._page_prev.setEnabled(self._page_current>0)
-        self._page_next.setEnabled(self._page_current<total_pages-1)
-
-        self.tree.clear(); svcs=self.db.get_ai_services()
-        for m in page_msgs:
-            meta=json.loads(m.get("metadata","{}") or "{}"); label=meta.get("label","")
-            source=meta.get("source","cb")[:3]; svc=m["service"]
-            t=datetime.fromisoformat(m["detected_at"]).strftime("%m/%d %H:%M:%S")
-            is_question=(label=="question")
-            content_prev=m["content"].replace("\n"," ")[:48]
-            # question行はQUESTION列に内容を表示、ANSWER列は空
-            q_col = content_prev if is_question else ""
-            a_col = "" if is_question else content_prev
-            disp_label = "question" if is_question else label
-            item=QTreeWidgetItem([t,svc,disp_label,q_col,a_col,source])
-            item.setData(0,Qt.ItemDataRole.UserRole,  m["id"])
-            item.setData(0,Qt.ItemDataRole.UserRole+1,m["content"])
-            item.setData(0,Qt.ItemDataRole.UserRole+2,svc)
-            item.setData(0,Qt.ItemDataRole.UserRole+3,m["content"] if is_question else "")
-            item.setData(0,Qt.ItemDataRole.UserRole+4,m.get("ts",""))
-            color="#909090"
-            if svc in svcs: color=svcs[svc].get("color","#c0c0c0")
-            elif svc=="User": color="#94a3b8"
-            if is_question:
-                # question行：やや暗めのブルー系で識別
-                for c in range(6): item.setForeground(c,QColor("#7ab0c8"))
-                item.setForeground(1,QColor("#94a3b8"))
-            elif svc=="Unknown" and not label:
-                for c in range(6): item.setForeground(c,QColor("#666666"))
-            else:
-                item.setForeground(0,QColor("#909090"))
-                item.setForeground(5,QColor("#707070"))
-                item.setForeground(1,QColor(color))
-                item.setForeground(3,QColor("#c8c8c8"))
-                item.setForeground(4,QColor("#b8b8b8"))
-                if label and not is_question: item.setForeground(2,QColor("#fb923c"))
-                else: item.setForeground(2,QColor("#707070"))
+        self._page_update_label()
+        self.tree.clear(); self._item_index={}; svcs=self.db.get_ai_services()
+        if self._thread_mode:
+            # 質問を親・回答を子にしたツリー（回答数は質問行の ANSWER 列に表示）
+            for t in self._threads:
+                q=t["question"]; qi=QTreeWidgetItem(); self._fill_item(qi,q,svcs)
+                qi.setText(4,f"{len(t['answers'])} answers"); self._item_index[q["id"]]=qi
+                for a in t["answers"]:
+                    ai=QTreeWidgetItem(qi); self._fill_item(ai,a,svcs); self._item_index[a["id"]]=ai
+                self.tree.addTopLevelItem(qi); qi.setExpanded(True)
+            self._update_status(); return
+        for m in self._page_msgs:
+            item=QTreeWidgetItem(); self._fill_item(item,m,svcs)
+            self._item_index[m["id"]]=item
             self.tree.addTopLevelItem(item)
         self._update_status()
 
+    def _fill_item(self, item:QTreeWidgetItem, m:dict, svcs:dict):
+        """1行分の表示内容をツリー項目に設定（新規作成・差分更新で共用）"""
+        label=m["label"]; source=m["src"]; svc=m["service"]; t=m["t_disp"]
+        is_question=(label=="question")
+        # 全文検索時は一致箇所のスニペット（【】で強調）を表示
+        content_prev=(m.get("snippet") or m["preview"]).replace("\n"," ")[:48]
+        # question行はQUESTION列に内容を表示、ANSWER列は空
+        q_col = content_prev if is_question else ""
+        a_col = "" if is_question else content_prev
+        disp_label = "question" if is_question else label
+        for c,txt in enumerate([t,svc,disp_label,q_col,a_col,source]): item.setText(c,txt)
+        item.setData(0,Qt.ItemDataRole.UserRole,  m["id"])
+        # 全文は持たない（必要時に _item_content で取得）。UserRole+3 は質問行フラグ
+        item.setData(0,Qt.ItemDataRole.UserRole+2,svc)
+        item.setData(0,Qt.ItemDataRole.UserRole+3,is_question)
+        item.setData(0,Qt.ItemDataRole.UserRole+4,m.get("ts",""))
+        color="#909090"
+        if svc in svcs: color=svcs[svc].get("color","#c0c0c0")
+        elif svc=="User": color="#94a3b8"
+        if is_question:
+            # question行：やや暗めのブルー系で識別
+            for c in range(6): item.setForeground(c,QColor("#7ab0c8"))
+            item.setForeground(1,QColor("#94a3b8"))
+        elif svc=="Unknown" and not label:
+            for c in range(6): item.setForeground(c,QColor("#666666"))
+        else:
+            item.setForeground(0,QColor("#909090"))
+            item.setForeground(5,QColor("#707070"))
+            item.setForeground(1,QColor(color))
+            item.setForeground(3,QColor("#c8c8c8"))
+            item.setForeground(4,QColor("#b8b8b8"))
+            if label and not is_question: item.setForeground(2,QColor("#fb923c"))
+            else: item.setForeground(2,QColor("#707070"))
+
+    def _apply_delta(self, ch:dict):
+        """更新・削除だけの変化 → 現在ページの該当行だけ差し替え（選択状態は維持）"""
+        page_ids={m["id"] for m in self._page_msgs}
+        gone=set(i for i in ch["deleted"] if i in page_ids)
+        upd=[i for i in ch["updated"] if i in page_ids]
+        if upd:
+            fresh={m["id"]:m for m in self.db.get_messages_by_ids(upd,self._page_db_query())}
+            gone|={i for i in upd if i not in fresh}   # 検索条件から外れた行
+            svcs=self.db.get_ai_services()
+            for i,m in fresh.items():
+                item=self._item_index.get(i)
+                if item: self._fill_item(item,m,svcs)
+            self._page_msgs=[fresh.get(m["id"],m) for m in self._page_msgs]
+        if gone: self._remove_items(gone)
+        if ch["deleted"] or gone:
+            self._page_total=self._page_count()
+            self._page_update_label()
+        self._update_status()
+
     def _on_search(self,_):
-        self._page_current=0; self._refresh_viewer()
+        self._page_anchors=[None]; self._refresh_viewer()
+
+    def _on_search_enter(self):
+        if self._viewer_query().startswith("~"):
+            self._sem_go=True; self._sem_query=None; self._force_refresh_viewer()
+
+    def _show_similar(self, msg_id:int):
+        self._sem_go=True; self._sem_query=None
+        q=f"~#{msg_id}"
+        if self._viewer_query()==q: self._force_refresh_viewer()
+        else: self.search_edit.setText(q)
 
     def _on_selection_changed(self):
         items=self.tree.selectedItems()
@@ -2333,10 +4834,19 @@ class MainWindow(QMainWindow):
             self._content_view.setPlainText("")
         # 0件選択時は何もしない
 
+    def _item_content(self, item:QTreeWidgetItem) -> str:
+        """ツリー項目の全文（圧縮本文はここで初めて展開）"""
+        if item is None: return ""
+        return self.db.get_message_content(item.data(0,Qt.ItemDataRole.UserRole))
+
+    def _item_question(self, item:QTreeWidgetItem) -> str:
+        return self._item_content(item) if item.data(0,Qt.ItemDataRole.UserRole+3) else ""
+
     def _show_content(self, item:QTreeWidgetItem):
-        content=item.data(0,Qt.ItemDataRole.UserRole+1)
+        content=self._item_content(item)
         svc    =item.data(0,Qt.ItemDataRole.UserRole+2)
-        q_full =item.data(0,Qt.ItemDataRole.UserRole+3)
+        q_full =content if item.data(0,Qt.ItemDataRole.UserRole+3) else ""
+        if not q_full and item.parent() is not None: q_full=self._item_content(item.parent())   # スレッド表示の回答
         ts_val =item.data(0,Qt.ItemDataRole.UserRole+4)
         label  =item.text(2)
         badge  =svc.upper()
@@ -2351,40 +4861,55 @@ class MainWindow(QMainWindow):
     def _tree_ctx(self, pos):
         item=self.tree.itemAt(pos)
         if not item: return
-        msg_id=item.data(0,Qt.ItemDataRole.UserRole); svc=item.data(0,Qt.ItemDataRole.UserRole+2)
+        msg_id=item.data(0,Qt.ItemDataRole.UserRole)
+        # 選択中の行を右クリック → 選択行すべてが対象（ラベル・サービス名・削除）
+        sel=self.tree.selectedItems()
+        its=sel if item in sel and len(sel)>1 else [item]
+        ids=[it.data(0,Qt.ItemDataRole.UserRole) for it in its]
+        multi=f"（{len(ids)}件）" if len(ids)>1 else ""
+        # ラベル付けは Unknown 行だけ（右クリックした行がどれでも、選択内の Unknown 行に適用）
+        unk=[it for it in its if it.data(0,Qt.ItemDataRole.UserRole+2)=="Unknown"]
+        uids=[it.data(0,Qt.ItemDataRole.UserRole) for it in unk]
+        umulti=f"（{len(uids)}件）" if len(uids)>1 else ""
         menu=QMenu(self)
         def _add(lbl,fn): a=QAction(lbl,self); a.triggered.connect(fn); menu.addAction(a)
-        _add("📋  Copy Answer",lambda: _set_cb(item.data(0,Qt.ItemDataRole.UserRole+1)))
-        _add("📋  Copy Question",lambda: _set_cb(item.data(0,Qt.ItemDataRole.UserRole+3) or ""))
+        _add("📋  Copy Answer",lambda: _set_cb(self._item_content(item)))
+        _add("📋  Copy Question",lambda: _set_cb(self._item_question(item)))
+        _add("🔎  類似の回答を表示",lambda: self._show_similar(msg_id))
         # サービス名変更（全メッセージ対象）
         menu.addSeparator()
-        _add("✏️  サービス名を変更…", lambda: self._rename_service(msg_id, item))
+        _add(f"✏️  サービス名を変更…{multi}", lambda: self._rename_service(ids, item))
         svcs=self.db.get_ai_services()
         locals_=[(n,c) for n,c in svcs.items() if c.get("type")=="local" and c.get("enabled")]
         if locals_:
             menu.addSeparator()
             _add("📄  Generate Summary (Local)",
-                 lambda: self._local_task(item.data(0,Qt.ItemDataRole.UserRole+1),"summary",msg_id))
-        if svc=="Unknown":
+                 lambda: self._local_task(self._item_content(item),"summary",msg_id))
+        if uids:
             menu.addSeparator()
-            lm=menu.addMenu("🏷  Assign Label")
+            lm=menu.addMenu(f"🏷  Assign Label{umulti}")
             for key,disp,_ in ChatDatabase.LABELS:
-                a=QAction(disp,self); a.triggered.connect(lambda c,k=key,i=msg_id,it=item: self._assign_label(i,k,it)); lm.addAction(a)
-            if item.text(2):
-                _add("✕  Remove Label",lambda: self._assign_label(msg_id,None,item))
+                a=QAction(disp,self); a.triggered.connect(lambda c,k=key: self._assign_label(uids,k)); lm.addAction(a)
+            if any(it.text(2) for it in unk):
+                _add(f"✕  Remove Label{umulti}",lambda: self._assign_label(uids,None))
         menu.addSeparator()
-        _add("🗑  Delete",lambda: self._delete_item(msg_id))
+        if len(ids)>1: _add(f"🗑  Delete{multi}",self._bulk_delete)
+        else: _add("🗑  Delete",lambda: self._delete_item(msg_id))
         menu.exec(QCursor.pos())
 
-    def _assign_label(self,msg_id,label,item):
-        self.db.set_label(msg_id,label); item.setText(2,label or "")
-        if label: item.setForeground(2,QColor("#fb923c"))
-        else:
-            for c in range(6): item.setForeground(c,QColor("#3a3a3a"))
+    def _assign_label(self,ids:list,label):
+        self.db.set_labels(ids,label)
+        for i in ids:
+            item=self._item_index.get(i)
+            if not item: continue
+            item.setText(2,label or "")
+            if label: item.setForeground(2,QColor("#fb923c"))
+            else:
+                for c in range(6): item.setForeground(c,QColor("#3a3a3a"))
         self._update_status()
 
-    def _rename_service(self, msg_id:int, item):
-        """サービス名を手動変更するダイアログ"""
+    def _rename_service(self, ids:list, item):
+        """サービス名を手動変更するダイアログ（ids 全件に適用）"""
         svcs = self.db.get_ai_services()
         ai_names = list(svcs.keys()) + ["Unknown"]
         current_svc = item.data(0, Qt.ItemDataRole.UserRole+2) or "Unknown"
@@ -2413,14 +4938,18 @@ class MainWindow(QMainWindow):
 
         if dlg.exec() == QDialog.DialogCode.Accepted:
             new_svc = cb.currentText()
-            self.db.update_service(msg_id, new_svc)
-            item.setText(1, new_svc)  # VIEWERのSERVICE列を即時更新
+            self.db.update_services(ids, new_svc)
             # サービス色を更新
             colors = {"Claude":"#da7756","Gemini":"#4a90d9","Grok":"#c084fc",
                       "ChatGPT":"#74c99a","Unknown":"#3a3a3a"}
             color = colors.get(new_svc, "#aaaaaa")
-            item.setForeground(1, QColor(color))
-            self._log(f"✏️  {current_svc} → {new_svc}（ID:{msg_id}）")
+            for i in ids:
+                it=self._item_index.get(i)
+                if not it: continue
+                it.setText(1, new_svc)  # VIEWERのSERVICE列を即時更新
+                it.setData(0, Qt.ItemDataRole.UserRole+2, new_svc)
+                it.setForeground(1, QColor(color))
+            self._log(f"✏️  {current_svc} → {new_svc}（ID:{','.join(map(str,ids[:5]))}{'…' if len(ids)>5 else ''}）")
 
     def _clear_content_view(self):
         """コンテンツ表示エリアをクリア（削除・初期化時に呼ぶ）"""
@@ -2429,21 +4958,19 @@ class MainWindow(QMainWindow):
         self._q_badge.setText("QUESTION  ·  (質問行を選択)")
         self._q_view.setPlainText("")
 
+    def _remove_items(self, ids):
+        """id→item 索引からツリー項目を外す（ツリー全体の走査なし）"""
+        root=self.tree.invisibleRootItem(); ids=set(ids)
+        for i in ids:
+            it=self._item_index.pop(i,None)
+            if it: (it.parent() or root).removeChild(it)
+        self._page_msgs=[m for m in self._page_msgs if m.get("id") not in ids]
+
     def _delete_item(self,msg_id):
-        # msg_idでツリーを検索（itemの参照は使わない）
-        for i in range(self.tree.topLevelItemCount()):
-            it=self.tree.topLevelItem(i)
-            if it and it.data(0,Qt.ItemDataRole.UserRole)==msg_id:
-                self.tree.takeTopLevelItem(i)
-                break
         self.db.delete_message(msg_id)
-        self._page_all_msgs=[m for m in self._page_all_msgs if m.get("id")!=msg_id]
-        total=len(self._page_all_msgs)
-        total_pages=max(1,(total+self._page_size-1)//self._page_size)
-        self._page_current=min(self._page_current,total_pages-1)
-        self._page_label.setText(f"{self._page_current+1} / {total_pages}  （全{total}件）")
-        self._page_prev.setEnabled(self._page_current>0)
-        self._page_next.setEnabled(self._page_current<total_pages-1)
+        self._remove_items([msg_id])
+        self._page_total=max(0,self._page_total-1)
+        self._page_update_label()
         self._clear_content_view()
         self._update_status()
 
@@ -2457,19 +4984,10 @@ class MainWindow(QMainWindow):
         if ans!=QMessageBox.StandardButton.Yes: return
         # msg_idを先に収集（itemは削除で無効になるので参照しない）
         ids=[it.data(0,Qt.ItemDataRole.UserRole) for it in items]
-        for msg_id in ids:
-            self.db.delete_message(msg_id)
-            for i in range(self.tree.topLevelItemCount()-1,-1,-1):
-                it=self.tree.topLevelItem(i)
-                if it and it.data(0,Qt.ItemDataRole.UserRole)==msg_id:
-                    self.tree.takeTopLevelItem(i); break
-        self._page_all_msgs=[m for m in self._page_all_msgs if m.get("id") not in ids]
-        total=len(self._page_all_msgs)
-        total_pages=max(1,(total+self._page_size-1)//self._page_size)
-        self._page_current=min(self._page_current,total_pages-1)
-        self._page_label.setText(f"{self._page_current+1} / {total_pages}  （全{total}件）")
-        self._page_prev.setEnabled(self._page_current>0)
-        self._page_next.setEnabled(self._page_current<total_pages-1)
+        n=self.db.delete_messages(ids)
+        self._remove_items(ids)
+        self._page_total=max(0,self._page_total-n)
+        self._page_update_label()
         self._log(f"🗑  {len(ids)}件 一括削除")
         self._clear_content_view(); self._update_status()
 
@@ -2496,10 +5014,11 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self,"選択不足",
                 "2件以上の行を選択してください。\n（Ctrl+クリック または Shift+クリック）"); return
 
+        texts=self.db.get_message_contents([it.data(0,Qt.ItemDataRole.UserRole) for it in items])
         parts=[]
         for it in items:
             svc=it.data(0,Qt.ItemDataRole.UserRole+2) or it.text(1)
-            content=it.data(0,Qt.ItemDataRole.UserRole+1) or ""
+            content=texts.get(it.data(0,Qt.ItemDataRole.UserRole),"")
             parts.append(f"[{svc}]\n{content}")
         combined="\n\n---\n\n".join(parts)
 
@@ -2614,10 +5133,11 @@ class MainWindow(QMainWindow):
             return
 
         # 選択行から会話内容を収集
+        texts=self.db.get_message_contents([it.data(0,Qt.ItemDataRole.UserRole) for it in sel])
         parts=[]
         for it in sel:
             svc=it.data(0,Qt.ItemDataRole.UserRole+2) or it.text(1)
-            content=it.data(0,Qt.ItemDataRole.UserRole+1) or ""
+            content=texts.get(it.data(0,Qt.ItemDataRole.UserRole),"")
             label=it.text(2)
             parts.append(f"[{svc}]{f'({label})' if label else ''}\n{content}")
         combined="\n\n---\n\n".join(parts)
@@ -2840,23 +5360,53 @@ class MainWindow(QMainWindow):
         lines=[f"総メッセージ     : {s['total']}",f"処理対象         : {s['active']}",
                f"Unknown(ラベルなし): {s['unknown_unlabeled']}",f"保存質問数       : {s['questions']}","","── サービス別 ──"]
         lines+=[f"  {k} : {v}" for k,v in s["by_service"].items()]
+        m=self.monitor.stats
+        lines+=["","── 取り込み ──",
+                f"  検出 {m['detected']} / 保存 {m['saved']} / 重複 {m['dup']} / 破棄 {m['dropped']}"
+                f"  （待ち {m['queued']}件・最大 {m['queue_peak']}件）",
+                f"  読み取り {m['read_ms']}ms  キュー待ち {m['wait_ms']}ms  分類＋保存 {m['process_ms']}ms"]
+        cs=self.db.cache_stats()
+        lines+=["","── 検索キャッシュ ──",
+                f"  ヒット率 : {cs['rate']:.0%}（{cs['hits']} / {cs['hits']+cs['misses']}）  保持 {cs['size']}件"]
         self.stats_label.setText("\n".join(lines))
+        snap=metrics.snapshot()
+        ml=["── レイテンシ（ms） ──",f"  {'name':<18}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+        ml+=[f"  {k:<18}{h['count']:>7}{h['p50']:>10}{h['p95']:>10}{h['p99']:>10}{h['max_ms']:>10}"
+             for k,h in snap["histograms"].items()]
+        if snap["counters"]: ml+=["","  "+"  ".join(f"{k}={v}" for k,v in sorted(snap["counters"].items()))]
+        self.metrics_label.setText("\n".join(ml))
+
+    def _dump_metrics(self):
+        from PyQt6.QtWidgets import QFileDialog
+        p,_=QFileDialog.getSaveFileName(self,"メトリクスを保存",f"metrics_{datetime.now():%Y%m%d_%H%M}.json","JSON (*.json)")
+        if not p: return
+        try: metrics.dump(p); self._log(f"📊  メトリクスを書き出しました → {p}")
+        except Exception as e: self._log(f"❌  メトリクス保存失敗: {e}")
 
     def _monitor_cb(self,event,svc,text):
+        """取り込みワーカーからの結果通知（保存・まとめ・重複・機密）。ログとビューア更新はここだけで行う"""
         if event=="sensitive":
             self.sig.log_message.emit(f"🔒  機密っぽい文字列を検出 → 保存スキップ（APIキー/トークン系）")
+        elif event=="dup":
+            self.sig.log_message.emit(f"＝  {svc}  ·  保存済みと同じ内容 → スキップ")
+        elif event=="merged":
+            self.sig.new_message.emit(svc,"🔗 近似重複 → 既存の回答を長いほうの本文に更新")
         else:
             self.sig.new_message.emit(svc,text[:50])
     def _on_new_message(self,svc,prev): self._force_refresh_viewer(); self._log(f"{'✓' if svc!='Unknown' else '?'}  {svc}  ·  {prev}")
     def _on_local_result(self,svc,prev): self._force_refresh_viewer(); self._log(f"⚡  {svc}  ·  {prev}")
 
     def _page_go_prev(self):
-        self._page_current=max(0,self._page_current-1); self._render_page()
+        if len(self._page_anchors)>1:
+            self._page_anchors.pop(); self._force_refresh_viewer()
 
     def _page_go_next(self):
-        total=len(self._page_all_msgs)
-        total_pages=max(1,(total+self._page_size-1)//self._page_size)
-        self._page_current=min(total_pages-1,self._page_current+1); self._render_page()
+        if self._thread_mode:
+            if len(self._threads)<self._thread_page_size: return
+            last=self._threads[-1]["question"]
+            self._page_anchors.append((last["detected_at"],last["id"])); self._force_refresh_viewer(); return
+        if len(self._page_msgs)<self._page_size: return
+        self._page_anchors.append(ChatDatabase.page_key(self._page_msgs[-1])); self._force_refresh_viewer()
 
     def _on_reset_local_btns(self, names:list):
         for ai_name in names:
@@ -3079,31 +5629,77 @@ class MainWindow(QMainWindow):
         dlg.setStandardButtons(QMessageBox.StandardButton.Yes|QMessageBox.StandardButton.Cancel)
         dlg.setStyleSheet(STYLE)
         if dlg.exec()!=QMessageBox.StandardButton.Yes: return
-        with self.db._lock:
-            self.db._conn.executescript("""
-                DELETE FROM messages;
-                DELETE FROM sessions;
-            """)
-            self.db._conn.commit()
+        self.db.reset()
         self.monitor.start_session()
         self._force_refresh_viewer(); self._clear_content_view(); self._refresh_stats(); self._update_status()
         self._log("🗑  セッションメッセージを全削除しました")
 
+    def _rebuild_counters(self):
+        self.db.rebuild_counters()
+        self._refresh_stats(); self._update_status()
+        self._log("🔧  件数カウンタを再集計しました")
+
+    def _apply_archive(self):
+        keep=self._arc_spin.value(); self.db.set_setting("archive_months",keep)
+        if keep<=0: self._log("⚙️  月別アーカイブ：退避しない"); return
+        self._log(f"🗄  直近{keep}か月より古い行を月別アーカイブへ退避中…（以後は起動時に自動）")
+        def _worker():
+            try: self.sig.log_message.emit(f"🗄  {self.db.archive_old(keep)}件を月別アーカイブへ退避しました")
+            except Exception as e: self.sig.log_message.emit(f"❌  退避失敗: {e}")
+        threading.Thread(target=_worker,daemon=True).start()
+
+    def _export_messages(self):
+        from PyQt6.QtWidgets import QFileDialog
+        q=self._page_db_query()
+        p,_=QFileDialog.getSaveFileName(self,"エクスポート",f"chat_rotator_{datetime.now():%Y%m%d}.jsonl.gz",
+                                        "JSONL (*.jsonl.gz *.jsonl);;CSV (*.csv.gz *.csv)")
+        if not p: return
+        self._log(f"📤  エクスポート中… {os.path.basename(p)}"+(f"（{q}）" if q else ""))
+        def _worker():
+            try: self.sig.log_message.emit(f"📤  {self.db.export_messages(p,q)}件を書き出しました → {p}")
+            except Exception as e: self.sig.log_message.emit(f"❌  エクスポート失敗: {e}")
+        threading.Thread(target=_worker,daemon=True).start()
+
+    def _import_messages(self):
+        from PyQt6.QtWidgets import QFileDialog
+        p,_=QFileDialog.getOpenFileName(self,"インポート","","エクスポートファイル (*.jsonl.gz *.jsonl *.csv.gz *.csv)")
+        if not p: return
+        self._log(f"📥  インポート中… {os.path.basename(p)}")
+        def _worker():
+            try:
+                read,added=self.db.import_messages(p)
+                self.sig.log_message.emit(f"📥  {added}件を取り込みました（{read-added}件は重複でスキップ）")
+                self.sig.status_update.emit()
+            except Exception as e: self.sig.log_message.emit(f"❌  インポート失敗: {e}")
+        threading.Thread(target=_worker,daemon=True).start()
+
+    def _scan_near_dups(self):
+        self._log("🔍  近似重複を検出中…（バックグラウンド）")
+        def _worker():
+            try: self.sig.near_dups.emit(self.db.near_duplicate_clusters())
+            except Exception as e: self.sig.log_message.emit(f"❌  近似重複の検出に失敗: {e}")
+        threading.Thread(target=_worker,daemon=True).start()
+
+    def _on_near_dups(self, clusters:list):
+        extra=[i for g in clusters for i in g[1:]]   # 各グループの先頭（最古）を残す
+        if not extra: self._log("🔍  近似重複は見つかりませんでした"); return
+        dlg=QMessageBox(self); dlg.setWindowTitle("近似重複")
+        dlg.setText(f"{len(clusters)} グループ・{len(extra)} 件の近似重複が見つかりました。\n"
+                    "各グループの最も古い1件を残して削除しますか？")
+        dlg.setStandardButtons(QMessageBox.StandardButton.Yes|QMessageBox.StandardButton.Cancel)
+        dlg.setStyleSheet(STYLE)
+        if dlg.exec()!=QMessageBox.StandardButton.Yes: return
+        n=self.db.delete_messages(extra)
+        self._remove_items(extra); self._force_refresh_viewer(); self._refresh_stats(); self._update_status()
+        self._log(f"🗑  近似重複 {n}件を削除しました")
+
     def _reset_db_full(self):
         dlg=QMessageBox(self); dlg.setWindowTitle("⚠️  DB完全初期化")
         dlg.setText("messages / sessions / settings を全削除し、\nAI設定もデフォルトに戻します。\n\n本当に実行しますか？この操作は取り消せません。")
         dlg.setStandardButtons(QMessageBox.StandardButton.Yes|QMessageBox.StandardButton.Cancel)
         dlg.setStyleSheet(STYLE)
         if dlg.exec()!=QMessageBox.StandardButton.Yes: return
-        with self.db._lock:
-            self.db._conn.executescript("""
-                DELETE FROM messages;
-                DELETE FROM sessions;
-                DELETE FROM settings;
-                DELETE FROM ai_services;
-            """)
-            self.db._conn.commit()
-        self.db._init_ai_services()
+        self.db.reset(full=True)
         self.monitor.start_session()
         self._reload_ai_svc_tree(); self._load_ai_cards()
         self._force_refresh_viewer(); self._clear_content_view(); self._refresh_stats(); self._update_status()
@@ -3164,10 +5760,10 @@ class MainWindow(QMainWindow):
         hint = getattr(self, '_last_copied_ai', "")
         captured=self.monitor.capture_once(hint_ai=hint)
         if captured:
-            msg = f"📥  クリップボードを取り込みました"
+            # ここではキューに積んだだけ。保存・重複・機密の結果は _monitor_cb が記録し、保存時にビューアを更新する
+            msg = f"📥  クリップボードを取り込みキューに追加"
             if hint: msg += f"  （AI候補: {hint}）"
             self._log(msg)
-            self._force_refresh_viewer()
         else:
             self._log("⚠️  変化なし（前回と同じ内容）")
 
@@ -3286,7 +5882,9 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self,event):
         self._save_state()   # 状態保存
-        self.monitor.stop()
+        self.monitor.stop(); self.embedder.stop()
+        self.monitor.drain() # 取り込み待ちを分類・保存してから
+        self.db.flush()      # キュー済みの書き込みを確定
         if self._grid_launcher:
             self._grid_launcher.terminate_all()
         cnt=self.db.count_unknown(self.monitor.session_id)
@@ -3298,7 +5896,8 @@ class MainWindow(QMainWindow):
             dlg=QMessageBox(self); dlg.setWindowTitle("Exit"); dlg.setText(f"Unknown {cnt}件 を削除して終了しますか？")
             dlg.setStandardButtons(QMessageBox.StandardButton.Yes|QMessageBox.StandardButton.No|QMessageBox.StandardButton.Cancel); dlg.setStyleSheet(STYLE)
             r=dlg.exec()
-            if r==QMessageBox.StandardButton.Cancel: self.monitor.start(); event.ignore(); return
+            if r==QMessageBox.StandardButton.Cancel:   # 終了取りやめ → 止めたスレッドを再開
+                self.monitor.start(); self.embedder.start(); event.ignore(); return
             if r==QMessageBox.StandardButton.Yes: self.db.delete_unknown(self.monitor.session_id)
         event.accept()
 
@@ -3306,12 +5905,50 @@ class MainWindow(QMainWindow):
 # ─────────────────────────────────────────────────────────────────────
 # エントリポイント
 # ─────────────────────────────────────────────────────────────────────
+def _cli(argv:list) -> int:
+    """コマンドライン（GUIなし）: export / import / bench"""
+    import argparse
+    ap=argparse.ArgumentParser(prog="chat_rotator",description="RogoAI Chat Rotator（引数なしで GUI 起動）")
+    ap.add_argument("--db",default="chat_rotator.db",help="DBファイル（既定: chat_rotator.db）")
+    sub=ap.add_subparsers(dest="cmd",required=True)
+    ex=sub.add_parser("export",help="メッセージを JSONL / CSV に書き出す（.gz で gzip 圧縮）")
+    ex.add_argument("path",help="出力先（例: backup.jsonl.gz / backup.csv.gz）")
+    ex.add_argument("-q","--query",default="",help="検索構文（例: \"service=claude date=2026-02\"）")
+    im=sub.add_parser("import",help="export の出力を取り込む（重複はスキップ）")
+    im.add_argument("path",help="入力ファイル（.jsonl / .csv、.gz 可）")
+    im.add_argument("--session",default=None,help="取り込み先セッション名")
+    be=sub.add_parser("bench",help="取り込み分類のベンチマーク（従来処理との比較・DB は使わない）")
+    be.add_argument("--size",type=int,default=200,help="1件の大きさ（KB、既定: 200）")
+    be.add_argument("--rounds",type=int,default=5,help="繰り返し回数（既定: 5）")
+    be.add_argument("--metrics",default=None,help="計測したメトリクスを JSON に書き出す（リリース間の比較用）")
+    a=ap.parse_args(argv)
+    if a.cmd=="bench":
+        rows=CaptureClassifier.bench(a.size,a.rounds)
+        print(f"{'case':<10} {'KB':>5} {'legacy ms':>10} {'classifier ms':>14}  same")
+        for r in rows:
+            print(f"{r['case']:<10} {r['kb']:>5} {r['legacy_ms']:>10} {r['classifier_ms']:>14}  {r['same']}")
+        if a.metrics: metrics.dump(a.metrics); print(f"metrics → {a.metrics}")
+        return 0 if all(r["same"] for r in rows) else 1
+    db=ChatDatabase(a.db,auto_archive=False)   # CLI では退避しない（export / import だけを行う）
+    try:
+        if a.cmd=="export":
+            print(f"exported {db.export_messages(a.path,a.query)} rows → {a.path}")
+        elif a.cmd=="import":
+            read,added=db.import_messages(a.path,a.session)
+            print(f"imported {added}/{read} rows (duplicates skipped: {read-added})")
+    finally:
+        db.close()
+    return 0
+
 def main():
+    if len(sys.argv)>1: sys.exit(_cli(sys.argv[1:]))
     if not HAS_QT:   print("[❌] pip install PyQt6"); sys.exit(1)
     if not _init_cb():print("[❌] pip install pyperclip"); sys.exit(1)
-    db=ChatDatabase("chat_rotator.db"); monitor=ClipboardMonitor(db,poll=0.8)
-    monitor.start_session(); monitor.start()
+    db=ChatDatabase("chat_rotator.db",group_commit=True); monitor=ClipboardMonitor(db,poll=0.8)
     app=QApplication(sys.argv); app.setApplicationName("RogoAI Chat Rotator")
+    # GUI 版は Qt のクリップボード（変化通知で読む）。通知が来ない環境は pyperclip / tkinter でポーリング
+    if app.platformName() in QtClipboardBackend.NOTIFY_PLATFORMS: _use_cb(QtClipboardBackend(app.clipboard()))
+    monitor.start_session(); monitor.start()
 
     # アイコン設定（exe化後もリソースを正しく参照）
     def _resource(rel):
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0,str(Path(__file__).resolve().parents[1]/"src"))
+
+import chat_rotator_v3_7f as cr
+
+
+@pytest.fixture
+def db(tmp_path):
+    d=cr.ChatDatabase(str(tmp_path/"chat.db"))
+    yield d
+    d.close()
+
+
+@pytest.fixture
+def words():
+    import random
+    rnd=random.Random(1); vocab=[f"w{i}x" for i in range(3000)]
+    return lambda n: " ".join(rnd.choice(vocab) for _ in range(n))
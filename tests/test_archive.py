@@ -0,0 +1,76 @@
+import sqlite3
+
+import chat_rotator_v3_7f as cr
+
+
+def _thread(db, q_month="2024-03"):
+    sid=db.get_or_create_session()
+    qid=db.save_question(sid,"2024-03-10 12:00:00","what is archiving?")
+    for i in range(3):
+        db.save_message(sid,"assistant",f"AI{i}",f"answer {i}",{},"2024-03-10 12:00:00")
+    with db._lock:
+        db._conn.execute("UPDATE messages SET detected_at=? WHERE id=?",(f"{q_month}-10T12:00:00",qid))
+        db._conn.commit()
+    return qid
+
+
+def test_archiving_question_keeps_answer_links(db):
+    qid=_thread(db)
+    assert len(db.get_thread(qid)["answers"])==3
+    assert db.archive_old(keep_months=1)==1
+    linked=db._reader().execute("SELECT COUNT(*) FROM messages WHERE question_id=?",(qid,)).fetchone()[0]
+    assert linked==3
+    assert not db._reader().execute("SELECT 1 FROM settings WHERE key=?",(db.ARCHIVING_KEY,)).fetchone()
+
+
+def test_archive_copy_keeps_question_id_and_rev(db):
+    sid=db.get_or_create_session()
+    qid=db.save_question(sid,"2024-03-10 12:00:00","old question")
+    db.save_message(sid,"assistant","Claude","old answer",{},"2024-03-10 12:00:00")
+    db.set_label(2,"memo")
+    with db._lock:
+        db._conn.execute("UPDATE messages SET detected_at='2024-03-10T12:00:00'"); db._conn.commit()
+    rev=db._reader().execute("SELECT rev FROM messages WHERE id=2").fetchone()[0]
+    assert db.archive_old(keep_months=1)==2
+    arc=sqlite3.connect(db._archive_path("2024-03"))
+    try:
+        assert arc.execute("SELECT question_id,rev FROM messages WHERE id=2").fetchone()==(qid,rev)
+    finally:
+        arc.close()
+
+
+def test_deleting_question_still_unlinks(db):
+    qid=_thread(db,q_month="2099-01")
+    db.delete_messages([qid])
+    assert db._reader().execute("SELECT COUNT(*) FROM messages WHERE question_id=?",(qid,)).fetchone()[0]==0
+
+
+def _old_rows(db, n, month="2024-03"):
+    sid=db.get_or_create_session()
+    for i in range(n): db.save_message(sid,"assistant","Claude",f"archived answer 紫陽花 {i}",{})
+    with db._lock:
+        db._conn.execute("UPDATE messages SET detected_at=?",(f"{month}-10T12:00:00",)); db._conn.commit()
+
+
+def test_archiving_is_opt_in(tmp_path):
+    path=str(tmp_path/"chat.db")
+    db=cr.ChatDatabase(path); _old_rows(db,3)
+    assert not db._archive_due() and db.archive_old()==0
+    db.set_setting("archive_months",1)
+    assert db._archive_due(); db.close()
+    cli=cr.ChatDatabase(path,auto_archive=False)
+    try:
+        assert cli._reader().execute("SELECT COUNT(*) FROM messages").fetchone()[0]==3
+    finally:
+        cli.close()
+
+
+def test_archive_in_chunks(db, monkeypatch):
+    monkeypatch.setattr(db,"ARCHIVE_CHUNK",2)
+    commits=[]; orig=db._commit
+    monkeypatch.setattr(db,"_commit",lambda: (commits.append(1),orig()))
+    _old_rows(db,7)
+    assert db.archive_old(keep_months=1)==7
+    assert len(commits)>=8   # コピー4回＋削除4回（ロックはチャンクごとに離す）
+    assert db._reader().execute("SELECT COUNT(*) FROM messages").fetchone()[0]==0
+    assert len(db.search_messages("紫陽花 date=2024-03"))==7
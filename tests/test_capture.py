@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import chat_rotator_v3_7f as cr
+
+
+class CountingBackend(cr.MemoryBackend):
+    """読み取り回数を数える MemoryBackend（通知だけで本文を読んでいないかの確認用）"""
+    def __init__(self):
+        super().__init__(); self.reads=0
+    def read(self) -> str:
+        self.reads+=1; return super().read()
+
+
+@pytest.fixture
+def clip():
+    old=cr._cb; b=CountingBackend(); cr._use_cb(b)
+    yield b
+    cr._use_cb(old)
+
+
+def _monitor(db, manual):
+    m=cr.ClipboardMonitor(db,poll=0.05); m.manual_mode=manual
+    m.session_id=db.get_or_create_session(); m.start()
+    return m
+
+
+def _wait(cond, timeout=2.0):
+    end=time.time()+timeout
+    while not cond() and time.time()<end: time.sleep(0.01)
+    return cond()
+
+
+def test_watch_captures_headless(db, clip):
+    m=_monitor(db,False)
+    try:
+        clip.write("I'm Claude, made by Anthropic. Here is the first answer.")
+        assert _wait(lambda: m.stats["saved"]==1) and m.drain()
+        clip.write("I'm Claude, made by Anthropic. Here is the first answer.")   # 同じ内容は取り込まない
+        clip.write("As an AI language model by OpenAI, here is a second answer.")
+        assert _wait(lambda: m.stats["saved"]==2) and m.drain()
+        assert sorted(r["service"] for r in db.get_all_messages())==["ChatGPT","Claude"]
+    finally: m.stop()
+
+
+def test_manual_mode_does_not_read_on_change(db, clip):
+    m=_monitor(db,True)
+    try:
+        for i in range(5): clip.write(f"I'm Claude, made by Anthropic. copied text number {i}")
+        time.sleep(0.2)
+        assert clip.reads==0 and m.stats["detected"]==0
+        assert m.capture_once("Claude") and m.drain()   # 手動取り込みはそのとき1回だけ読む
+        assert clip.reads==1 and m.stats["saved"]==1
+    finally: m.stop()
+
+
+def test_manual_capture_reports_outcome_from_worker(db, clip):
+    events=[]
+    m=_monitor(db,True); m.on_new=lambda ev,svc,text: events.append((ev,svc))
+    try:
+        clip.write("I'm Claude, made by Anthropic. Here is the manual answer.")
+        assert m.capture_once("Claude")   # キューに積んだだけ
+        assert m.capture_once("Gemini") and m.drain()   # 同じ本文（AI候補だけ違う）→ ワーカーで重複
+        clip.write("my key sk-"+"a"*30+" copied by mistake")
+        assert m.capture_once() and m.drain()
+        assert [e for e,_ in events]==["saved","dup","sensitive"] and m.stats["saved"]==1
+    finally: m.stop()
+
+
+def test_full_queue_drops_and_counts(db, clip, monkeypatch):
+    import threading
+    monkeypatch.setattr(cr.ClipboardMonitor,"QUEUE_MAX",3)
+    monkeypatch.setattr(cr.ClipboardMonitor,"QUEUE_WAIT",0.01)
+    cr.metrics.reset()
+    gate=threading.Event(); done=[]
+    m=_monitor(db,True)
+    monkeypatch.setattr(m,"_process",lambda text,hint_ai="": (gate.wait(5),done.append(text)))
+    try:
+        texts=[f"copied text number {i}" for i in range(6)]
+        clip.write(texts[0]); assert m.capture_once()
+        assert _wait(lambda: m._cq.qsize()==0)   # 1件目はワーカーが持ったまま止まる
+        for t in texts[1:4]:
+            clip.write(t); assert m.capture_once()
+        for t in texts[4:]:
+            clip.write(t); assert not m.capture_once()   # 満杯 → 待ってから破棄
+        assert m.stats["dropped"]==2 and m.stats["queue_peak"]==3 and m.stats["queued"]==3
+        assert m._last_key is None   # 破棄した内容は次回また取り込める
+        assert cr.metrics.snapshot()["counters"]["capture.dropped"]==2
+        gate.set(); assert m.drain()
+        assert done==texts[:4] and m.stats["queued"]==0
+        assert m.stats["read_ms"]>0 and m.stats["wait_ms"]>0 and m.stats["process_ms"]>0
+        h=cr.metrics.snapshot()["histograms"]
+        assert h["capture.read"]["count"]==6 and h["capture.wait"]["count"]==h["capture.process"]["count"]==4
+    finally: gate.set(); m.stop()
@@ -0,0 +1,46 @@
+def _expected(db):
+    """message_counters を使わずに messages から直接集計した get_stats 相当の値"""
+    q=lambda sql: db._reader().execute(sql).fetchone()[0]
+    total=q("SELECT COUNT(*) FROM messages")
+    unknown=q("SELECT COUNT(*) FROM messages WHERE service='Unknown' AND IFNULL(label,'')=''")
+    by=dict(db._reader().execute("SELECT service,COUNT(*) FROM messages WHERE label IS NOT 'question'"
+                                 " GROUP BY service").fetchall())
+    return {"total":total,"active":total-unknown,"unknown_unlabeled":unknown,
+            "questions":q("SELECT COUNT(*) FROM messages WHERE label='question'"),"by_service":by}
+
+
+def _check(db):
+    got=db.get_stats(); want=_expected(db)
+    assert {**got,"by_service":dict(sorted(got["by_service"].items()))}=={**want,"by_service":dict(sorted(want["by_service"].items()))}
+    return got
+
+
+def test_counters_follow_every_write(db):
+    sid=db.get_or_create_session(); _check(db)
+    qid=db.save_question(sid,"2024-03-10 12:00:00","an old question")
+    for i in range(4): db.save_message(sid,"assistant","Unknown",f"unknown text {i}")
+    for i in range(3): db.save_message(sid,"assistant","Claude",f"claude answer {i}",{},"2024-03-10 12:00:00")
+    db.save_message(sid,"assistant","Gemini","gemini answer")
+    s=_check(db)
+    assert s["total"]==9 and s["questions"]==1 and s["unknown_unlabeled"]==4
+    db.set_labels([2,3],"memo"); _check(db)                   # ラベル付与で Unknown(ラベルなし) から外れる
+    db.set_label(3,None); _check(db)                          # ラベル解除で戻る
+    db.update_services([4],"Claude"); _check(db)              # サービス名の変更
+    db.set_labels([qid],None); _check(db)                     # 質問 → 通常の行
+    db.set_labels([qid],"question"); _check(db)
+    db.delete_messages([5]); _check(db)
+    db.delete_unknown(sid); _check(db)
+    with db._lock:   # 質問と Claude の回答を古い月へ
+        db._conn.execute("UPDATE messages SET detected_at='2024-03-10T12:00:00' WHERE id IN (?,6,7)",(qid,)); db._commit()
+    assert db.archive_old(keep_months=1)==3
+    s=_check(db)
+    assert s["questions"]==0 and s["by_service"].get("Claude")==2   # 名前を変えた行＋退避しなかった回答
+
+
+def test_rebuild_matches_triggers(db):
+    sid=db.get_or_create_session()
+    for i in range(5): db.save_message(sid,"assistant",("Claude","Unknown")[i%2],f"row {i}")
+    db.set_labels([2],"memo")
+    before=_check(db)
+    db.rebuild_counters()
+    assert _check(db)==before
@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+
+import pytest
+
+
+def _in_thread(fn):
+    out=[]; t=threading.Thread(target=lambda: out.append(fn())); t.start(); t.join(5)
+    return out[0]
+
+
+def test_wal_mode(db):
+    assert db._wal
+    assert db._conn.execute("PRAGMA journal_mode").fetchone()[0].lower()=="wal"
+
+
+def test_reader_is_per_thread_and_read_only(db):
+    mine=db._reader()
+    other=_in_thread(db._reader)
+    assert mine is db._reader() and other is not mine and other is not db._conn
+    with pytest.raises(sqlite3.OperationalError):
+        mine.execute("INSERT INTO settings(key,value,updated_at) VALUES('x','1','')")
+
+
+def test_reads_do_not_wait_for_open_write(db):
+    count=lambda: db._reader().execute("SELECT COUNT(*) FROM settings WHERE key='x'").fetchone()[0]
+    with db._lock:   # ライターがトランザクションを開いたまま
+        db._conn.execute("INSERT INTO settings(key,value,updated_at) VALUES('x','1','')")
+        assert _in_thread(count)==0   # 待たされず、確定前の行は見えない
+        db._conn.commit()
+    assert _in_thread(count)==1
+
+
+def test_close_closes_every_thread_reader(tmp_path):
+    import chat_rotator_v3_7f as cr
+    d=cr.ChatDatabase(str(tmp_path/"chat.db"))
+    hold=threading.Event(); conns=[]
+    def worker():
+        conns.append(d._reader()); hold.wait(5)
+    ts=[threading.Thread(target=worker) for _ in range(3)]
+    for t in ts: t.start()
+    while len(conns)<3: pass
+    conns.append(d._reader())
+    d.close(); hold.set()
+    for t in ts: t.join(5)
+    for c in conns:
+        with pytest.raises(sqlite3.ProgrammingError): c.execute("SELECT 1")
+
+
+def test_dead_thread_reader_is_closed(db):
+    gone=_in_thread(db._reader)
+    _in_thread(db._reader)   # 次に接続を作るときに終了済みスレッドの分を閉じる
+    with pytest.raises(sqlite3.ProgrammingError): gone.execute("SELECT 1")
+    assert all(rc is not gone for _,rc in db._readers)   # 登録からも外れる
@@ -0,0 +1,52 @@
+import json
+
+import chat_rotator_v3_7f as cr
+
+
+def _aged(db, n_old, n_new, month="2024-03"):
+    sid=db.get_or_create_session()
+    for i in range(n_old+n_new):
+        db.save_message(sid,"assistant","Claude",f"answer number {i}",{"source":"clipboard"})
+    with db._lock:
+        db._conn.execute("UPDATE messages SET detected_at=? WHERE id<=?",(f"{month}-10T12:00:00",n_old))
+        db._conn.commit()
+    assert db.archive_old(keep_months=1)==n_old
+
+
+def _lines(path):
+    with open(path,encoding="utf-8") as f: return [json.loads(l) for l in f if l.strip()]
+
+
+def test_export_without_filter_includes_archives(db, tmp_path):
+    _aged(db,6,1)
+    out=tmp_path/"all.jsonl"
+    assert db.export_messages(str(out))==7
+    assert sorted(r["content"] for r in _lines(out))==sorted(f"answer number {i}" for i in range(7))
+
+
+def test_export_date_filter_uses_matching_archives(db, tmp_path):
+    _aged(db,6,1)
+    assert db.export_messages(str(tmp_path/"old.jsonl"),"date=2024")==6
+    assert db.export_messages(str(tmp_path/"none.jsonl"),"date=2023")==0
+
+
+def test_export_round_trip(db, tmp_path):
+    _aged(db,2,3)
+    out=tmp_path/"b.csv.gz"; db.export_messages(str(out))
+    other=cr.ChatDatabase(str(tmp_path/"other.db"))
+    try:
+        assert other.import_messages(str(out))==(5,5)
+        assert other.import_messages(str(out))==(5,0)
+    finally:
+        other.close()
+
+
+def test_import_bad_metadata_row(db, tmp_path):
+    src=tmp_path/"in.jsonl"
+    rows=[{"service":"Claude","content":"good row","metadata":{"label":"ok"}},
+          {"service":"Claude","content":"broken row","metadata":"{not json"},
+          {"service":"Grok","content":"list row","metadata":"[1,2]"}]
+    src.write_text("\n".join(json.dumps(r) for r in rows),encoding="utf-8")
+    assert db.import_messages(str(src))==(3,3)
+    metas={r["content"]:r.meta for r in db.get_all_messages()}
+    assert metas=={"good row":{"label":"ok"},"broken row":{},"list row":{}}
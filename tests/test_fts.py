@@ -0,0 +1,58 @@
+import sqlite3
+
+import chat_rotator_v3_7f as cr
+
+
+def _ids(db, q):
+    return sorted(r["id"] for r in db.search_messages(q))
+
+
+def test_search_follows_writes(db):
+    sid=db.get_or_create_session()
+    db.save_message(sid,"assistant","Claude","紫陽花の育て方について",{})
+    db.save_message(sid,"assistant","Grok","x"*3000+" compressed 向日葵 body",{})
+    assert _ids(db,"紫陽花")==[1] and _ids(db,"向日葵")==[2]
+    db.delete_messages([1])
+    assert _ids(db,"紫陽花")==[]
+    assert not db._reader().execute("SELECT 1 FROM fts_queue").fetchone()
+
+
+def test_plain_sqlite_can_modify_db(tmp_path):
+    path=str(tmp_path/"chat.db")
+    db=cr.ChatDatabase(path); sid=db.get_or_create_session()
+    db.save_message(sid,"assistant","Claude","first answer about 紫陽花",{})
+    db.save_message(sid,"assistant","Claude","y"*3000+" second answer about 向日葵",{})
+    db.close()
+    # アプリの関数（cr_unpack）を登録しない素の接続で変更できる
+    c=sqlite3.connect(path)
+    c.execute("DELETE FROM messages WHERE id=2")
+    c.execute("UPDATE messages SET content='first answer about 菖蒲園' WHERE id=1")
+    c.execute("INSERT INTO messages(session_id,role,service,content,content_hash,detected_at)"
+              " VALUES(?,'assistant','Grok','external row about 桔梗色','ext-1','2026-01-01T00:00:00')",(sid,))
+    c.commit(); c.execute("DELETE FROM messages"); c.rollback(); c.close()
+    db=cr.ChatDatabase(path)
+    try:
+        assert _ids(db,"向日葵")==[] and _ids(db,"紫陽花")==[]
+        assert _ids(db,"菖蒲園")==[1] and _ids(db,"桔梗色")==[3]
+        assert db._reader().execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH '菖蒲園'").fetchone()[0]==1
+    finally:
+        db.close()
+
+
+def test_viewer_pages_by_relevance(db):
+    sid=db.get_or_create_session()
+    for n in (1,4,2,6,3):   # 紫陽花 の出現回数が多いほど bm25 で上位
+        db.save_message(sid,"assistant","Claude",f"{'紫陽花 '*n}の話 その{n}")
+    db.save_message(sid,"assistant","Claude","薔薇の話")
+    db._fts_ready=True
+    page=lambda **kw: db.get_messages_page(limit=2,query="紫陽花",ranked=True,**kw)
+    seen=[]; key=None
+    while True:
+        rows=page(after=key)
+        if not rows: break
+        seen+=rows; key=db.page_key(rows[-1])
+    assert [r["preview"].count("紫陽花") for r in seen]==[6,4,3,2,1]
+    assert [r["rank"] for r in seen]==sorted(r["rank"] for r in seen) and all("snippet" in r for r in seen)
+    assert [r["id"] for r in page(before=db.page_key(seen[2]))]==[r["id"] for r in seen[:2]]   # 前ページ
+    dated=db.get_messages_page(limit=10,query="service=claude",desc=True,ranked=True)   # 本文条件なし → 新しい順
+    assert [r["id"] for r in dated]==sorted((r["id"] for r in dated),reverse=True) and "rank" not in dated[0]
@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+import chat_rotator_v3_7f as cr
+
+
+@pytest.fixture
+def gdb(tmp_path, monkeypatch):
+    monkeypatch.setattr(cr.ChatDatabase,"GROUP_MAX_WAIT",0.2)   # 1バッチにまとまるよう待ち時間を長めに
+    d=cr.ChatDatabase(str(tmp_path/"chat.db"),group_commit=True)
+    yield d
+    d.close()
+
+
+def _committed(path):
+    """別接続から見える（commit 済みの）メッセージ数"""
+    c=sqlite3.connect(path)
+    try: return c.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally: c.close()
+
+
+def test_queued_writes_visible_after_flush(gdb):
+    sid=gdb.get_or_create_session(); cr.metrics.reset()
+    futs=[gdb.save_message_async(sid,"assistant","Claude",f"answer {i}") for i in range(20)]
+    gdb.flush()
+    assert all(f.done() and f.result() is True for f in futs)
+    assert _committed(gdb.db_path)==20
+    snap=cr.metrics.snapshot()
+    assert snap["counters"]["db.rows"]>=20 and snap["histograms"]["db.commit"]["count"]<20   # まとめて commit
+
+
+def test_duplicate_in_one_batch_rejected_once(gdb):
+    sid=gdb.get_or_create_session()
+    a=gdb.save_message_async(sid,"assistant","Claude","same answer")
+    b=gdb.save_message_async(sid,"assistant","Claude","same answer")
+    c=gdb.save_message_async(sid,"assistant","Gemini","same answer")   # サービスが違えば別行
+    q1=gdb.save_question_async(sid,"2026-01-01 10:00:00","question")
+    q2=gdb.save_question_async(sid,"2026-01-01 10:00:00","question")
+    gdb.flush()
+    assert [a.result(),b.result(),c.result()]==[True,False,True]
+    assert q1.result()==q2.result()   # 重複した質問は既存行の id
+    assert _committed(gdb.db_path)==3
+
+
+def test_close_drains_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(cr.ChatDatabase,"GROUP_MAX_WAIT",5.0)   # close しなければまだ commit されない
+    path=str(tmp_path/"chat.db")
+    d=cr.ChatDatabase(path,group_commit=True); sid=d.get_or_create_session()
+    futs=[d.save_message_async(sid,"assistant","Claude",f"answer {i}") for i in range(10)]
+    d.close()
+    assert all(f.result(0) is True for f in futs) and _committed(path)==10
+
+
+def test_failed_row_does_not_sink_batch(gdb):
+    sid=gdb.get_or_create_session()
+    ok=gdb.save_message_async(sid,"assistant","Claude","fine")
+    bad=gdb._submit(lambda: 1/0)
+    gdb.flush()
+    assert ok.result() is True and isinstance(bad.exception(),ZeroDivisionError)
+    assert _committed(gdb.db_path)==1
@@ -0,0 +1,18 @@
+import chat_rotator_v3_7f as cr
+
+
+def test_quantile_interpolates_within_buckets():
+    m=cr.Metrics()
+    for ms in range(1,101): m.observe("x",ms)   # 1..100ms → バケット境界でちょうど分かれる
+    assert [m.quantile("x",q) for q in (0.5,0.95,0.99,1.0)]==[50.0,95.0,99.0,100.0]
+    assert m.snapshot()["histograms"]["x"]["buckets"]=={"1":1,"2.5":1,"5":3,"10":5,"25":15,"50":25,"100":50}
+
+
+def test_quantile_capped_by_max_and_overflow():
+    m=cr.Metrics()
+    for _ in range(4): m.observe("x",3.0)   # (2.5, 5] のバケットだが最大は3 → 上端を3で打ち切る
+    assert m.quantile("x",0.5)==2.75 and m.quantile("x",1.0)==3.0
+    m.observe("big",200000)   # 最後のバケットより大きい → 上端は最大値
+    assert m.quantile("big",0.5)==160000.0
+    assert m.quantile("none",0.5)==0.0
+
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+import pytest
+
+import chat_rotator_v3_7f as cr
+
+# v3.7f（マイグレーション導入前）の _init_schema が作っていた表。user_version は 0
+BASELINE = """
+    CREATE TABLE sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL, created_at TEXT NOT NULL, updated_at TEXT NOT NULL
+    );
+    CREATE TABLE messages (
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id   INTEGER NOT NULL,
+        ts           TEXT DEFAULT '',
+        role         TEXT NOT NULL,
+        service      TEXT NOT NULL,
+        content      TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        detected_at  TEXT NOT NULL,
+        metadata     TEXT NOT NULL DEFAULT '{}',
+        FOREIGN KEY (session_id) REFERENCES sessions(id)
+    );
+    CREATE TABLE ai_services (name TEXT PRIMARY KEY, config TEXT NOT NULL, updated_at TEXT NOT NULL);
+    CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT, updated_at TEXT);
+    CREATE INDEX idx_msg_hash ON messages(content_hash);
+    CREATE INDEX idx_msg_sess ON messages(session_id,detected_at);
+    CREATE INDEX idx_msg_ts   ON messages(ts);
+"""
+TS="2025-06-01 09:00:00"
+
+
+def _baseline(path, words):
+    """v3.7f 相当の DB：質問1件・回答2件（平文・md5）、既定サービスを1つ書き換え済み"""
+    c=sqlite3.connect(path); c.executescript(BASELINE)
+    c.execute("INSERT INTO sessions(name,created_at,updated_at) VALUES('s','2025-06-01','2025-06-01')")
+    q="紫陽花の育て方を教えて"
+    rows=[("user","User",q,hashlib.md5(f"Q:{TS}:{q[:80]}".encode()).hexdigest(),{"label":"question"})]
+    for svc in ("Claude","Gemini"):
+        body=f"{svc} の回答 紫陽花 "+words(400)
+        rows.append(("assistant",svc,body,hashlib.md5(f"{svc}:{body}".encode()).hexdigest(),{}))
+    for role,svc,body,h,meta in rows:
+        c.execute("INSERT INTO messages(session_id,ts,role,service,content,content_hash,detected_at,metadata)"
+                  " VALUES(1,?,?,?,?,?,?,?)",(TS,role,svc,body,h,"2025-06-01T09:00:00",json.dumps(meta,ensure_ascii=False)))
+    for name,cfg in cr.DEFAULT_AI_SERVICES.items():
+        if name=="Claude": cfg=dict(cfg,url="https://example.invalid/custom")
+        c.execute("INSERT INTO ai_services VALUES(?,?,?)",(name,json.dumps(cfg,ensure_ascii=False),"2025-06-01"))
+    c.commit(); c.close()
+    return [r[2] for r in rows]
+
+
+def _user_version(path):
+    c=sqlite3.connect(path)
+    try: return c.execute("PRAGMA user_version").fetchone()[0]
+    finally: c.close()
+
+
+def test_empty_file_migrates_to_latest(tmp_path):
+    path=str(tmp_path/"new.db")
+    d=cr.ChatDatabase(path)
+    try:
+        assert d.migrate()==[]   # 最新なら何もしない
+        names={r[0] for r in d._conn.execute("SELECT name FROM sqlite_master")}
+        assert {"messages","change_log","simhash","embeddings","fts_queue","messages_fts"}<=names
+        assert set(d.get_ai_services())==set(cr.DEFAULT_AI_SERVICES)
+    finally: d.close()
+    assert _user_version(path)==cr.ChatDatabase.SCHEMA_VERSION
+
+
+def test_baseline_migrates_to_latest(tmp_path, words):
+    path=str(tmp_path/"v37f.db"); bodies=_baseline(path,words)
+    d=cr.ChatDatabase(path)
+    try:
+        rows=sorted(d.get_all_messages(),key=lambda r:r["id"])
+        assert [d.get_message_content(r["id"]) for r in rows]==bodies
+        assert d.get_thread(rows[0]["id"])["answers"]   # ts で回答が質問に紐付く
+        assert d.save_message(1,"assistant","Claude",bodies[1]) is False   # 再ハッシュ後も重複を弾く
+        for _ in range(200):   # 既存行の索引化（バックグラウンド）を待つ
+            if d._fts_ready: break
+            time.sleep(0.01)
+        assert len(d.search_messages("紫陽花"))==3
+        assert d.get_ai_services()["Claude"]["url"]=="https://example.invalid/custom"
+    finally: d.close()
+    assert _user_version(path)==cr.ChatDatabase.SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("stop",range(1,cr.ChatDatabase.SCHEMA_VERSION))
+def test_resume_from_each_version(tmp_path, words, monkeypatch, stop):
+    path=str(tmp_path/"v37f.db"); bodies=_baseline(path,words)
+    monkeypatch.setattr(cr.ChatDatabase,"SCHEMA_VERSION",stop)
+    cr.ChatDatabase(path,auto_archive=False).close()
+    assert _user_version(path)==stop
+    monkeypatch.undo()
+    d=cr.ChatDatabase(path)
+    try:
+        assert d.migrate()==[]
+        rows=sorted(d.get_all_messages(),key=lambda r:r["id"])
+        assert [d.get_message_content(r["id"]) for r in rows]==bodies
+    finally: d.close()
+
+
+def test_failed_step_rolls_back(tmp_path, words, monkeypatch):
+    path=str(tmp_path/"v37f.db"); _baseline(path,words)
+    def boom(self,c):
+        c.execute("CREATE TABLE half_done(x)"); raise RuntimeError("boom")
+    monkeypatch.setattr(cr.ChatDatabase,"_mig_preview",boom)
+    with pytest.raises(RuntimeError): cr.ChatDatabase(path)
+    assert _user_version(path)==2
+    c=sqlite3.connect(path)
+    assert not c.execute("SELECT 1 FROM sqlite_master WHERE name='half_done'").fetchone(); c.close()
+
+
+def test_deleted_default_service_stays_deleted(tmp_path):
+    # 既定サービスの投入はマイグレーション5の1回だけ（v3.7f までは起動のたびに補充していた）
+    path=str(tmp_path/"chat.db")
+    d=cr.ChatDatabase(path); d.delete_ai_service("Claude"); d.close()
+    d=cr.ChatDatabase(path)
+    try: assert "Claude" not in d.get_ai_services()
+    finally: d.close()
@@ -0,0 +1,74 @@
+import chat_rotator_v3_7f as cr
+
+
+def _answer(ts, q, body):
+    return f"{body}\n[AI:Claude][Q:{q}][TS:{ts}]"
+
+
+def _monitor(db, mode=None):
+    m=cr.ClipboardMonitor(db)
+    if mode: m.near_dup=mode
+    m.session_id=db.get_or_create_session()
+    return m
+
+
+def test_default_mode_is_flag(db):
+    assert _monitor(db).near_dup=="flag"
+
+
+def test_flag_keeps_both_rows(db, words):
+    m=_monitor(db); body=words(600)
+    m._process(body,hint_ai="Claude"); m._process(body+" one more sentence.",hint_ai="Claude")
+    rows=sorted(db.get_all_messages(),key=lambda r:r["id"])
+    assert len(rows)==2 and rows[1].meta.get("near_dup_of")==rows[0]["id"]
+
+
+def test_merge_never_crosses_questions(db, words):
+    sid=db.get_or_create_session(); m=_monitor(db,"merge"); body=words(600)
+    q1=db.save_question(sid,"2026-01-01 10:00:00","first question")
+    q2=db.save_question(sid,"2026-01-01 11:00:00","second question")
+    m._process(_answer("2026-01-01 10:00:00","first",body))
+    changed=body.replace(body.split()[3],"alpha",1).replace(body.split()[9],"beta",1)+" And one more sentence."
+    assert db.find_near_duplicate(changed,"Claude")   # 近似重複として見つかる前提
+    m._process(_answer("2026-01-01 11:00:00","second",changed))
+    a1=db.get_thread(q1)["answers"]; a2=db.get_thread(q2)["answers"]
+    assert [db.get_message_content(r["id"]) for r in a1]==[body]
+    assert [db.get_message_content(r["id"]) for r in a2]==[changed]
+
+
+def test_merge_same_signature_keeps_longer(db, words):
+    sid=db.get_or_create_session(); m=_monitor(db,"merge"); body=words(600)
+    db.save_question(sid,"2026-01-01 10:00:00","first question")
+    m._process(_answer("2026-01-01 10:00:00","first",body[:-40]))
+    m._process(_answer("2026-01-01 10:00:00","first",body))
+    rows=[r for r in db.get_all_messages() if r["service"]=="Claude"]
+    assert [r["content"] for r in rows]==[body] and m.stats["near_dup"]==1
+
+
+
+def test_rewritten_content_leaves_cache(db, words):
+    sid=db.get_or_create_session(); body=words(600)
+    db.save_message(sid,"assistant","Claude",body[:-40])
+    mid=db.get_all_messages()[0]["id"]
+    assert db.get_message_content(mid)==body[:-40]   # LRU に載せる
+    assert db.merge_near_duplicate(mid,body) is True
+    assert db.get_message_content(mid)==body
+    with db._lock:   # 差し替え API を通らない書き換えも同じトリガーで外れる
+        db._conn.execute("UPDATE messages SET content=? WHERE id=?",(db._pack("edited"),mid)); db._commit()
+    assert db.get_message_content(mid)=="edited"
+
+def test_simhash_majority_bits(words):
+    import zlib
+    text=words(300); t=cr.ChatDatabase._SIM_STRIP.sub("",text).lower()
+    hs=[zlib.crc32(g.encode())<<32|zlib.crc32(g.encode(),0x9E3779B9) for g in {t[i:i+4] for i in range(len(t)-3)}]
+    want=sum(1<<b for b in range(64) if sum(h>>b&1 for h in hs)>len(hs)/2)
+    assert cr.ChatDatabase.simhash(text)==want
+    assert cr.ChatDatabase.simhash("short") is None
+
+
+def test_process_hashes_once(db, words, monkeypatch):
+    m=_monitor(db,"merge"); body=words(600); calls=[]
+    orig=cr.ChatDatabase.simhash.__func__
+    monkeypatch.setattr(cr.ChatDatabase,"simhash",classmethod(lambda cls,t:calls.append(1) or orig(cls,t)))
+    m._process(body,hint_ai="Claude"); m._process(body+" and a longer tail.",hint_ai="Claude")
+    assert len(calls)==2 and m.stats["near_dup"]==1
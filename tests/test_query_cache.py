@@ -0,0 +1,57 @@
+import chat_rotator_v3_7f as cr
+
+
+def _fill(db, n=3):
+    sid=db.get_or_create_session()
+    for i in range(n): db.save_message(sid,"assistant","Claude",f"cached answer number {i}")
+    return sid
+
+
+def _views(db):
+    return (len(db.get_messages_page(limit=50,desc=True)),db.count_messages(""),
+            len(db.search_messages("answer")),db.get_stats()["total"])
+
+
+def test_repeated_queries_hit_cache(db):
+    _fill(db); _views(db); before=db.cache_stats()
+    _views(db); after=db.cache_stats()
+    assert after["hits"]-before["hits"]==4 and after["misses"]==before["misses"]
+
+
+def test_writes_invalidate_page_count_search_and_stats(db):
+    sid=_fill(db)
+    assert _views(db)==(3,3,3,3)
+    db.save_message(sid,"assistant","Gemini","another answer arrives")
+    assert _views(db)==(4,4,4,4)
+    mid=db.get_messages_page(limit=1,desc=True)[0]["id"]
+    db.set_labels([mid],"summary")   # UPDATE も変更フィード経由で効く
+    assert db.count_messages("label=summary")==1
+    db.delete_messages([mid])
+    assert _views(db)==(3,3,3,3)
+
+
+def test_counter_rebuild_invalidates_stats(db):
+    _fill(db); assert db.get_stats()["total"]==3
+    with db._lock:   # 変更フィードに出ない書き込み（カウンタだけ壊す）
+        db._conn.execute("UPDATE message_counters SET n=99 WHERE key='total'"); db._commit()
+    assert db.get_stats()["total"]==3   # キャッシュのまま
+    db._invalidate_queries(); assert db.get_stats()["total"]==99
+    db.rebuild_counters(); assert db.get_stats()["total"]==3
+
+
+def test_ai_service_changes_invalidate(db):
+    assert "Claude" in db.get_ai_services()
+    db.save_ai_service("Mine",{"type":"web","url":"https://example.invalid"})
+    assert "Mine" in db.get_ai_services()
+    db.delete_ai_service("Mine"); db.delete_ai_service("Claude")
+    assert not {"Mine","Claude"}&set(db.get_ai_services())
+
+
+def test_reset_clears_cached_results(db):
+    _fill(db); _views(db); db.delete_ai_service("Claude"); db.set_setting("x","1")
+    assert db.get_message_content(db.get_messages_page(limit=1)[0]["id"])
+    db.reset()
+    assert _views(db)==(0,0,0,0) and "Claude" not in db.get_ai_services() and db.get_setting("x")=="1"
+    _fill(db,1); db.reset(full=True)
+    assert _views(db)==(0,0,0,0) and db.get_setting("x") is None
+    assert set(db.get_ai_services())==set(cr.DEFAULT_AI_SERVICES)   # 既定サービスを入れ直す
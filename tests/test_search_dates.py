@@ -0,0 +1,95 @@
+from datetime import datetime
+
+import pytest
+
+import chat_rotator_v3_7f as cr
+
+span=cr.ChatDatabase._date_span
+
+
+class _Fixed(datetime):
+    @classmethod
+    def now(cls, tz=None): return cls(2026,3,10,15,30)
+
+
+@pytest.mark.parametrize("v,want",[
+    ("2026",             ("2026","2027")),
+    ("2026-02",          ("2026-02","2026-03")),
+    ("2026-12",          ("2026-12","2027-01")),   # 年をまたぐ
+    ("2026-02-28",       ("2026-02-28","2026-03-01")),
+    ("2024-02-29",       ("2024-02-29","2024-03-01")),
+    ("2026-02-15T10",    ("2026-02-15T10","2026-02-15T11")),
+    ("2026-02-15 23:59", ("2026-02-15T23:59","2026-02-16T00:00")),
+    ("2026-02-15T10:30:59",("2026-02-15T10:30:59","2026-02-15T10:31:00")),
+    ("2026-01-15..2026-02-10",("2026-01-15","2026-02-11")),   # 両端の日を含む
+    ("..2026-02",        (None,"2026-03")),
+    ("2026-01..",        ("2026-01",None)),
+])
+def test_date_span(v, want):
+    assert span(v)==want
+
+
+@pytest.mark.parametrize("v",["2026-13","2026-02-29","2026-02-15T25","claude","2026-02..nope"])
+def test_date_span_rejects(v):
+    assert span(v) is None
+
+
+def test_relative_spans(monkeypatch):
+    monkeypatch.setattr(cr,"datetime",_Fixed)
+    assert span("today")==("2026-03-10","2026-03-11")
+    assert span("Yesterday")==("2026-03-09","2026-03-10")
+    assert span("last24h")==("2026-03-09T15:30:00",None)
+    assert span("last7d")==("2026-03-03T15:30:00",None)
+    assert span("last2w")==("2026-02-24T15:30:00",None)
+
+
+@pytest.mark.parametrize("token,want",[
+    ("date=2026-02,2026-04",("date",False,[("2026-02","2026-03"),("2026-04","2026-05")])),
+    ("date=!2026-02",       ("date",True,[("2026-02","2026-03")])),
+    ("date>=2026-01-15",    ("date",False,[("2026-01-15",None)])),
+    ("date>2026-01-15",     ("date",False,[("2026-01-16",None)])),
+    ("date<2026",           ("date",False,[(None,"2026")])),
+    ("date<=2026",          ("date",False,[(None,"2027")])),
+    ("ts=2026-02-18T14:23", ("ts",False,[("2026-02-18T14:23","2026-02-18T14:24")])),
+    ("date=feb",            ("date",False,None)),          # 期間でなければ部分一致
+    ("date>=feb",           ("date",False,[("9999",None)])),   # 比較できない → 一致なし
+    ("service=claude",      None),
+    ("hello",               None),
+])
+def test_date_token(db, token, want):
+    assert db._date_token(token)==want
+
+
+@pytest.fixture
+def months(db):
+    db._archives={m:f"/nowhere/{m}.db" for m in ("2025-11","2025-12","2026-01","2026-02")}
+    return db
+
+
+@pytest.mark.parametrize("query,want",[
+    ("",                           []),
+    ("紫陽花",                      []),
+    ("date=2025-12",               ["2025-12"]),
+    ("date>=2026-01-15",           ["2026-02","2026-01"]),
+    ("date<2026",                  ["2025-12","2025-11"]),
+    ("date=2025-12-31..2026-01-01",["2026-01","2025-12"]),
+    ("date=2025-11,2026-02",       ["2026-02","2025-11"]),
+    ("date=2027",                  []),
+    ("date=!2025-12",              []),   # 否定はホットだけ
+    ("ts=2025-12",                 []),   # ts はアーカイブ月の判定に使わない
+    ("date=feb",                   ["2026-02","2026-01","2025-12","2025-11"]),   # 部分一致は全部
+])
+def test_archive_months(months, query, want):
+    assert months._archive_months(query)==want
+
+
+def test_date_filter_end_to_end(db):
+    sid=db.get_or_create_session()
+    for i in range(3): db.save_message(sid,"assistant","Claude",f"dated answer {i}")
+    with db._lock:
+        db._conn.execute("UPDATE messages SET detected_at='2026-01-31T23:59:59' WHERE id=1")
+        db._conn.execute("UPDATE messages SET detected_at='2026-02-01T00:00:00' WHERE id=2")
+        db._conn.execute("UPDATE messages SET detected_at='2026-02-28T12:00:00' WHERE id=3"); db._commit()
+    ids=lambda q: sorted(r["id"] for r in db.get_messages_page(limit=10,query=q))
+    assert ids("date=2026-02")==[2,3] and ids("date<2026-02")==[1] and ids("date=!2026-02")==[1]
+    assert ids("date=2026-01-31..2026-02-01")==[1,2] and db.count_messages("date=2026-02-28")==1
@@ -0,0 +1,160 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import chat_rotator_v3_7f as cr
+
+TOPICS=["python list sort","python dict merge","cooking pasta recipe","pasta sauce tomato","weather rain tomorrow"]
+VOCAB=sorted({w for t in TOPICS for w in t.split()})
+
+
+def _vec(text):
+    """話題の単語の出現数（＋全文共通の1次元）だけの決定的な埋め込み"""
+    v=[0.0]*len(VOCAB)+[0.1]
+    for w in text.lower().split():
+        if w in VOCAB: v[VOCAB.index(w)]+=1
+    return v
+
+
+class _Handler(BaseHTTPRequestHandler):
+    calls=[]
+    missing=()   # 404 を返すパス（Ollama / LM Studio の片方だけのサーバー）
+    short=False  # 入力より少ない件数を返す
+
+    def log_message(self, *a): pass
+
+    def do_POST(self):
+        body=json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.calls.append((self.path,len(body["input"])))
+        texts=body["input"][:-1] if self.short else body["input"]
+        if self.path in self.missing: self.send_response(404); self.end_headers(); return
+        if self.path=="/api/embed": out={"embeddings":[_vec(t) for t in texts]}
+        elif self.path=="/v1/embeddings":   # OpenAI 互換は index 順とは限らない
+            out={"data":[{"index":i,"embedding":_vec(t)} for i,t in reversed(list(enumerate(texts)))]}
+        else: self.send_response(404); self.end_headers(); return
+        b=json.dumps(out).encode()
+        self.send_response(200); self.send_header("Content-Length",str(len(b))); self.end_headers(); self.wfile.write(b)
+
+
+@pytest.fixture
+def stub():
+    _Handler.calls=[]; _Handler.missing=(); _Handler.short=False
+    srv=HTTPServer(("127.0.0.1",0),_Handler)
+    threading.Thread(target=srv.serve_forever,daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_port}"
+    srv.shutdown(); srv.server_close()
+
+
+def _local(db, enabled, url=None):
+    cfg=dict(cr.DEFAULT_AI_SERVICES["Ollama"],enabled=enabled)
+    if url: cfg["url"]=url
+    db.save_ai_service("Ollama",cfg)
+
+
+def _fill(db, n, start=0):
+    sid=db.get_or_create_session()
+    for i in range(start,start+n): db.save_message(sid,"assistant","Claude",f"{TOPICS[i%5]} variant {i}",{})
+
+
+def test_embed_ollama_first(stub):
+    texts=["python list sort","cooking pasta recipe"]
+    assert cr.LocalLLMClient.embed(stub,"m",texts)==[_vec(t) for t in texts]
+    assert [p for p,_ in _Handler.calls]==["/api/embed"]
+
+
+def test_embed_openai_compatible(stub):
+    texts=["python list sort","cooking pasta recipe","weather rain tomorrow"]
+    assert cr.LocalLLMClient.embed(stub,"m",texts,endpoint="/v1/chat/completions")==[_vec(t) for t in texts]
+    assert [p for p,_ in _Handler.calls]==["/v1/embeddings"]   # /v1/… のサービスは OpenAI 互換を先に
+
+
+def test_embed_falls_back_to_other_endpoint(stub):
+    _Handler.missing=("/api/embed",)
+    assert cr.LocalLLMClient.embed(stub,"m",["pasta"])==[_vec("pasta")]
+    assert [p for p,_ in _Handler.calls]==["/api/embed","/v1/embeddings"]
+
+
+def test_embed_rejects_short_answer(stub):
+    _Handler.short=True
+    assert cr.LocalLLMClient.embed(stub,"m",["a","b"]) is None
+
+
+def test_vector_index_appends_and_reloads(db, tmp_path):
+    np=pytest.importorskip("numpy")
+    sid=db.get_or_create_session()
+    for t in TOPICS: db.save_message(sid,"assistant","Claude",t)
+    vec=lambda i: np.asarray(_vec(TOPICS[i-1]),dtype=np.float32).tobytes()
+    db.save_embeddings("m",[(i,vec(i)) for i in (1,2,3)])
+    ix=cr.VectorIndex(db); assert ix.refresh() and len(ix)==3
+    db.save_embeddings("m",[(i,vec(i)) for i in (4,5)])
+    assert ix.refresh() and len(ix)==5 and not ix.refresh()
+    assert ix.top_k(_vec("pasta sauce tomato"),2)[0][0]==4
+    assert [i for i,_ in ix.similar(1,1)]==[2]   # python 同士
+    again=cr.VectorIndex(db)   # 行列ファイルを再利用（作り直さない）
+    assert not again.refresh() and len(again)==5
+    db.delete_messages([4])   # 削除 → 作り直し
+    assert ix.refresh() and 4 not in [i for i,_ in ix.top_k(_vec("pasta sauce tomato"),5)]
+
+
+def test_disabled_service_is_not_used(db):
+    _local(db,False)
+    assert cr.DEFAULT_AI_SERVICES["Ollama"].get("enabled") is False
+    assert cr.Embedder(db).config() is None
+
+
+def test_enabled_service_is_used(db):
+    _local(db,True)
+    url,_,model=cr.Embedder(db).config()
+    assert url==cr.DEFAULT_AI_SERVICES["Ollama"]["url"] and model==cr.Embedder.DEFAULT_MODEL
+
+
+def test_disabled_service_gets_no_requests(db, stub):
+    _local(db,False,stub); _fill(db,5)
+    assert cr.Embedder(db).run_once()==0 and _Handler.calls==[]
+
+
+@pytest.fixture
+def embedder(db, stub):
+    pytest.importorskip("numpy")
+    _local(db,True,stub); _fill(db,50)
+    e=cr.Embedder(db)
+    assert e.run_once()==50 and len(e.index)==50
+    return e
+
+
+def test_embed_and_search(embedder, db):
+    hits=embedder.search_text("pasta sauce tomato",k=3)
+    assert len(hits)==3 and all(db.get_message_content(i).startswith("pasta sauce tomato") for i,_ in hits)
+    assert all(db.get_message_content(i).startswith(TOPICS[0]) for i,_ in embedder.similar(1,3))
+
+
+def test_incremental_only_sends_new_rows(embedder, db):
+    _Handler.calls.clear(); _fill(db,3,start=50)
+    assert embedder.run_once()==3 and sum(n for _,n in _Handler.calls)==3 and len(embedder.index)==53
+
+
+def test_rewritten_rows_are_embedded_again(embedder, db):
+    assert db.merge_near_duplicate(2,"weather rain tomorrow and more rain")
+    assert not db._reader().execute("SELECT 1 FROM embeddings WHERE id=2").fetchone()
+    assert embedder.run_once()==1
+    assert embedder.similar(2,1)[0][0]%5==0   # 今は weather の行に近い
+
+
+def test_unreachable_server(db):
+    pytest.importorskip("numpy")
+    _local(db,True,"http://127.0.0.1:9"); _fill(db,2)
+    assert cr.Embedder(db).run_once()==-1
+
+
+def test_restart_after_stop(embedder, db, monkeypatch):
+    import time
+    monkeypatch.setattr(cr.Embedder,"IDLE_WAIT",0.05)
+    embedder.start(); embedder.stop(); embedder.start()   # 終了の取りやめ → 再開
+    try:
+        _fill(db,2,start=50)
+        end=time.time()+3
+        while len(embedder.index)<52 and time.time()<end: time.sleep(0.02)
+        assert len(embedder.index)==52
+    finally: embedder.stop()